@@ -1,375 +1,2628 @@
 import mysql.connector
-from datetime import datetime, timedelta, time
+import mysql.connector.pooling
+import numpy as np
+from datetime import datetime, timedelta, time, date
+import calendar
 import os
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
+import random
+import tempfile
+import threading
+import queue
+import hashlib
+import json
+import functools
+import inspect
+import shutil
+import bisect
+import uuid
+from array import array
+from collections import namedtuple
+from collections.abc import Mapping
+from time import perf_counter, sleep
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from formato_tsv import fila_tsv
+try:
+    import resource # Solo en sistemas Unix; sin él no se reporta el pico de memoria
+except ImportError:
+    resource = None
 
 # --- Configuración de Bases de Datos se leerán de Key Vault ---
 KEY_VAULT_URL = os.environ.get("KEY_VAULT_URL")
+# Segundos que se reutilizan las credenciales leídas antes de volver a pedirlas (en memoria y en la caché local cifrada)
+ETL_CREDENCIALES_TTL = float(os.environ.get("ETL_CREDENCIALES_TTL", "3600"))
+# Archivo JSON con credenciales locales {"DB-ORIGEN": {"host": ..., "port": ..., "user": ..., "password": ..., "database": ...}, ...}
+# que sustituye a Key Vault (p. ej. para probar contra un servidor local)
+ETL_CREDENCIALES_ARCHIVO = os.environ.get("ETL_CREDENCIALES_ARCHIVO", "")
+# Caché local cifrada de las credenciales de Key Vault y su clave Fernet (Fernet.generate_key(), paquete cryptography).
+# Vacío = no usarla.
+ETL_CREDENCIALES_CACHE = os.environ.get("ETL_CREDENCIALES_CACHE", "")
+ETL_CREDENCIALES_CLAVE = os.environ.get("ETL_CREDENCIALES_CLAVE", "")
+PREFIJOS_BD = ("DB-ORIGEN", "DB-ALMACEN")
+CAMPOS_SECRETOS = ('host', 'user', 'password', 'database')
 
-credential = DefaultAzureCredential()
-secret_client = SecretClient(vault_url=KEY_VAULT_URL, credential=credential)
+# --- Configuración de ejecución del ETL ---
+# 'completa': trunca el almacén (o usa tablas sombra, ver ETL_CARGA_SOMBRA) y recarga todo. 'incremental': solo extrae filas nuevas desde la última marca de agua.
+# 'cdc': replica continuamente los cambios (inserciones, actualizaciones y borrados) leyendo el binlog del origen.
+ETL_MODO_CARGA = os.environ.get("ETL_MODO_CARGA", "completa").lower()
 
-def get_db_credentials(db_prefix):
-    """Recupera las credenciales de la base de datos desde Azure Key Vault."""
-    try:
-        host = secret_client.get_secret(f"{db_prefix}-HOST").value
-        user = secret_client.get_secret(f"{db_prefix}-USER").value
-        password = secret_client.get_secret(f"{db_prefix}-PASSWORD").value
-        database = secret_client.get_secret(f"{db_prefix}-DATABASE").value
-        print(f"Credenciales para {db_prefix} recuperadas exitosamente.")
-        return {
-            'host': host,
-            'user': user,
-            'password': password,
-            'database': database,
+# Columna usada como marca de agua (high-watermark) por tabla de origen. Son claves AUTO_INCREMENT, por lo que crecen monótonamente.
+COLUMNAS_MARCA_AGUA = {
+    'Pacientes': 'PacienteID',
+    'Medicos': 'MedicoID',
+    'Especialidades': 'EspecialidadID',
+    'Citas': 'CitaID'
+}
+
+# Columnas extraídas por tabla de origen (la clave primaria siempre primero). Se omiten columnas que el almacén no usa, como Citas.Notas.
+COLUMNAS_ORIGEN = {
+    'Pacientes': ('PacienteID', 'Apellido', 'Direccion', 'FechaNacimiento', 'Genero', 'Nombre', 'Telefono'),
+    'Medicos': ('MedicoID', 'EspecialidadID', 'CodigoEmpleado', 'Nombre', 'Apellido', 'Genero'),
+    'Especialidades': ('EspecialidadID', 'NombreEspecialidad'),
+    'Citas': ('CitaID', 'PacienteID', 'MedicoID', 'FechaCita', 'HoraCita', 'EstadoCita', 'MotivoCita')
+}
+
+# Número de filas por lote en la extracción en streaming (acota la memoria usada por el ETL)
+ETL_TAMANO_LOTE = int(os.environ.get("ETL_TAMANO_LOTE", "5000"))
+# Número de filas por sentencia INSERT multi-fila (y por commit) al cargar el almacén
+ETL_TAMANO_LOTE_CARGA = int(os.environ.get("ETL_TAMANO_LOTE_CARGA", "1000"))
+# Extraer las tablas de origen en paralelo, una conexión por tabla. Más rápido, pero los datos extraídos quedan en memoria.
+ETL_EXTRACCION_PARALELA = os.environ.get("ETL_EXTRACCION_PARALELA", "false").lower() in ("1", "true", "si", "sí")
+# Número de rangos de CitaID leídos en paralelo (cada uno en su propia conexión) en la extracción paralela
+ETL_PARTICIONES_CITAS = int(os.environ.get("ETL_PARTICIONES_CITAS", "1"))
+# Cargar las dimensiones independientes en paralelo (grafo de dependencias), cada tarea en su propia conexión al almacén.
+# Implica la extracción paralela, porque las citas se recorren dos veces (dim_tiempo y citas_hechos).
+ETL_CARGA_PARALELA = os.environ.get("ETL_CARGA_PARALELA", "false").lower() in ("1", "true", "si", "sí")
+# Pipeline en la carga en streaming: la extracción de cada tabla (y la transformación de las citas) corre en hilos
+# propios comunicados por colas de ETL_TAMANO_COLA lotes, solapándose con la carga. No aplica con la extracción paralela.
+ETL_PIPELINE = os.environ.get("ETL_PIPELINE", "false").lower() in ("1", "true", "si", "sí")
+ETL_TAMANO_COLA = int(os.environ.get("ETL_TAMANO_COLA", "4"))
+# Número máximo de tareas de carga simultáneas
+ETL_HILOS_CARGA = int(os.environ.get("ETL_HILOS_CARGA", "4"))
+# Conexiones mínimas por pool (una pool por base de datos; mysql-connector admite como máximo 32). Cada pool crece
+# hasta las conexiones simultáneas que pide el paralelismo configurado (ver CONEXIONES_ORIGEN y CONEXIONES_ALMACEN).
+TAMANO_MAXIMO_POOL = mysql.connector.pooling.CNX_POOL_MAXSIZE
+ETL_TAMANO_POOL = min(int(os.environ.get("ETL_TAMANO_POOL", "8")), TAMANO_MAXIMO_POOL)
+# Timeouts en segundos para conectar y para esperar respuestas del servidor (0 = sin límite de lectura)
+ETL_TIMEOUT_CONEXION = int(os.environ.get("ETL_TIMEOUT_CONEXION", "10"))
+ETL_TIMEOUT_LECTURA = int(os.environ.get("ETL_TIMEOUT_LECTURA", "0"))
+# Reintentos ante errores transitorios y espera base (segundos) del backoff exponencial
+ETL_REINTENTOS = int(os.environ.get("ETL_REINTENTOS", "5"))
+ETL_ESPERA_REINTENTO = float(os.environ.get("ETL_ESPERA_REINTENTO", "1"))
+# Grano del calendario precalculado de dim_tiempo: 'dia', 'hora', 'minuto' o 'segundo'. Vacío = derivar dim_tiempo de
+# las citas (una fila por fecha y hora exacta). Con calendario, id_tiempo_sk de los hechos se trunca a ese grano.
+ETL_GRANO_TIEMPO = os.environ.get("ETL_GRANO_TIEMPO", "").lower()
+# Días hacia adelante que se precalculan más allá de la última fecha vista, para que el calendario casi nunca se extienda
+ETL_HORIZONTE_CALENDARIO_DIAS = int(os.environ.get("ETL_HORIZONTE_CALENDARIO_DIAS", "365"))
+SEGUNDOS_POR_GRANO = {'dia': 86400, 'hora': 3600, 'minuto': 60, 'segundo': 1}
+# Modo CDC: server_id único de este lector de binlog, tamaño e intervalo máximo (s) de cada micro-lote,
+# y duración máxima de la ejecución en segundos (0 = indefinida)
+ETL_CDC_SERVER_ID = int(os.environ.get("ETL_CDC_SERVER_ID", "4242"))
+ETL_CDC_TAMANO_LOTE = int(os.environ.get("ETL_CDC_TAMANO_LOTE", "2000"))
+ETL_CDC_INTERVALO = float(os.environ.get("ETL_CDC_INTERVALO", "5"))
+ETL_CDC_DURACION = float(os.environ.get("ETL_CDC_DURACION", "0"))
+# Tablas de origen cuyas dimensiones son SCD tipo 2: en cargas incrementales se leen completas (no por marca de agua)
+# para detectar cambios, y solo se escriben las filas cuyo hash de contenido cambió
+TABLAS_SCD2 = {'Pacientes', 'Medicos'}
+# Separación entre versiones en las SK de dimensiones SCD2 (mayor que cualquier clave de negocio INT)
+FACTOR_VERSION_SK = 10**10
+# Directorio local para estado persistente entre ejecuciones (p. ej. la caché de claves sustitutas). Vacío = no persistir.
+ETL_DIRECTORIO_ESTADO = os.environ.get("ETL_DIRECTORIO_ESTADO", "")
+# Tablas del almacén que se cargan con LOAD DATA LOCAL INFILE (separadas por coma, p. ej. "citas_hechos,dim_tiempo").
+# Si el servidor no lo permite, se vuelve a los INSERT por lotes. Las dimensiones SCD2, y citas_hechos con ETL_AGREGADOS,
+# siempre se cargan con INSERT (report_bulk_load_fallbacks lo informa al iniciar).
+ETL_CARGA_MASIVA = {t.strip() for t in os.environ.get("ETL_CARGA_MASIVA", "").split(",") if t.strip()}
+# Carga completa sobre tablas sombra ({tabla}_nueva) en lugar de truncar: el almacén sigue consultable con los datos
+# anteriores durante toda la carga y, si algo falla, no se modifica. Al final las tablas se intercambian con RENAME TABLE.
+ETL_CARGA_SOMBRA = os.environ.get("ETL_CARGA_SOMBRA", "false").lower() in ("1", "true", "si", "sí")
+
+# Hilos que cargan en paralelo las particiones mensuales (por fecha de la cita) de citas_hechos, cada uno en su propia
+# conexión al almacén; una partición que falla se reintenta sola. 1 = todo el lote en la conexión de la carga. Solo aplica
+# con la carga paralela, que une todas las citas en un lote: un lote en streaming repartido en meses serían
+# particiones de unas pocas filas, y abrirlas en otras conexiones cuesta más de lo que se gana.
+ETL_HILOS_HECHOS = int(os.environ.get("ETL_HILOS_HECHOS", "1"))
+
+# Conexiones simultáneas que puede pedir cada pool: la conexión principal de la ejecución más una por tarea de
+# extracción paralela (3 dimensiones y los rangos de CitaID) o de carga (y por partición de hechos en paralelo).
+# El paralelismo se limita para que quepa en una pool: una conexión que no llega a tiempo haría fallar la tabla.
+ETL_PARTICIONES_CITAS = max(1, min(ETL_PARTICIONES_CITAS, TAMANO_MAXIMO_POOL - 4))
+ETL_HILOS_CARGA = max(1, min(ETL_HILOS_CARGA, TAMANO_MAXIMO_POOL - 2))
+ETL_HILOS_HECHOS = max(1, min(ETL_HILOS_HECHOS, TAMANO_MAXIMO_POOL - 1 - ETL_HILOS_CARGA))
+CONEXIONES_ORIGEN = 1 + 3 + ETL_PARTICIONES_CITAS
+CONEXIONES_ALMACEN = 1 + ETL_HILOS_CARGA + ETL_HILOS_HECHOS
+# Meses de particiones de citas_hechos que se crean por adelantado más allá de la última fecha cargada
+ETL_MESES_PARTICIONES = int(os.environ.get("ETL_MESES_PARTICIONES", "12"))
+
+# Reanudar una ejecución interrumpida desde sus puntos de control (última clave confirmada por tabla de origen,
+# guardada en etl_control tras cada lote) en lugar de empezar de nuevo
+ETL_REANUDAR = os.environ.get("ETL_REANUDAR", "true").lower() in ("1", "true", "si", "sí")
+
+# Esquema compacto del almacén (almacen_citas_v2_compacto.sql): claves INT/BIGINT en lugar de VARCHAR(250). Las claves
+# se envían como enteros nativos; con el esquema original se envían como cadenas para que MySQL use los índices.
+ETL_ESQUEMA_COMPACTO = os.environ.get("ETL_ESQUEMA_COMPACTO", "false").lower() in ("1", "true", "si", "sí")
+
+# Tablas de agregados (conteos de citas por día y médico, y por mes y especialidad) que el ETL mantiene
+# incrementalmente con cada lote de citas_hechos (en la misma transacción), para que los tableros no recorran la tabla
+# de hechos. Con ellas, cada lote de hechos se carga en una sola transacción, sin reparto por mes (ETL_HILOS_HECHOS).
+# ETL_RECONSTRUIR_AGREGADOS las recalcula desde citas_hechos al final de la ejecución (p. ej. al activarlas).
+ETL_AGREGADOS = os.environ.get("ETL_AGREGADOS", "false").lower() in ("1", "true", "si", "sí")
+ETL_RECONSTRUIR_AGREGADOS = os.environ.get("ETL_RECONSTRUIR_AGREGADOS", "false").lower() in ("1", "true", "si", "sí")
+TABLAS_AGREGADOS = ('agg_citas_dia_medico', 'agg_citas_mes_especialidad') if ETL_AGREGADOS else ()
+
+# Tablas del almacén en orden de dependencias, e índices secundarios y FKs (ver almacen_citas_v2.sql) que la carga
+# con tablas sombra crea una sola vez al final en lugar de mantenerlos fila a fila
+TABLAS_ALMACEN = ('dim_especialidades', 'dim_pacientes', 'dim_medicos', 'dim_tiempo', 'citas_hechos') + TABLAS_AGREGADOS
+INDICES_DIFERIDOS = {
+    'dim_pacientes': {'id_paciente_actual': '(id_paciente, es_actual)'},
+    'dim_medicos': {'id_medico_actual': '(id_medico, es_actual)', 'FK_dim_medicos_dim_especialidades': '(id_especialidad)'},
+    'citas_hechos': {'id_paciente_sk': '(id_paciente_sk)', 'id_medico_sk': '(id_medico_sk)', 'id_tiempo_sk': '(id_tiempo_sk)'}
+}
+# citas_hechos no tiene FKs: está particionada por fecha y MySQL no las admite en tablas particionadas
+CLAVES_FORANEAS = {
+    'dim_medicos': {'FK_dim_medicos_dim_especialidades': ('id_especialidad', 'dim_especialidades', 'id_especialidad')}
+}
+# Métricas por etapa: archivo JSON lines al que se añade una línea por etapa y ejecución, y archivo en formato de texto
+# de Prometheus (para el textfile collector de node_exporter). Vacío = no escribir. Con alguno de los dos, además se
+# miden bytes y consultas por etapa con SHOW SESSION STATUS (dos consultas extra por llamada instrumentada).
+ETL_METRICAS_ARCHIVO = os.environ.get("ETL_METRICAS_ARCHIVO", "")
+ETL_METRICAS_PROMETHEUS = os.environ.get("ETL_METRICAS_PROMETHEUS", "")
+# Directorio al que se exporta además el esquema estrella en Parquet (requiere pyarrow), un archivo por tabla y lote;
+# citas_hechos particionada por anio=/mes= de fecha_hora_cita. Vacío = no exportar.
+ETL_EXPORTAR_PARQUET = os.environ.get("ETL_EXPORTAR_PARQUET", "")
+# Tamaño (bytes) a partir del cual se cierra un archivo Parquet y se abre otro. En CDC, los archivos abiertos se cierran
+# (y la exportación se compacta) cada ETL_CDC_INTERVALO_PARQUET segundos, o antes si ya hay ETL_PARQUET_ARCHIVOS_COMPACTAR
+# archivos cerrados sin compactar; entre compactaciones puede haber versiones anteriores de las filas reemplazadas.
+ETL_PARQUET_TAMANO_ARCHIVO = int(os.environ.get("ETL_PARQUET_TAMANO_ARCHIVO", str(128 * 1024 * 1024)))
+ETL_CDC_INTERVALO_PARQUET = float(os.environ.get("ETL_CDC_INTERVALO_PARQUET", "300"))
+ETL_PARQUET_ARCHIVOS_COMPACTAR = int(os.environ.get("ETL_PARQUET_ARCHIVOS_COMPACTAR", "20"))
+# Directorio de snapshots locales de las extracciones del origen (Arrow IPC comprimido, requiere pyarrow): un archivo por
+# tabla y rango de claves extraído. Vacío = no guardarlos. Con ETL_DESDE_SNAPSHOT las tablas se leen de los snapshots en
+# lugar del origen (p. ej. para repetir solo la carga tras un fallo del almacén, o para ajustar las transformaciones);
+# las que no tienen snapshot se extraen del origen. Compresión: 'lz4', 'zstd' o '' (sin comprimir: se lee sin copias).
+ETL_SNAPSHOTS = os.environ.get("ETL_SNAPSHOTS", "")
+ETL_SNAPSHOTS_COMPRESION = os.environ.get("ETL_SNAPSHOTS_COMPRESION", "lz4").lower()
+ETL_DESDE_SNAPSHOT = os.environ.get("ETL_DESDE_SNAPSHOT", "false").lower() in ("1", "true", "si", "sí")
+
+# --- Credenciales ---
+def _credenciales_entorno(db_prefix):
+    """Credenciales de las variables {PREFIJO}_HOST, _PORT, _USER, _PASSWORD y _DATABASE (p. ej. DB_ORIGEN_HOST), o None."""
+    prefijo_env = db_prefix.replace("-", "_")
+    if not os.environ.get(f"{prefijo_env}_HOST"):
+        return None
+    return {
+        'host': os.environ[f"{prefijo_env}_HOST"],
+        'port': int(os.environ.get(f"{prefijo_env}_PORT", "3306")),
+        'user': os.environ.get(f"{prefijo_env}_USER", ""),
+        'password': os.environ.get(f"{prefijo_env}_PASSWORD", ""),
+        'database': os.environ.get(f"{prefijo_env}_DATABASE", ""),
+        'ssl_ca': os.environ.get("MYSQL_SSL_CA")
+    }
+
+def _credenciales_archivo(db_prefix):
+    """Credenciales de db_prefix en ETL_CREDENCIALES_ARCHIVO, o None si no está configurado o no las contiene."""
+    if not ETL_CREDENCIALES_ARCHIVO:
+        return None
+    try:
+        with open(ETL_CREDENCIALES_ARCHIVO, encoding='utf-8') as archivo:
+            datos = json.load(archivo).get(db_prefix)
+    except (OSError, ValueError) as err:
+        print(f"Error al leer {ETL_CREDENCIALES_ARCHIVO}: {err}")
+        return None
+    if not datos:
+        return None
+    return {
+        'host': datos['host'],
+        'port': int(datos.get('port', 3306)),
+        'user': datos.get('user', ""),
+        'password': datos.get('password', ""),
+        'database': datos.get('database', ""),
+        'ssl_ca': datos.get('ssl_ca') or os.environ.get("MYSQL_SSL_CA")
+    }
+
+def _credenciales_key_vault(prefijos):
+    """Lee de Key Vault las credenciales de varios prefijos, pidiendo todos los secretos en paralelo."""
+    # Importación diferida: el módulo se puede importar (y usar con credenciales locales) sin los paquetes de Azure
+    from azure.identity import DefaultAzureCredential
+    from azure.keyvault.secrets import SecretClient
+
+    secret_client = SecretClient(vault_url=KEY_VAULT_URL, credential=DefaultAzureCredential())
+    nombres = [f"{prefijo}-{campo.upper()}" for prefijo in prefijos for campo in CAMPOS_SECRETOS]
+    with ThreadPoolExecutor(max_workers=len(nombres)) as pool:
+        valores = dict(zip(nombres, pool.map(lambda nombre: secret_client.get_secret(nombre).value, nombres)))
+    return {
+        prefijo: {
+            **{campo: valores[f"{prefijo}-{campo.upper()}"] for campo in CAMPOS_SECRETOS},
             'ssl_ca': os.environ.get("MYSQL_SSL_CA") # Para Azure MySQL Flexible Server, se espera la ruta del certificado CA
         }
-    except Exception as e:
-        print(f"Error al recuperar credenciales para {db_prefix} de Key Vault: {e}")
+        for prefijo in prefijos
+    }
+
+def _fernet():
+    """Cifrador de la caché local, o None si no está configurada o falta el paquete cryptography."""
+    if not ETL_CREDENCIALES_CACHE or not ETL_CREDENCIALES_CLAVE:
+        return None
+    try:
+        from cryptography.fernet import Fernet
+        return Fernet(ETL_CREDENCIALES_CLAVE)
+    except (ImportError, ValueError) as err:
+        print(f"Caché de credenciales desactivada: {err}")
         return None
 
-# Recuperar credenciales para origen y almacén
-DB_CONFIG_ORIGEN = get_db_credentials("DB-ORIGEN")
-DB_CONFIG_ALMACEN = get_db_credentials("DB-ALMACEN")
+def _leer_cache_credenciales(prefijos):
+    """Credenciales de la caché local cifrada si existe, no caducó y contiene todos los prefijos; si no, None."""
+    fernet = _fernet()
+    if not fernet or not os.path.exists(ETL_CREDENCIALES_CACHE):
+        return None
+    try:
+        with open(ETL_CREDENCIALES_CACHE, 'rb') as archivo:
+            # El token Fernet lleva su fecha de creación: decrypt lo rechaza si tiene más de ETL_CREDENCIALES_TTL segundos
+            configs = json.loads(fernet.decrypt(archivo.read(), ttl=int(ETL_CREDENCIALES_TTL)))
+    except Exception:
+        return None
+    return configs if all(prefijo in configs for prefijo in prefijos) else None
 
-if not KEY_VAULT_URL:
-    print("Error: La variable de entorno KEY_VAULT_URL no está configurada. Terminando.")
-    exit(1)
+def _guardar_cache_credenciales(configs):
+    fernet = _fernet()
+    if not fernet:
+        return
+    try:
+        descriptor = os.open(ETL_CREDENCIALES_CACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'wb') as archivo:
+            archivo.write(fernet.encrypt(json.dumps(configs).encode('utf-8')))
+    except OSError as err:
+        print(f"Error al guardar la caché de credenciales: {err}")
 
-if not DB_CONFIG_ORIGEN or not DB_CONFIG_ALMACEN:
-    print("No se pudieron cargar las credenciales de la base de datos desde Key Vault. Terminando ETL.")
-    exit(1)
+class CredentialProvider:
+    """Proveedor perezoso de las credenciales de las bases de datos, con caché en memoria de ETL_CREDENCIALES_TTL segundos.
 
-# --- Funciones de Conexión ---
-def connect_db(config):
-    """Establece conexión con la base de datos."""
-    try:
-        # Añadir ssl_ca si está presente en la configuración para conexiones SSL
-        if 'ssl_ca' in config and config['ssl_ca']:
-            conn = mysql.connector.connect(
-                host=config['host'],
-                user=config['user'],
-                password=config['password'],
-                database=config['database'],
-                ssl_ca=config['ssl_ca']
-            )
+    Nada se lee hasta el primer uso. Por prefijo, se usan las variables de entorno, después ETL_CREDENCIALES_ARCHIVO y
+    por último Key Vault: los prefijos que van a Key Vault se resuelven juntos (con los secretos en paralelo), pasando
+    antes por la caché local cifrada.
+    """
+
+    def __init__(self, prefijos):
+        self.prefijos = prefijos
+        self._credenciales = {} # prefijo -> (configuración o None, instante de caducidad)
+        self._lock = threading.Lock()
+
+    def get(self, db_prefix):
+        """Retorna la configuración de conexión de db_prefix, o None si no se pudo obtener."""
+        entrada = self._credenciales.get(db_prefix)
+        if entrada is None or entrada[1] <= perf_counter():
+            with self._lock:
+                entrada = self._credenciales.get(db_prefix)
+                if entrada is None or entrada[1] <= perf_counter():
+                    self._load()
+                    entrada = self._credenciales[db_prefix]
+        return entrada[0]
+
+    def _load(self):
+        expira = perf_counter() + ETL_CREDENCIALES_TTL
+        pendientes = []
+        for prefijo in self.prefijos:
+            config = _credenciales_entorno(prefijo) or _credenciales_archivo(prefijo)
+            if config:
+                print(f"Credenciales para {prefijo} leídas de la configuración local.")
+                self._credenciales[prefijo] = (config, expira)
+            else:
+                pendientes.append(prefijo)
+        if not pendientes:
+            return
+
+        configs = _leer_cache_credenciales(pendientes)
+        if configs is not None:
+            print(f"Credenciales para {', '.join(pendientes)} leídas de la caché local.")
+        elif not KEY_VAULT_URL:
+            print(f"Error: La variable de entorno KEY_VAULT_URL no está configurada y no hay credenciales locales para {', '.join(pendientes)}.")
+            configs = {}
         else:
-            # Si ssl_ca no está definido o es None, intenta la conexión sin SSL_CA explícito
-            conn = mysql.connector.connect(
-                host=config['host'],
-                user=config['user'],
-                password=config['password'],
-                database=config['database']
+            try:
+                configs = _credenciales_key_vault(pendientes)
+                print(f"Credenciales para {', '.join(pendientes)} recuperadas exitosamente.")
+                _guardar_cache_credenciales(configs)
+            except Exception as e:
+                print(f"Error al recuperar credenciales para {', '.join(pendientes)} de Key Vault: {e}")
+                configs = {}
+        for prefijo in pendientes:
+            self._credenciales[prefijo] = (configs.get(prefijo), expira)
+
+CREDENCIALES = CredentialProvider(PREFIJOS_BD)
+
+def get_db_credentials(db_prefix):
+    """Recupera las credenciales de la base de datos (ver CredentialProvider). Retorna None si no están disponibles."""
+    return CREDENCIALES.get(db_prefix)
+
+class DbConfig(Mapping):
+    """Configuración de conexión de una base de datos que se resuelve con CREDENCIALES al usarla (vacía si no está disponible)."""
+
+    def __init__(self, db_prefix):
+        self.db_prefix = db_prefix
+
+    def _config(self):
+        return get_db_credentials(self.db_prefix) or {}
+
+    def __getitem__(self, clave):
+        return self._config()[clave]
+
+    def __iter__(self):
+        return iter(self._config())
+
+    def __len__(self):
+        return len(self._config())
+
+# Configuraciones de origen y almacén: se evalúan como False si no hay credenciales
+DB_CONFIG_ORIGEN = DbConfig("DB-ORIGEN")
+DB_CONFIG_ALMACEN = DbConfig("DB-ALMACEN")
+
+# --- Funciones de Conexión ---
+# Errores de MySQL que suelen ser transitorios en Azure MySQL Flexible Server (reinicios, failover, cortes de red,
+# límite de conexiones, bloqueos) y justifican un reintento
+ERRORES_TRANSITORIOS = {1040, 1203, 1205, 1213, 1927, 2002, 2003, 2006, 2013, 2055}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def is_transient_error(err):
+    """Indica si un error de MySQL merece reintento (pool agotado o error transitorio conocido)."""
+    return isinstance(err, mysql.connector.errors.PoolError) or getattr(err, 'errno', None) in ERRORES_TRANSITORIOS
+
+def wait_before_retry(intento):
+    """Espera con backoff exponencial (y algo de jitter) antes del reintento número intento (desde 0)."""
+    sleep(ETL_ESPERA_REINTENTO * (2 ** intento) + random.uniform(0, ETL_ESPERA_REINTENTO))
+
+def get_pool(config):
+    """Obtiene (o crea) el pool de conexiones para una configuración de base de datos.
+
+    El pool tiene capacidad para todas las conexiones simultáneas que pide el paralelismo configurado.
+    """
+    clave = (config['host'], config.get('port', 3306), config['database'], config['user'])
+    with _pools_lock:
+        if clave not in _pools:
+            parametros = {
+                'host': config['host'],
+                'user': config['user'],
+                'password': config['password'],
+                'database': config['database'],
+                'port': config.get('port', 3306),
+                'connection_timeout': ETL_TIMEOUT_CONEXION,
+                'allow_local_infile_in_path': tempfile.gettempdir() # LOAD DATA LOCAL solo desde el directorio temporal
+            }
+            # Añadir ssl_ca si está presente en la configuración para conexiones SSL
+            if 'ssl_ca' in config and config['ssl_ca']:
+                parametros['ssl_ca'] = config['ssl_ca']
+            if ETL_TIMEOUT_LECTURA:
+                parametros['read_timeout'] = ETL_TIMEOUT_LECTURA
+            _pools[clave] = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name=f"etl_{config['database']}_{len(_pools)}",
+                pool_size=max(ETL_TAMANO_POOL, CONEXIONES_ORIGEN if config is DB_CONFIG_ORIGEN else CONEXIONES_ALMACEN),
+                **parametros
             )
-        
-        if conn.is_connected():
-            print(f"Conexión exitosa a la base de datos: {config['database']}")
+        return _pools[clave]
+
+def connect_db(config):
+    """Obtiene una conexión sana del pool de la base de datos, reintentando ante errores transitorios.
+
+    La conexión vuelve al pool al llamar a close(). Retorna None si se agotan los reintentos.
+    """
+    for intento in range(ETL_REINTENTOS + 1):
+        try:
+            conn = get_pool(config).get_connection()
+            # Verificación de salud: una conexión del pool puede haber sido cerrada por el servidor
+            conn.ping(reconnect=True, attempts=1, delay=0)
             return conn
-    except mysql.connector.Error as err:
-        print(f"Error al conectar a la base de datos {config['database']}: {err}")
+        except mysql.connector.Error as err:
+            if intento < ETL_REINTENTOS and is_transient_error(err):
+                print(f"Error transitorio al conectar a {config['database']} (intento {intento + 1}/{ETL_REINTENTOS + 1}): {err}. Reintentando...")
+                wait_before_retry(intento)
+                continue
+            print(f"Error al conectar a la base de datos {config['database']}: {err}")
+            return None
+
+# --- Instrumentación ---
+# Métricas acumuladas por etapa (nombre de la función instrumentada) durante la ejecución
+_metricas = {}
+_metricas_lock = threading.Lock()
+
+def _medir_bd():
+    return bool(ETL_METRICAS_ARCHIVO or ETL_METRICAS_PROMETHEUS)
+
+def _estado_sesion(conn):
+    """Retorna (bytes_enviados, bytes_recibidos, consultas) de la sesión según el servidor, o None si no se pudo leer."""
+    try:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SHOW SESSION STATUS WHERE Variable_name IN ('Bytes_received', 'Bytes_sent', 'Questions')")
+            estado = {nombre: int(valor) for nombre, valor in cursor.fetchall()}
+        finally:
+            cursor.close()
+        # Bytes_received del servidor son los bytes que envía el ETL, y viceversa
+        return estado['Bytes_received'], estado['Bytes_sent'], estado['Questions']
+    except (mysql.connector.Error, KeyError, AttributeError):
         return None
 
+def _rss_maximo():
+    """Pico de memoria residente del proceso desde que arrancó, en bytes (ru_maxrss está en KB en Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None
+
+def _pico_rss_reiniciable():
+    """Pico de memoria residente del proceso (VmHWM de /proc/self/status) en bytes, o None fuera de Linux."""
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith("VmHWM:"):
+                    return int(linea.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+# Mediciones en curso. En Linux, el pico de cada etapa se obtiene reiniciando VmHWM (5 en /proc/self/clear_refs) al
+# iniciar cada medición; antes de reiniciarlo, el pico alcanzado se acumula en todas las mediciones en curso, así
+# que las etapas anidadas o en paralelo no se ocultan el pico entre sí. False si no se puede reiniciar. Como el reinicio
+# también afecta a ru_maxrss, el pico del proceso se lleva aparte (el máximo de los picos leídos antes de cada reinicio).
+_mediciones_activas = set()
+_pico_rss_por_etapa = True
+_pico_rss_proceso = 0
+
+def _acumular_pico_rss(reiniciar):
+    """Acumula el pico desde el último reinicio en las mediciones en curso y, si se pide, lo reinicia.
+    Se llama con _metricas_lock tomado."""
+    global _pico_rss_por_etapa, _pico_rss_proceso
+    if not _pico_rss_por_etapa:
+        return
+    pico = _pico_rss_reiniciable()
+    if pico is None:
+        _pico_rss_por_etapa = False
+        return
+    _pico_rss_proceso = max(_pico_rss_proceso, pico)
+    for medicion in _mediciones_activas:
+        medicion.rss_pico = max(medicion.rss_pico, pico)
+    if reiniciar:
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            _pico_rss_por_etapa = False
+
+def _num_filas(valor):
+    """Número de filas de un lote: lista de tuplas o LoteCitas (columnas)."""
+    if isinstance(valor, LoteCitas):
+        return len(valor.cita_id)
+    return len(valor) if isinstance(valor, (list, tuple)) else 0
+
+class _Medicion:
+    """Mide una llamada a una etapa y la acumula en _metricas al registrarla."""
+
+    def __init__(self, etapa, conn=None):
+        self.etapa = etapa
+        self.conn = conn if _medir_bd() else None
+        self.estado_inicial = _estado_sesion(self.conn) if self.conn else None
+        self.rss_pico = 0
+        with _metricas_lock:
+            _acumular_pico_rss(reiniciar=True)
+            _mediciones_activas.add(self)
+        self.segundos = 0.0
+        self.filas_entrada = 0
+        self.filas_salida = 0
+        self.error = False
+
+    def registrar(self):
+        estado_final = _estado_sesion(self.conn) if self.estado_inicial else None
+        with _metricas_lock:
+            _acumular_pico_rss(reiniciar=False)
+            _mediciones_activas.discard(self)
+            rss_proceso = _pico_rss_proceso if _pico_rss_por_etapa else _rss_maximo()
+            m = _metricas.setdefault(self.etapa, {
+                'llamadas': 0, 'errores': 0, 'segundos': 0.0, 'filas_entrada': 0, 'filas_salida': 0,
+                'bytes_enviados': 0, 'bytes_recibidos': 0, 'consultas': 0, 'rss_pico_etapa_bytes': 0,
+                'rss_pico_proceso_bytes': 0
+            })
+            m['llamadas'] += 1
+            m['errores'] += self.error
+            m['segundos'] += self.segundos
+            m['filas_entrada'] += self.filas_entrada
+            m['filas_salida'] += self.filas_salida
+            if estado_final:
+                m['bytes_enviados'] += estado_final[0] - self.estado_inicial[0]
+                m['bytes_recibidos'] += estado_final[1] - self.estado_inicial[1]
+                m['consultas'] += estado_final[2] - self.estado_inicial[2] - 1 # Sin contar el propio SHOW STATUS
+            if _pico_rss_por_etapa:
+                m['rss_pico_etapa_bytes'] = max(m['rss_pico_etapa_bytes'], self.rss_pico)
+            if rss_proceso:
+                m['rss_pico_proceso_bytes'] = max(m['rss_pico_proceso_bytes'], rss_proceso)
+
+def instrumentado(fn):
+    """Decorador que acumula tiempo, filas, bytes, consultas y pico de memoria por etapa (el nombre de la función).
+
+    De memoria se registran el pico de la residente durante la etapa (rss_pico_etapa_bytes, solo en Linux; incluye
+    lo que otros hilos asignen mientras tanto) y el pico del proceso desde que arrancó, medido al terminar la etapa
+    (rss_pico_proceso_bytes), que no es atribuible solo a ella.
+
+    El primer argumento, si es una conexión, se usa para medir bytes y consultas. En los cargadores, las filas
+    de entrada son las del lote recibido y las de salida las que retorna la función (None cuenta como error).
+    En generadores (extract_data) solo se mide el tiempo dentro del generador y las filas de los lotes producidos.
+    """
+    def conexion(args):
+        return args[0] if args and hasattr(args[0], 'cursor') else None
+
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def envoltura_generador(*args, **kwargs):
+            medicion = _Medicion(fn.__name__, conexion(args))
+            generador = fn(*args, **kwargs)
+            try:
+                while True:
+                    inicio = perf_counter()
+                    try:
+                        lote = next(generador)
+                    except StopIteration:
+                        return
+                    except Exception:
+                        medicion.error = True
+                        raise
+                    finally:
+                        medicion.segundos += perf_counter() - inicio
+                    medicion.filas_salida += _num_filas(lote)
+                    yield lote
+            finally:
+                generador.close()
+                medicion.registrar()
+        return envoltura_generador
+
+    @functools.wraps(fn)
+    def envoltura(*args, **kwargs):
+        medicion = _Medicion(fn.__name__, conexion(args))
+        if len(args) > 1:
+            medicion.filas_entrada = _num_filas(args[1])
+        inicio = perf_counter()
+        try:
+            resultado = fn(*args, **kwargs)
+        except Exception:
+            medicion.error = True
+            raise
+        else:
+            if isinstance(resultado, int) and not isinstance(resultado, bool):
+                medicion.filas_salida = resultado
+            elif resultado is None and medicion.filas_entrada:
+                medicion.error = True
+            return resultado
+        finally:
+            medicion.segundos = perf_counter() - inicio
+            medicion.registrar()
+    return envoltura
+
+def write_metrics():
+    """Imprime el resumen de métricas por etapa y lo escribe en ETL_METRICAS_ARCHIVO / ETL_METRICAS_PROMETHEUS."""
+    with _metricas_lock:
+        metricas = {etapa: dict(m) for etapa, m in _metricas.items()}
+    if not metricas:
+        return
+    for m in metricas.values():
+        m['filas_por_segundo'] = round(max(m['filas_entrada'], m['filas_salida']) / m['segundos'], 1) if m['segundos'] else 0.0
+        m['segundos'] = round(m['segundos'], 3)
+
+    print("\nMétricas por etapa:")
+    for etapa, m in metricas.items():
+        print(f"  {etapa}: {m['segundos']}s, {m['llamadas']} llamadas, {m['filas_entrada']} filas de entrada, "
+              f"{m['filas_salida']} de salida ({m['filas_por_segundo']} filas/s), {m['consultas']} consultas, "
+              f"{m['bytes_enviados'] + m['bytes_recibidos']} bytes, {m['errores']} errores")
+
+    try:
+        if ETL_METRICAS_ARCHIVO:
+            marca_tiempo = datetime.now().isoformat(timespec='seconds')
+            with open(ETL_METRICAS_ARCHIVO, 'a', encoding='utf-8') as archivo:
+                for etapa, m in metricas.items():
+                    archivo.write(json.dumps({'fecha': marca_tiempo, 'modo': ETL_MODO_CARGA, 'etapa': etapa, **m}) + "\n")
+        if ETL_METRICAS_PROMETHEUS:
+            lineas = []
+            for nombre in ('llamadas', 'errores', 'segundos', 'filas_entrada', 'filas_salida', 'filas_por_segundo',
+                           'bytes_enviados', 'bytes_recibidos', 'consultas', 'rss_pico_etapa_bytes', 'rss_pico_proceso_bytes'):
+                lineas.append(f"# TYPE etl_etapa_{nombre} gauge")
+                lineas.extend(f'etl_etapa_{nombre}{{etapa="{etapa}",modo="{ETL_MODO_CARGA}"}} {m[nombre]}' for etapa, m in metricas.items())
+            # Escritura atómica para que el collector nunca lea un archivo a medias
+            temporal = ETL_METRICAS_PROMETHEUS + ".tmp"
+            with open(temporal, 'w', encoding='utf-8') as archivo:
+                archivo.write("\n".join(lineas) + "\n")
+            os.replace(temporal, ETL_METRICAS_PROMETHEUS)
+    except OSError as err:
+        print(f"Error al escribir las métricas: {err}")
+
+# --- Exportación columnar (Parquet) ---
+# Columnas de baja cardinalidad que se guardan con codificación de diccionario
+COLUMNAS_DICCIONARIO = {'estado_cita', 'motivo_cita', 'genero', 'nombre_mes', 'dia_semana'}
+# Tablas exportadas cuyas filas se reemplazan por clave (upsert). Las dimensiones SCD2 no están: cada versión tiene su
+# propia SK y la vigente de cada clave de negocio es la de mayor version; dim_tiempo nunca cambia.
+CLAVES_EXPORTACION = {'citas_hechos': 'id_cita', 'dim_especialidades': 'id_especialidad_sk'}
+
+# Estado de la exportación de esta ejecución: directorio ('' = desactivada), si alguna escritura falló, escritores
+# abiertos {(tabla, particion): (ParquetWriter, ruta)}, archivos cerrados desde la última compactación y, en las
+# exportaciones que se compactan (incrementales y CDC), las claves escritas o borradas desde la última compactación
+# con el archivo que tiene su versión vigente {tabla: {clave: ruta final, o None si se borró}}, y los archivos en los
+# que alguna clave se escribió más de una vez (en CDC un archivo sigue abierto durante varios micro-lotes)
+_exportacion = {'directorio': '', 'errores': False, 'escritores': {}, 'archivos': set(), 'compactar': False, 'claves': {},
+                'repetidos': set()}
+_exportacion_lock = threading.Lock()
+
+def prepare_parquet_export(completa, reanudar=False):
+    """Prepara la exportación Parquet de una ejecución.
+
+    Las cargas completas escriben en {directorio}.nueva, que publish_parquet_export publica al terminar (como las
+    tablas sombra); al reanudar se conserva lo ya escrito. Las incrementales y CDC añaden archivos al directorio
+    publicado y, al cerrarlos, compactan los anteriores (ver compact_parquet_export).
+    """
+    close_parquet_export()
+    _exportacion.update(directorio='', errores=False, archivos=set(), compactar=not completa, claves={}, repetidos=set())
+    if not ETL_EXPORTAR_PARQUET:
+        return
+    try:
+        import pyarrow.parquet # noqa: F401
+    except ImportError:
+        print("La exportación Parquet requiere el paquete pyarrow (pip install pyarrow). Se omite.")
+        return
+    directorio = ETL_EXPORTAR_PARQUET + ".nueva" if completa else ETL_EXPORTAR_PARQUET
+    if completa and not reanudar:
+        shutil.rmtree(directorio, ignore_errors=True)
+    os.makedirs(directorio, exist_ok=True)
+    # Archivos que una ejecución interrumpida dejó sin cerrar: sus filas no pueden recuperarse
+    incompletos = [os.path.join(raiz, archivo) for raiz, _, archivos in os.walk(directorio)
+                   for archivo in archivos if archivo.endswith(".parcial")]
+    for ruta in incompletos:
+        os.remove(ruta)
+    if incompletos:
+        print(f"La exportación Parquet de la ejecución interrumpida perdió {len(incompletos)} archivos sin cerrar.")
+        if completa:
+            print("La exportación de esta carga completa no se publicará; la próxima carga completa la regenera.")
+            _exportacion['errores'] = True
+    _exportacion['directorio'] = directorio
+
+def export_parquet(table_name, columnas, filas, particion=None):
+    """Escribe un lote de filas de una tabla del almacén en la exportación Parquet (con fecha_carga).
+
+    Cada tabla (y partición) tiene un archivo abierto al que cada lote se añade como un grupo de filas; se abre otro
+    si cambian los tipos (p. ej. una columna que en el primer lote era toda NULL) o al llegar a ETL_PARQUET_TAMANO_ARCHIVO.
+    particion es una ruta relativa estilo Hive (p. ej. 'anio=2025/mes=03'). Los errores no detienen la carga del
+    almacén, pero impiden publicar la exportación de una carga completa.
+    """
+    if not _exportacion['directorio'] or not filas:
+        return
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    with _exportacion_lock:
+        try:
+            columnas_arrow = {}
+            for columna, valores in zip(columnas, zip(*filas)):
+                if columna in COLUMNAS_DICCIONARIO:
+                    columnas_arrow[columna] = pa.array(valores, type=pa.string()).dictionary_encode()
+                else:
+                    columnas_arrow[columna] = pa.array(valores)
+            columnas_arrow['fecha_carga'] = pa.array([datetime.now().replace(microsecond=0)] * len(filas))
+            tabla = pa.table(columnas_arrow)
+
+            abierto = _exportacion['escritores'].get((table_name, particion))
+            if abierto and not tabla.schema.equals(abierto[0].schema):
+                try:
+                    tabla = tabla.cast(abierto[0].schema)
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                    _close_parquet_writer(table_name, particion)
+                    abierto = None
+            if not abierto:
+                directorio = os.path.join(_exportacion['directorio'], table_name, *([particion] if particion else []))
+                os.makedirs(directorio, exist_ok=True)
+                # Se escribe como .parcial y se renombra al cerrarse, cuando el archivo ya tiene su pie (footer)
+                ruta = os.path.join(directorio, f"part-{uuid.uuid4().hex}.parquet.parcial")
+                abierto = (pq.ParquetWriter(ruta, tabla.schema, compression='zstd',
+                                            use_dictionary=[c for c in columnas if c in COLUMNAS_DICCIONARIO]), ruta)
+                _exportacion['escritores'][(table_name, particion)] = abierto
+            abierto[0].write_table(tabla)
+            if _exportacion['compactar'] and table_name in CLAVES_EXPORTACION:
+                indice = columnas.index(CLAVES_EXPORTACION[table_name])
+                final = abierto[1][:-len(".parcial")]
+                claves = _exportacion['claves'].setdefault(table_name, {})
+                for fila in filas:
+                    if claves.get(fila[indice]) == final:
+                        _exportacion['repetidos'].add(final)
+                    claves[fila[indice]] = final
+            if os.path.getsize(abierto[1]) >= ETL_PARQUET_TAMANO_ARCHIVO:
+                _close_parquet_writer(table_name, particion)
+        except (pa.ArrowException, OSError) as err:
+            _exportacion['errores'] = True
+            print(f"Error al exportar {table_name} a Parquet: {err}")
+
+def export_fact_parquet(filas, meses):
+    """Exporta filas de citas_hechos en la partición de su mes (meses: datetime64[M] de cada fila)."""
+    if not _exportacion['directorio']:
+        return
+    valores_mes, indice_mes = np.unique(meses, return_inverse=True)
+    for i, mes in enumerate(valores_mes.astype(object)):
+        export_parquet('citas_hechos', COLUMNAS_HECHOS, [filas[j] for j in np.flatnonzero(indice_mes == i)],
+                       f"anio={mes.year}/mes={mes.month:02d}")
+
+def delete_parquet_rows(table_name, claves):
+    """Registra claves borradas del almacén, para que compact_parquet_export las quite de la exportación."""
+    if _exportacion['directorio'] and _exportacion['compactar']:
+        with _exportacion_lock:
+            _exportacion['claves'].setdefault(table_name, {}).update(dict.fromkeys(claves))
+
+def _close_parquet_writer(table_name, particion):
+    escritor, ruta = _exportacion['escritores'].pop((table_name, particion))
+    escritor.close()
+    final = ruta[:-len(".parcial")]
+    os.replace(ruta, final)
+    _exportacion['archivos'].add(final)
+
+def close_parquet_export():
+    """Cierra los archivos abiertos de la exportación y, en las incrementales y CDC, compacta los anteriores."""
+    if not _exportacion['escritores'] and not _exportacion['claves']:
+        return
+    import pyarrow as pa
+    with _exportacion_lock:
+        try:
+            for table_name, particion in list(_exportacion['escritores']):
+                _close_parquet_writer(table_name, particion)
+        except (pa.ArrowException, OSError) as err:
+            _exportacion['errores'] = True
+            _exportacion['escritores'].clear()
+            print(f"Error al cerrar la exportación Parquet: {err}")
+    compact_parquet_export()
+
+def _parquet_file_may_contain(ruta, columna, claves_ordenadas):
+    """Indica, leyendo solo el pie del archivo, si el rango [mín., máx.] de columna de algún grupo de filas abarca
+    alguna de las claves (ordenadas). Sin estadísticas, se asume que sí."""
+    import pyarrow.parquet as pq
+    metadatos = pq.read_metadata(ruta)
+    indice = metadatos.schema.names.index(columna)
+    for grupo in range(metadatos.num_row_groups):
+        estadisticas = metadatos.row_group(grupo).column(indice).statistics
+        if estadisticas is None or not estadisticas.has_min_max:
+            return True
+        posicion = bisect.bisect_left(claves_ordenadas, estadisticas.min)
+        if posicion < len(claves_ordenadas) and claves_ordenadas[posicion] <= estadisticas.max:
+            return True
+    return False
+
+def compact_parquet_export():
+    """Quita de los archivos Parquet las filas cuya clave se reescribió o se borró desde la última compactación.
+
+    En cargas incrementales y CDC las filas actualizadas (p. ej. una cita reprogramada, que además puede cambiar de
+    partición) se añaden en archivos nuevos; sin compactar, la exportación tendría varias versiones de la misma
+    clave. De cada clave se conserva solo la última fila escrita, en el archivo de su versión vigente. Los archivos
+    cuyo pie indica que no abarcan ninguna de las claves no se leen; de los demás se lee solo la columna clave, y
+    se reescriben los que contienen alguna versión reemplazada.
+    """
+    if not _exportacion['claves']:
+        return
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    with _exportacion_lock:
+        claves_por_tabla, _exportacion['claves'] = _exportacion['claves'], {}
+        repetidos, _exportacion['repetidos'] = _exportacion['repetidos'], set()
+        _exportacion['archivos'] = set()
+        reescritos = 0
+        try:
+            for table_name, claves in claves_por_tabla.items():
+                columna = CLAVES_EXPORTACION[table_name]
+                claves_ordenadas = sorted(claves)
+                todas = pa.array(claves_ordenadas)
+                vigentes_por_archivo = {}
+                for clave, ruta in claves.items():
+                    if ruta is not None:
+                        vigentes_por_archivo.setdefault(ruta, []).append(clave)
+                for raiz, _, archivos in os.walk(os.path.join(_exportacion['directorio'], table_name)):
+                    for archivo in archivos:
+                        ruta = os.path.join(raiz, archivo)
+                        if not archivo.endswith(".parquet") or not _parquet_file_may_contain(ruta, columna, claves_ordenadas):
+                            continue
+                        valores = pq.read_table(ruta, columns=[columna]).column(0)
+                        conservar = ~pc.is_in(valores, value_set=todas.cast(valores.type)).to_numpy(zero_copy_only=False)
+                        if ruta in vigentes_por_archivo:
+                            vigentes = pa.array(vigentes_por_archivo[ruta]).cast(valores.type)
+                            propias = np.flatnonzero(pc.is_in(valores, value_set=vigentes).to_numpy(zero_copy_only=False))
+                            if ruta in repetidos:
+                                # Última fila de cada clave: su primera aparición recorriendo las filas al revés
+                                claves_propias = valores.take(pa.array(propias)).to_numpy(zero_copy_only=False)[::-1]
+                                propias = propias[::-1][np.unique(claves_propias, return_index=True)[1]]
+                            conservar[propias] = True
+                        if conservar.all():
+                            continue
+                        tabla = pq.read_table(ruta).filter(pa.array(conservar))
+                        if tabla.num_rows:
+                            pq.write_table(tabla, ruta + ".parcial", compression='zstd',
+                                           use_dictionary=[c for c in tabla.column_names if c in COLUMNAS_DICCIONARIO])
+                            os.replace(ruta + ".parcial", ruta)
+                        else:
+                            os.remove(ruta)
+                        reescritos += 1
+        except (pa.ArrowException, OSError) as err:
+            _exportacion['errores'] = True
+            print(f"Error al compactar la exportación Parquet: {err}")
+        if reescritos:
+            print(f"Exportación Parquet compactada: {reescritos} archivos con filas reemplazadas.")
+
+def publish_parquet_export():
+    """Publica la exportación de una carga completa reemplazando el directorio anterior.
+
+    Con el calendario precalculado, dim_tiempo no se recarga en cargas completas, así que sus archivos anteriores
+    se conservan. Retorna False si hubo errores de exportación (y entonces no se publica).
+    """
+    close_parquet_export()
+    directorio = _exportacion['directorio']
+    if not directorio or directorio == ETL_EXPORTAR_PARQUET:
+        return True
+    if _exportacion['errores']:
+        print(f"Hubo errores al exportar a Parquet; la exportación queda sin publicar en {directorio}.")
+        return False
+    antiguo = ETL_EXPORTAR_PARQUET + ".antigua"
+    shutil.rmtree(antiguo, ignore_errors=True)
+    if os.path.isdir(ETL_EXPORTAR_PARQUET):
+        if ETL_GRANO_TIEMPO and os.path.isdir(os.path.join(ETL_EXPORTAR_PARQUET, 'dim_tiempo')):
+            os.makedirs(os.path.join(directorio, 'dim_tiempo'), exist_ok=True)
+            for archivo in os.listdir(os.path.join(ETL_EXPORTAR_PARQUET, 'dim_tiempo')):
+                os.replace(os.path.join(ETL_EXPORTAR_PARQUET, 'dim_tiempo', archivo), os.path.join(directorio, 'dim_tiempo', archivo))
+        os.replace(ETL_EXPORTAR_PARQUET, antiguo)
+    os.replace(directorio, ETL_EXPORTAR_PARQUET)
+    shutil.rmtree(antiguo, ignore_errors=True)
+    _exportacion['directorio'] = ETL_EXPORTAR_PARQUET
+    print(f"Exportación Parquet publicada en {ETL_EXPORTAR_PARQUET}.")
+    return True
+
+# --- Snapshots locales de las extracciones (Arrow IPC) ---
+# Tipos Arrow de las columnas de COLUMNAS_ORIGEN (HoraCita llega de MySQL como timedelta)
+TIPOS_SNAPSHOT = {
+    'Pacientes': ('int64', 'string', 'string', 'date32', 'string', 'string', 'string'),
+    'Medicos': ('int64', 'int64', 'string', 'string', 'string', 'string'),
+    'Especialidades': ('int64', 'string'),
+    'Citas': ('int64', 'int64', 'int64', 'date32', 'duration', 'string', 'string')
+}
+
+def _esquema_snapshot(table_name):
+    import pyarrow as pa
+    tipos = {'int64': pa.int64(), 'string': pa.string(), 'date32': pa.date32(), 'duration': pa.duration('us')}
+    return pa.schema([(columna, tipos[tipo]) for columna, tipo in zip(COLUMNAS_ORIGEN[table_name], TIPOS_SNAPSHOT[table_name])])
+
+def _snapshots_de(table_name):
+    """Snapshots completos de una tabla como [(desde, hasta, ruta)]: cubren las claves desde < clave <= hasta."""
+    if not os.path.isdir(ETL_SNAPSHOTS):
+        return []
+    snapshots = []
+    for archivo in os.listdir(ETL_SNAPSHOTS):
+        partes = archivo[:-len(".arrow")].split("_") if archivo.endswith(".arrow") else []
+        if len(partes) == 3 and partes[0] == table_name and partes[1].isdigit() and partes[2].isdigit():
+            snapshots.append((int(partes[1]), int(partes[2]), os.path.join(ETL_SNAPSHOTS, archivo)))
+    return snapshots
+
+def find_snapshots(table_name, marca_agua=None, hasta=None):
+    """Retorna las rutas de los snapshots que, encadenados, cubren las claves posteriores a marca_agua (hasta 'hasta').
+
+    Retorna [] si ningún snapshot empieza en marca_agua o antes (la tabla debe extraerse del origen).
+    """
+    if not ETL_SNAPSHOTS:
+        return []
+    try:
+        import pyarrow # noqa: F401
+    except ImportError:
+        print("Los snapshots de extracción requieren el paquete pyarrow (pip install pyarrow). Se omiten.")
+        return []
+    disponibles = _snapshots_de(table_name)
+    posicion = marca_agua or 0
+    rutas = []
+    while hasta is None or posicion < hasta:
+        cubren = [snapshot for snapshot in disponibles if snapshot[0] <= posicion < snapshot[1]]
+        if not cubren:
+            break
+        _, posicion, ruta = max(cubren, key=lambda snapshot: snapshot[1])
+        rutas.append(ruta)
+    return rutas
+
+def read_snapshot(table_name, rutas, marca_agua=None, hasta=None):
+    """Genera los lotes de los snapshots indicados con claves en (marca_agua, hasta], como extract_data.
+
+    Los archivos se abren mapeados en memoria y se leen lote a lote. Los lotes de Citas se entregan ya
+    transformados (LoteCitas, con transform_citas_arrow); los de las demás tablas como listas de tuplas.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    for ruta in rutas:
+        lector = pa.ipc.open_file(pa.memory_map(ruta))
+        for i in range(lector.num_record_batches):
+            lote = lector.get_batch(i)
+            claves = lote.column(0)
+            # Los lotes están ordenados por clave: solo se filtran los que cruzan los límites pedidos
+            if not lote.num_rows or (marca_agua is not None and claves[-1].as_py() <= marca_agua):
+                continue
+            if hasta is not None and claves[0].as_py() > hasta:
+                return
+            if marca_agua is not None and claves[0].as_py() <= marca_agua:
+                lote = lote.filter(pc.greater(claves, marca_agua))
+            if hasta is not None and lote.column(0)[-1].as_py() > hasta:
+                lote = lote.filter(pc.less_equal(lote.column(0), hasta))
+            if table_name == 'Citas':
+                yield transform_citas_arrow(lote)
+            else:
+                yield list(zip(*(columna.to_pylist() for columna in lote.columns)))
+
+class SnapshotWriter:
+    """Escribe en ETL_SNAPSHOTS los lotes de una extracción del origen, en un archivo Arrow IPC por tabla y rango.
+
+    El archivo se escribe como .parcial y solo se publica ({tabla}_{desde}_{hasta}.arrow) si la extracción termina
+    completa; entonces se eliminan los snapshots anteriores de la tabla cuyo rango queda contenido en el nuevo.
+    Un error de escritura no detiene la extracción: solo descarta el snapshot.
+    """
+
+    def __init__(self, table_name, marca_agua=None, hasta=None):
+        self.table_name = table_name
+        self.desde = marca_agua or 0
+        self.hasta = hasta
+        self.ultima_clave = None
+        self.escritor = None
+        self.ruta_parcial = None
+        self.fallido = False
+
+    def write(self, filas):
+        if self.fallido or not filas:
+            return
+        try:
+            import pyarrow as pa
+        except ImportError:
+            print("Los snapshots de extracción requieren el paquete pyarrow (pip install pyarrow). Se omiten.")
+            self.fallido = True
+            return
+        try:
+            esquema = _esquema_snapshot(self.table_name)
+            if self.escritor is None:
+                os.makedirs(ETL_SNAPSHOTS, exist_ok=True)
+                self.ruta_parcial = os.path.join(ETL_SNAPSHOTS, f"{self.table_name}_{uuid.uuid4().hex}.parcial")
+                opciones = pa.ipc.IpcWriteOptions(compression=ETL_SNAPSHOTS_COMPRESION or None)
+                self.escritor = pa.ipc.new_file(self.ruta_parcial, esquema, options=opciones)
+            columnas = [pa.array(valores, type=tipo) for valores, tipo in zip(zip(*filas), esquema.types)]
+            self.escritor.write_batch(pa.RecordBatch.from_arrays(columnas, schema=esquema))
+            self.ultima_clave = filas[-1][0]
+        except (pa.ArrowException, OSError, TypeError, ValueError) as err:
+            print(f"Error al escribir el snapshot de {self.table_name}: {err}. Se descarta.")
+            self.close(completa=False)
+            self.fallido = True
+
+    def close(self, completa):
+        """Cierra el archivo y lo publica si la extracción terminó completa; si no, lo elimina."""
+        escritor, self.escritor = self.escritor, None
+        if escritor is None:
+            return
+        try:
+            escritor.close()
+            if completa and not self.fallido:
+                hasta = self.hasta if self.hasta is not None else self.ultima_clave
+                ruta = os.path.join(ETL_SNAPSHOTS, f"{self.table_name}_{self.desde}_{hasta}.arrow")
+                os.replace(self.ruta_parcial, ruta)
+                for desde_anterior, hasta_anterior, ruta_anterior in _snapshots_de(self.table_name):
+                    if ruta_anterior != ruta and self.desde <= desde_anterior and hasta_anterior <= hasta:
+                        os.remove(ruta_anterior)
+                print(f"Snapshot de {self.table_name} guardado en {ruta}.")
+                return
+        except (OSError, ValueError) as err:
+            print(f"Error al guardar el snapshot de {self.table_name}: {err}")
+        if os.path.exists(self.ruta_parcial):
+            os.remove(self.ruta_parcial)
+
 # --- Funciones ETL  ---
 
-def extract_data(conn_origen, table_name):
-    """Extrae todos los datos de una tabla de la base de datos de origen."""
-    cursor = conn_origen.cursor(dictionary=True) # Retorna filas como diccionarios
+def sql_key(valor):
+    """Clave tal como se envía al almacén: entero nativo en el esquema compacto, o cadena para las columnas VARCHAR(250).
+
+    None (NULL en el origen) se conserva como None.
+    """
+    if valor is None:
+        return None
+    return int(valor) if ETL_ESQUEMA_COMPACTO else str(valor)
+
+def sql_keys(valores):
+    """Versión de sql_key para un array NumPy de enteros; retorna una lista."""
+    return valores.tolist() if ETL_ESQUEMA_COMPACTO else valores.astype(str).tolist()
+
+# Errores que extract_data relanza al interrumpirse: del origen, o de lectura de un snapshot (pyarrow)
+ERRORES_EXTRACCION = (mysql.connector.Error, OSError, ValueError)
+
+@instrumentado
+def extract_data(conn_origen, table_name, marca_agua=None, tamano_lote=ETL_TAMANO_LOTE, hasta=None):
+    """Extrae una tabla de origen en streaming, generando lotes de tuplas (en el orden de COLUMNAS_ORIGEN).
+
+    Usa un cursor sin buffer, por lo que solo un lote vive en memoria a la vez. Si se indica
+    marca_agua, solo se extraen las filas posteriores a ella; con hasta, solo hasta esa clave (inclusive).
+    Con ETL_SNAPSHOTS los lotes se guardan además en un snapshot local; con ETL_DESDE_SNAPSHOT se leen de
+    él si existe (sin consultar el origen, y las citas ya transformadas). Un error a mitad de la extracción se
+    relanza (ver ERRORES_EXTRACCION), para que la tabla no se dé por cargada con solo parte de sus filas.
+    """
+    if ETL_DESDE_SNAPSHOT:
+        rutas = find_snapshots(table_name, marca_agua, hasta)
+        if rutas:
+            print(f"Leyendo {table_name} desde {len(rutas)} snapshot(s) locales...")
+            try:
+                yield from read_snapshot(table_name, rutas, marca_agua, hasta)
+            except (OSError, ValueError) as err:
+                print(f"Error al leer el snapshot de {table_name}: {err}")
+                raise
+            return
+        print(f"No hay snapshot de {table_name}; se extrae del origen.")
+
+    columnas = COLUMNAS_ORIGEN[table_name]
+    columna_marca = COLUMNAS_MARCA_AGUA[table_name]
+    query = f"SELECT {', '.join(columnas)} FROM {table_name}"
+    condiciones = []
+    params = []
+    if marca_agua is not None:
+        condiciones.append(f"{columna_marca} > %s")
+        params.append(marca_agua)
+    if hasta is not None:
+        condiciones.append(f"{columna_marca} <= %s")
+        params.append(hasta)
+    if condiciones:
+        query += " WHERE " + " AND ".join(condiciones)
+    query += f" ORDER BY {columna_marca}"
+
+    snapshot = SnapshotWriter(table_name, marca_agua, hasta) if ETL_SNAPSHOTS else None
+    completa = False
+    cursor = conn_origen.cursor(buffered=False) # Cursor sin buffer: las filas se leen del servidor a medida que se piden
     try:
-        cursor.execute(f"SELECT * FROM {table_name}")
-        return cursor.fetchall()
+        cursor.execute(query, params)
+        while True:
+            lote = cursor.fetchmany(tamano_lote)
+            if not lote:
+                break
+            if snapshot:
+                snapshot.write(lote)
+            yield lote
+        completa = True
     except mysql.connector.Error as err:
         print(f"Error al extraer datos de {table_name}: {err}")
+        raise
+    finally:
+        cursor.close()
+        if snapshot:
+            snapshot.close(completa)
+
+def get_key_ranges(conn_origen, table_name, particiones, marca_agua=None):
+    """Divide el rango de claves primarias pendientes de una tabla en particiones contiguas [(desde, hasta), ...]."""
+    columna = COLUMNAS_MARCA_AGUA[table_name]
+    cursor = conn_origen.cursor()
+    try:
+        cursor.execute(f"SELECT MIN({columna}), MAX({columna}) FROM {table_name} WHERE {columna} > %s",
+                       (marca_agua if marca_agua is not None else -1,))
+        minimo, maximo = cursor.fetchone()
+    finally:
+        cursor.close()
+    if minimo is None:
         return []
+    # Cada rango es (desde exclusivo, hasta inclusivo), igual que marca_agua/hasta en extract_data
+    paso = max(1, -(-(maximo - minimo + 1) // particiones))
+    return [(desde - 1, min(desde + paso - 1, maximo)) for desde in range(minimo, maximo + 1, paso)]
+
+def _extract_to_list(config, table_name, marca_agua=None, hasta=None):
+    """Extrae una tabla (o un rango de ella) completa en su propia conexión. Retorna la lista de lotes, o None si falló."""
+    conn = None
+    if not (ETL_DESDE_SNAPSHOT and find_snapshots(table_name, marca_agua, hasta)):
+        conn = connect_db(config)
+        if not conn:
+            return None
+    try:
+        return list(extract_data(conn, table_name, marca_agua, hasta=hasta))
+    except ERRORES_EXTRACCION:
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def extract_data_parallel(config, marcas_agua, particiones_citas=1):
+    """Extrae todas las tablas de origen en paralelo, con una conexión por tabla (y por rango de CitaID).
+
+    Retorna {tabla: lista de lotes o None si la extracción falló}. A diferencia de extract_data, los
+    lotes quedan en memoria: se cambia memoria por tiempo de extracción.
+    """
+    tareas = {tabla: [(marcas_agua.get(tabla), None)] for tabla in ('Especialidades', 'Pacientes', 'Medicos')}
+    tareas['Citas'] = [(marcas_agua.get('Citas'), None)]
+    if particiones_citas > 1 and not (ETL_DESDE_SNAPSHOT and find_snapshots('Citas', marcas_agua.get('Citas'))):
+        conn = connect_db(config)
+        if conn:
+            try:
+                tareas['Citas'] = get_key_ranges(conn, 'Citas', particiones_citas, marcas_agua.get('Citas'))
+            finally:
+                conn.close()
+
+    with ThreadPoolExecutor(max_workers=sum(len(rangos) for rangos in tareas.values()) or 1) as pool:
+        futuros = {
+            tabla: [pool.submit(_extract_to_list, config, tabla, desde, hasta) for desde, hasta in rangos]
+            for tabla, rangos in tareas.items()
+        }
+        resultado = {}
+        for tabla, futuros_tabla in futuros.items():
+            partes = [futuro.result() for futuro in futuros_tabla]
+            # Las particiones se concatenan en orden de clave para que la marca de agua siga siendo válida
+            resultado[tabla] = None if None in partes else [lote for parte in partes for lote in parte]
+    return resultado
+
+def get_watermarks(conn_almacen):
+    """Lee las marcas de agua persistidas en la tabla de control del almacén."""
+    cursor = conn_almacen.cursor()
+    try:
+        cursor.execute("SELECT tabla_origen, marca_agua FROM etl_control")
+        return {row[0]: row[1] for row in cursor.fetchall()}
+    except mysql.connector.Error as err:
+        print(f"Error al leer marcas de agua: {err}")
+        return None
+    finally:
+        cursor.close()
+
+def save_watermarks(conn_almacen, marcas_agua):
+    """Persiste las nuevas marcas de agua por tabla de origen."""
+    cursor = conn_almacen.cursor()
+    try:
+        cursor.executemany(
+            "INSERT INTO etl_control (tabla_origen, marca_agua) VALUES (%s, %s) ON DUPLICATE KEY UPDATE marca_agua = VALUES(marca_agua)",
+            list(marcas_agua.items())
+        )
+        conn_almacen.commit()
+        print(f"Marcas de agua actualizadas: {marcas_agua}")
+    except mysql.connector.Error as err:
+        conn_almacen.rollback()
+        print(f"Error al guardar marcas de agua: {err}")
+    finally:
+        cursor.close()
+
+# Puntos de control de run_etl_process en etl_control: 'checkpoint_carga' identifica el tipo de ejecución en curso
+# y 'checkpoint_{tabla_origen}' la última clave primaria cargada (todos los lotes anteriores confirmados)
+PREFIJO_PUNTO_CONTROL = 'checkpoint_'
+TIPOS_CARGA = {'completa': 1, 'sombra': 2, 'incremental': 3}
+
+def get_checkpoints(marcas_control):
+    """Extrae los puntos de control de las filas de etl_control leídas con get_watermarks."""
+    return {clave[len(PREFIJO_PUNTO_CONTROL):]: valor for clave, valor in marcas_control.items() if clave.startswith(PREFIJO_PUNTO_CONTROL)}
+
+def save_checkpoint(conn_almacen, clave, valor):
+    """Guarda un punto de control. Un error no detiene la carga: a lo sumo se repite más trabajo al reanudar."""
+    cursor = conn_almacen.cursor()
+    try:
+        cursor.execute(
+            "INSERT INTO etl_control (tabla_origen, marca_agua) VALUES (%s, %s) ON DUPLICATE KEY UPDATE marca_agua = VALUES(marca_agua)",
+            (PREFIJO_PUNTO_CONTROL + clave, valor)
+        )
+        conn_almacen.commit()
+    except mysql.connector.Error as err:
+        conn_almacen.rollback()
+        print(f"Error al guardar el punto de control {clave}: {err}")
+    finally:
+        cursor.close()
+
+def clear_checkpoints(conn_almacen):
+    """Elimina los puntos de control al terminar una ejecución con éxito."""
+    cursor = conn_almacen.cursor()
+    try:
+        cursor.execute("DELETE FROM etl_control WHERE tabla_origen LIKE %s", (PREFIJO_PUNTO_CONTROL + '%',))
+        conn_almacen.commit()
+    except mysql.connector.Error as err:
+        conn_almacen.rollback()
+        print(f"Error al eliminar los puntos de control: {err}")
     finally:
         cursor.close()
 
 def truncate_warehouse_tables(conn_almacen):
     """Truncar tablas del almacén para una carga limpia (Full Load)."""
+    global _especialidad_sin_asignar_cargada
     cursor = conn_almacen.cursor()
     try:
         print("Truncando tablas del almacén para una carga limpia...")
         cursor.execute("SET FOREIGN_KEY_CHECKS = 0;") # Deshabilitar FKs temporalmente
+        for tabla in TABLAS_AGREGADOS:
+            cursor.execute(f"TRUNCATE TABLE {tabla};")
         cursor.execute("TRUNCATE TABLE citas_hechos;")
-        cursor.execute("TRUNCATE TABLE dim_tiempo;")
+        if not ETL_GRANO_TIEMPO:
+            cursor.execute("TRUNCATE TABLE dim_tiempo;") # El calendario precalculado se conserva entre cargas completas
         cursor.execute("TRUNCATE TABLE dim_medicos;")
         cursor.execute("TRUNCATE TABLE dim_pacientes;")
         cursor.execute("TRUNCATE TABLE dim_especialidades;")
+        # Reiniciar marcas de agua de la carga incremental (la cobertura del calendario se conserva con dim_tiempo)
+        cursor.execute("DELETE FROM etl_control WHERE tabla_origen NOT LIKE 'dim_tiempo%';")
         cursor.execute("SET FOREIGN_KEY_CHECKS = 1;") # Habilitar FKs
         conn_almacen.commit()
+        _especialidad_sin_asignar_cargada = False # TRUNCATE también elimina la especialidad reservada
         print("Tablas del almacén truncadas exitosamente.")
+        return True
     except mysql.connector.Error as err:
         conn_almacen.rollback()
         print(f"Error al truncar tablas del almacén: {err}")
+        return False
     finally:
         cursor.close()
 
-def load_dim_especialidades(conn_almacen, especialidades_origen):
-    """Carga y transforma datos para dim_especialidades."""
+# Clave de cita a partir de la cual las citas que se cargan en esta ejecución no tienen aún ninguna fila en citas_hechos,
+# así que no hace falta buscar ni borrar sus versiones anteriores: 0 si está recién vaciada (o es una tabla sombra), la
+# marca de agua de Citas en una incremental (solo se extraen citas posteriores), o None si cualquier cita puede tener
+# ya una fila, quizá con otra fecha si se reprogramó (CDC, reanudación)
+_citas_nuevas_desde = None
+
+def _citas_preexistentes(filas):
+    """Filas de citas_hechos cuya cita puede tener ya una versión en el almacén (ver _citas_nuevas_desde)."""
+    if _citas_nuevas_desde is None:
+        return filas
+    return [fila for fila in filas if int(fila[0]) <= _citas_nuevas_desde]
+
+# Tabla física en la que se escribe cada tabla del almacén (las tablas sombra durante una carga con ETL_CARGA_SOMBRA)
+_tablas_destino = {}
+
+def nombre_fisico(table_name):
+    """Retorna la tabla en la que se escriben realmente las filas de table_name."""
+    return _tablas_destino.get(table_name, table_name)
+
+def _tablas_sombra():
+    """Tablas del almacén que se recargan en tablas sombra (el calendario precalculado se conserva y no se copia)."""
+    return [tabla for tabla in TABLAS_ALMACEN if not (tabla == 'dim_tiempo' and ETL_GRANO_TIEMPO)]
+
+def create_shadow_tables(conn_almacen):
+    """Crea tablas sombra vacías ({tabla}_nueva) sin índices secundarios ni FKs y dirige las cargas hacia ellas.
+
+    Retorna True si se crearon. Las tablas publicadas no se modifican hasta swap_shadow_tables.
+    """
     cursor = conn_almacen.cursor()
-    print("Cargando dim_especialidades...")
     try:
-        for esp in especialidades_origen:
-            # Transforma y asegura que los IDs sean VARCHAR(250)
-            id_especialidad_sk = str(esp['EspecialidadID'])
-            id_especialidad_bk = str(esp['EspecialidadID']) # id_especialidad como Business Key
+        print("Creando tablas sombra para la carga completa...")
+        for tabla in _tablas_sombra():
+            sombra = f"{tabla}_nueva"
+            # Restos de una carga anterior interrumpida
+            cursor.execute(f"DROP TABLE IF EXISTS {sombra}, {tabla}_antigua;")
+            cursor.execute(f"CREATE TABLE {sombra} LIKE {tabla};") # Copia columnas, PK e índices, pero no las FKs
+            if tabla in INDICES_DIFERIDOS:
+                cursor.execute(f"ALTER TABLE {sombra} " + ", ".join(f"DROP INDEX {indice}" for indice in INDICES_DIFERIDOS[tabla]))
+            _tablas_destino[tabla] = sombra
+        print("Tablas sombra creadas exitosamente.")
+        return True
+    except mysql.connector.Error as err:
+        _tablas_destino.clear()
+        print(f"Error al crear tablas sombra: {err}")
+        return False
+    finally:
+        cursor.close()
 
-            cursor.execute(
-                "INSERT IGNORE INTO dim_especialidades (id_especialidad_sk, id_especialidad, nombre_especialidad, fecha_carga) VALUES (%s, %s, %s, CURRENT_TIMESTAMP)",
-                (id_especialidad_sk, id_especialidad_bk, esp['NombreEspecialidad'])
-            )
+def resume_shadow_tables(conn_almacen):
+    """Vuelve a dirigir las cargas a las tablas sombra de una ejecución interrumpida. Retorna True si existen todas."""
+    tablas = _tablas_sombra()
+    cursor = conn_almacen.cursor()
+    try:
+        cursor.execute(
+            f"SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({', '.join(['%s'] * len(tablas))})",
+            [f"{tabla}_nueva" for tabla in tablas]
+        )
+        if cursor.fetchone()[0] != len(tablas):
+            return False
+    except mysql.connector.Error as err:
+        print(f"Error al buscar las tablas sombra: {err}")
+        return False
+    finally:
+        cursor.close()
+    for tabla in tablas:
+        _tablas_destino[tabla] = f"{tabla}_nueva"
+    return True
+
+def swap_shadow_tables(conn_almacen):
+    """Publica las tablas sombra: crea sus índices, las intercambia atómicamente con RENAME TABLE y restaura las FKs.
+
+    Las FKs se añaden con FOREIGN_KEY_CHECKS = 0 (sin revalidar las tablas): el ETL solo escribe claves
+    sustitutas resueltas contra las dimensiones cargadas. Retorna True si el intercambio se completó.
+    """
+    tablas = _tablas_sombra()
+    cursor = conn_almacen.cursor()
+    try:
+        print("Creando índices de las tablas sombra...")
+        for tabla in tablas:
+            if tabla in INDICES_DIFERIDOS:
+                cursor.execute(f"ALTER TABLE {tabla}_nueva " + ", ".join(
+                    f"ADD KEY {indice} {columnas}" for indice, columnas in INDICES_DIFERIDOS[tabla].items()))
+
+        # Un único RENAME TABLE es atómico: las consultas ven las tablas anteriores o las nuevas, nunca una mezcla
+        cursor.execute("RENAME TABLE " + ", ".join(
+            f"{tabla} TO {tabla}_antigua, {tabla}_nueva TO {tabla}" for tabla in tablas))
+        _tablas_destino.clear()
+        print("Tablas sombra publicadas.")
+
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 0;")
+        # Las FKs de las tablas anteriores siguen a las tablas renombradas, así que se eliminan con ellas
+        cursor.execute("DROP TABLE IF EXISTS " + ", ".join(f"{tabla}_antigua" for tabla in reversed(tablas)) + ";")
+        for tabla in tablas:
+            if tabla in CLAVES_FORANEAS:
+                cursor.execute(f"ALTER TABLE {tabla} " + ", ".join(
+                    f"ADD CONSTRAINT {nombre} FOREIGN KEY ({columna}) REFERENCES {referida} ({columna_referida})"
+                    for nombre, (columna, referida, columna_referida) in CLAVES_FORANEAS[tabla].items()))
+        # Reiniciar marcas de agua de la carga incremental, como al truncar
+        cursor.execute("DELETE FROM etl_control WHERE tabla_origen NOT LIKE 'dim_tiempo%';")
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 1;")
         conn_almacen.commit()
-        print(f"Cargadas {cursor.rowcount} filas en dim_especialidades.")
+        return True
     except mysql.connector.Error as err:
         conn_almacen.rollback()
-        print(f"Error al cargar dim_especialidades: {err}")
+        print(f"Error al publicar las tablas sombra: {err}")
+        return False
     finally:
         cursor.close()
 
-def load_dim_pacientes(conn_almacen, pacientes_origen):
-    """Carga y transforma datos para dim_pacientes."""
+# Tablas en las que el servidor o el cliente no permiten LOAD DATA LOCAL INFILE (no se reintenta en cada lote)
+_tablas_sin_carga_masiva = set()
+# Errores de LOAD DATA LOCAL INFILE que indican que no está disponible (y no un problema de los datos del lote):
+# comando no permitido (1148), falta de privilegios (1227), desactivado en el servidor (3948) o en el cliente (2068)
+ERRORES_SIN_CARGA_MASIVA = (1148, 1227, 2068, 3948)
+
+def report_bulk_load_fallbacks():
+    """Informa una vez qué tablas de ETL_CARGA_MASIVA se cargan de todas formas con INSERT, y por qué."""
+    motivos = {tabla: "dimensión SCD tipo 2: cierre y nueva versión se escriben con INSERT en una transacción"
+               for tabla in ('dim_pacientes', 'dim_medicos')}
+    if TABLAS_AGREGADOS:
+        motivos['citas_hechos'] = "con ETL_AGREGADOS, hechos y agregados se escriben con INSERT en una transacción"
+    for tabla in sorted(ETL_CARGA_MASIVA):
+        motivo = motivos.get(tabla) or (None if tabla in TABLAS_ALMACEN else "no es una tabla del almacén")
+        if motivo:
+            print(f"ETL_CARGA_MASIVA: {tabla} no usará LOAD DATA LOCAL INFILE ({motivo}).")
+
+def load_rows_infile(conn_almacen, table_name, columns, rows, replace=False):
+    """Carga filas con LOAD DATA LOCAL INFILE a través de un archivo TSV temporal.
+
+    Con replace las filas existentes se reemplazan (REPLACE); si no, los duplicados se ignoran (IGNORE).
+    Retorna el número de filas cargadas, o None si el servidor rechazó la carga. Solo si LOAD DATA no está
+    disponible (ERRORES_SIN_CARGA_MASIVA) se deja de usar en la tabla; con otros errores se reintenta en el lote siguiente.
+    """
+    archivo = tempfile.NamedTemporaryFile('w', suffix='.tsv', encoding='utf-8', newline='\n', delete=False)
+    cursor = conn_almacen.cursor()
+    try:
+        with archivo:
+            for fila in rows:
+                archivo.write(fila_tsv(fila))
+        cursor.execute(
+            f"LOAD DATA LOCAL INFILE %s {'REPLACE' if replace else 'IGNORE'} INTO TABLE {nombre_fisico(table_name)} "
+            "CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+            f"({', '.join(columns)}) SET fecha_carga = CURRENT_TIMESTAMP",
+            (archivo.name,)
+        )
+        conn_almacen.commit()
+        # REPLACE cuenta 2 por fila reemplazada, así que se cuentan las filas enviadas
+        return len(rows) if replace else cursor.rowcount
+    except mysql.connector.Error as err:
+        conn_almacen.rollback()
+        if err.errno in ERRORES_SIN_CARGA_MASIVA:
+            print(f"LOAD DATA LOCAL INFILE no disponible para {table_name}: {err}. Se usarán INSERT por lotes.")
+            _tablas_sin_carga_masiva.add(table_name)
+        else:
+            print(f"Error de LOAD DATA LOCAL INFILE en {table_name}: {err}. Este lote se cargará con INSERT por lotes.")
+        return None
+    finally:
+        cursor.close()
+        os.remove(archivo.name)
+
+def build_insert_sql(table_name, columns, num_filas, update_columns=None, ignore=False):
+    """Genera un INSERT multi-fila para num_filas filas, con fecha_carga = CURRENT_TIMESTAMP."""
+    fila_sql = "(" + ", ".join(["%s"] * len(columns)) + ", CURRENT_TIMESTAMP)"
+    sql = f"INSERT {'IGNORE ' if ignore else ''}INTO {nombre_fisico(table_name)} ({', '.join(columns)}, fecha_carga) VALUES " + ", ".join([fila_sql] * num_filas)
+    if update_columns:
+        sql += " ON DUPLICATE KEY UPDATE " + ", ".join(f"{col} = VALUES({col})" for col in update_columns) + ", fecha_carga = CURRENT_TIMESTAMP"
+    return sql
+
+def load_rows(conn_almacen, table_name, columns, rows, update_columns=None, ignore=False, batch_size=None):
+    """Carga filas en una tabla del almacén con sentencias INSERT multi-fila, confirmando cada lote.
+
+    fecha_carga se fija siempre a CURRENT_TIMESTAMP. Con update_columns se genera un upsert
+    (ON DUPLICATE KEY UPDATE) y con ignore un INSERT IGNORE. Retorna el número de filas cargadas
+    (en INSERT IGNORE, solo las nuevas), o None si algún lote falló; los lotes previos quedan confirmados.
+    Las tablas listadas en ETL_CARGA_MASIVA se cargan primero con LOAD DATA LOCAL INFILE.
+    """
+    if table_name in ETL_CARGA_MASIVA and table_name not in _tablas_sin_carga_masiva:
+        cargadas = load_rows_infile(conn_almacen, table_name, columns, rows, replace=bool(update_columns))
+        if cargadas is not None:
+            return cargadas
+
+    batch_size = batch_size or ETL_TAMANO_LOTE_CARGA
+    cursor = conn_almacen.cursor()
+    cargadas = 0
+    try:
+        for inicio in range(0, len(rows), batch_size):
+            lote = rows[inicio:inicio + batch_size]
+            params = [valor for fila in lote for valor in fila]
+            for intento in range(ETL_REINTENTOS + 1):
+                try:
+                    cursor.execute(build_insert_sql(table_name, columns, len(lote), update_columns, ignore), params)
+                    conn_almacen.commit()
+                    break
+                except mysql.connector.Error as err:
+                    # Deadlocks y esperas de bloqueo (frecuentes con cargas paralelas) se reintentan sobre la misma conexión
+                    if intento < ETL_REINTENTOS and err.errno in (1205, 1213):
+                        conn_almacen.rollback()
+                        wait_before_retry(intento)
+                        continue
+                    raise
+            # Con ON DUPLICATE KEY UPDATE rowcount cuenta 2 por fila actualizada, así que se cuentan las filas enviadas
+            cargadas += cursor.rowcount if ignore else len(lote)
+        return cargadas
+    except mysql.connector.Error as err:
+        conn_almacen.rollback()
+        print(f"Error al cargar {table_name} (después de {cargadas} filas confirmadas): {err}")
+        return None
+    finally:
+        cursor.close()
+
+@instrumentado
+def load_dim_especialidades(conn_almacen, especialidades_origen):
+    """Carga y transforma datos para dim_especialidades."""
+    print("Cargando dim_especialidades...")
+    rows_to_insert = []
+    for especialidad_id, nombre_especialidad in especialidades_origen:
+        # Transforma los IDs al tipo de clave del almacén (VARCHAR(250), o INT en el esquema compacto)
+        id_especialidad_sk = sql_key(especialidad_id)
+        id_especialidad_bk = sql_key(especialidad_id) # id_especialidad como Business Key
+        rows_to_insert.append((id_especialidad_sk, id_especialidad_bk, nombre_especialidad))
+
+    cargadas = load_rows(
+        conn_almacen, 'dim_especialidades',
+        ('id_especialidad_sk', 'id_especialidad', 'nombre_especialidad'),
+        rows_to_insert, update_columns=('nombre_especialidad',)
+    )
+    if cargadas is not None:
+        export_parquet('dim_especialidades', ('id_especialidad_sk', 'id_especialidad', 'nombre_especialidad'), rows_to_insert)
+        print(f"Cargadas {cargadas} filas en dim_especialidades.")
+    return cargadas
+
+def content_hash(valores):
+    """Hash MD5 del contenido de una fila de dimensión, para detectar cambios sin comparar columna a columna."""
+    return hashlib.md5("\x1f".join("\\N" if valor is None else str(valor) for valor in valores).encode('utf-8')).hexdigest()
+
+def _rows_with_resolved_fks(cursor, table_name, columnas, candidatas):
+    """Descarta (e informa) las filas candidatas (bk, atributos, ...) cuyas FKs de CLAVES_FORANEAS no existen en la
+    tabla referida, para que una sola fila no haga fallar (y revertir) el lote completo. NULL no se comprueba.
+    """
+    for nombre, (columna, referida, columna_referida) in CLAVES_FORANEAS.get(table_name, {}).items():
+        posicion = columnas.index(columna)
+        valores = list({fila[1][posicion] for fila in candidatas if fila[1][posicion] is not None})
+        existentes = set()
+        for inicio in range(0, len(valores), ETL_TAMANO_LOTE_CARGA):
+            parte = valores[inicio:inicio + ETL_TAMANO_LOTE_CARGA]
+            cursor.execute(
+                f"SELECT {columna_referida} FROM {nombre_fisico(referida)} "
+                f"WHERE {columna_referida} IN ({', '.join(['%s'] * len(parte))})", parte)
+            existentes.update(str(valor) for valor, in cursor.fetchall())
+        omitidas = [fila for fila in candidatas if fila[1][posicion] is not None and str(fila[1][posicion]) not in existentes]
+        if omitidas:
+            ejemplos = ", ".join(f"{fila[0]} ({columna}={fila[1][posicion]})" for fila in omitidas[:5])
+            print(f"Advertencia: se omiten {len(omitidas)} filas de {table_name} cuyo {columna} no existe en {referida} "
+                  f"({nombre}), p. ej. {ejemplos}.")
+            omitidas = {id(fila) for fila in omitidas}
+            candidatas = [fila for fila in candidatas if id(fila) not in omitidas]
+    return candidatas
+
+def merge_dim_scd2(conn_almacen, table_name, sk_col, bk_col, columnas, filas):
+    """Fusiona filas (clave_negocio, *atributos) en una dimensión SCD tipo 2 usando un hash del contenido.
+
+    Solo se escriben las filas nuevas o cambiadas: una fila cambiada cierra su versión actual (valido_hasta,
+    es_actual = 0) e inserta la siguiente versión, con SK = (version - 1) * FACTOR_VERSION_SK + clave de negocio.
+    Cierre e inserción van en la misma transacción. Las filas con FKs sin correspondencia se omiten con una advertencia.
+    Actualiza SK_CACHE con las versiones actuales. Retorna el número de filas escritas, o None si hubo error.
+    """
+    cache = SK_CACHE[table_name]
+    tabla = nombre_fisico(table_name)
+    filas_hash = [(fila[0], fila[1:], content_hash(fila[1:])) for fila in filas]
+    # Con la caché completa (p. ej. tras truncar), una clave que no está en ella es nueva y no hace falta consultarla
+    consultar = [bk for bk, _, _ in filas_hash if not cache.completa or cache.get(bk) is not None]
+
     cursor = conn_almacen.cursor()
-    print("Cargando dim_pacientes...")
     try:
-        for pac in pacientes_origen:
-            # Transforma y asegura que los IDs sean VARCHAR(250)
-            id_paciente_sk = str(pac['PacienteID'])
-            id_paciente_bk = str(pac['PacienteID']) # id_paciente como Business Key
+        actuales = {}
+        for inicio in range(0, len(consultar), ETL_TAMANO_LOTE_CARGA):
+            parte = [sql_key(bk) for bk in consultar[inicio:inicio + ETL_TAMANO_LOTE_CARGA]]
+            cursor.execute(
+                f"SELECT {bk_col}, {sk_col}, version, hash_contenido FROM {tabla} "
+                f"WHERE es_actual = 1 AND {bk_col} IN ({', '.join(['%s'] * len(parte))})", parte
+            )
+            actuales.update({int(bk): (int(sk), version, hash_contenido) for bk, sk, version, hash_contenido in cursor.fetchall()})
+
+        ahora = datetime.now().replace(microsecond=0)
+        nuevas, cerrar, pares_cache, candidatas = [], [], [], []
+        for bk, atributos, hash_fila in filas_hash:
+            actual = actuales.get(bk)
+            if actual and actual[2] == hash_fila:
+                pares_cache.append((bk, actual[0])) # Sin cambios: no se escribe nada
+            else:
+                candidatas.append((bk, atributos, hash_fila, actual))
+        candidatas = _rows_with_resolved_fks(cursor, table_name, columnas, candidatas)
+        for bk, atributos, hash_fila, actual in candidatas:
+            version = actual[1] + 1 if actual else 1
+            sk = (version - 1) * FACTOR_VERSION_SK + bk
+            if actual:
+                cerrar.append(sql_key(actual[0]))
+            nuevas.append((sql_key(sk), sql_key(bk)) + tuple(atributos) + (hash_fila, ahora, version))
+            pares_cache.append((bk, sk))
 
+        for inicio in range(0, len(cerrar), ETL_TAMANO_LOTE_CARGA):
+            parte = cerrar[inicio:inicio + ETL_TAMANO_LOTE_CARGA]
             cursor.execute(
-                "INSERT IGNORE INTO dim_pacientes (id_paciente_sk, id_paciente, apellido, direccion, fecha_nacimiento, genero, nombre, telefono, fecha_carga) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)",
-                (id_paciente_sk, id_paciente_bk, pac['Apellido'], pac['Direccion'], pac['FechaNacimiento'],
-                 pac['Genero'], pac['Nombre'], pac['Telefono'])
+                f"UPDATE {tabla} SET es_actual = 0, valido_hasta = %s WHERE {sk_col} IN ({', '.join(['%s'] * len(parte))})",
+                [ahora] + parte
             )
+        columnas_insert = (sk_col, bk_col) + columnas + ('hash_contenido', 'valido_desde', 'version')
+        for inicio in range(0, len(nuevas), ETL_TAMANO_LOTE_CARGA):
+            parte = nuevas[inicio:inicio + ETL_TAMANO_LOTE_CARGA]
+            cursor.execute(build_insert_sql(table_name, columnas_insert, len(parte)), [valor for fila in parte for valor in fila])
         conn_almacen.commit()
-        print(f"Cargadas {cursor.rowcount} filas en dim_pacientes.")
+        cache.add_many(pares_cache)
+        # Solo las versiones nuevas: la versión vigente de cada clave es la de mayor version
+        export_parquet(table_name, columnas_insert, nuevas)
+        print(f"{table_name}: {len(nuevas) - len(cerrar)} filas nuevas, {len(cerrar)} versiones nuevas por cambios, "
+              f"{len(filas_hash) - len(pares_cache)} omitidas, {len(pares_cache) - len(nuevas)} sin cambios.")
+        return len(nuevas)
     except mysql.connector.Error as err:
         conn_almacen.rollback()
-        print(f"Error al cargar dim_pacientes: {err}")
+        print(f"Error al fusionar {table_name}: {err}")
+        return None
     finally:
         cursor.close()
 
+@instrumentado
+def load_dim_pacientes(conn_almacen, pacientes_origen):
+    """Carga y transforma datos para dim_pacientes (SCD tipo 2: solo se escriben pacientes nuevos o cambiados)."""
+    print("Cargando dim_pacientes...")
+    cargadas = merge_dim_scd2(
+        conn_almacen, 'dim_pacientes', 'id_paciente_sk', 'id_paciente',
+        ('apellido', 'direccion', 'fecha_nacimiento', 'genero', 'nombre', 'telefono'),
+        pacientes_origen # Las tuplas ya vienen como (PacienteID, Apellido, Direccion, FechaNacimiento, Genero, Nombre, Telefono)
+    )
+    if cargadas is not None:
+        print(f"Cargadas {cargadas} filas en dim_pacientes.")
+    return cargadas
+
+# Especialidad reservada para los médicos con EspecialidadID NULL en el origen (los IDs del origen empiezan en 1).
+# Ambos esquemas la siembran; se vuelve a asegurar tras truncar, ya que dim_medicos.id_especialidad es NOT NULL.
+ESPECIALIDAD_SIN_ASIGNAR = (0, 'Sin especialidad')
+_especialidad_sin_asignar_cargada = False
+
+def ensure_especialidad_sin_asignar(conn_almacen):
+    """Inserta (o actualiza) la especialidad reservada ESPECIALIDAD_SIN_ASIGNAR. Retorna False si hubo error."""
+    global _especialidad_sin_asignar_cargada
+    if _especialidad_sin_asignar_cargada:
+        return True
+    especialidad_id, nombre_especialidad = ESPECIALIDAD_SIN_ASIGNAR
+    fila = (sql_key(especialidad_id), sql_key(especialidad_id), nombre_especialidad)
+    columnas = ('id_especialidad_sk', 'id_especialidad', 'nombre_especialidad')
+    if load_rows(conn_almacen, 'dim_especialidades', columnas, [fila], update_columns=('nombre_especialidad',)) is None:
+        return False
+    export_parquet('dim_especialidades', columnas, [fila])
+    _especialidad_sin_asignar_cargada = True
+    return True
+
+@instrumentado
 def load_dim_medicos(conn_almacen, medicos_origen):
-    """Carga y transforma datos para dim_medicos."""
-    cursor = conn_almacen.cursor()
+    """Carga y transforma datos para dim_medicos (SCD tipo 2: solo se escriben médicos nuevos o cambiados).
+
+    Los médicos sin especialidad en el origen se asignan a ESPECIALIDAD_SIN_ASIGNAR.
+    """
     print("Cargando dim_medicos...")
+    rows_to_merge = []
+    sin_especialidad = 0
+    for medico_id, especialidad_id, codigo_empleado, nombre, apellido, genero in medicos_origen:
+        if especialidad_id is None:
+            especialidad_id = ESPECIALIDAD_SIN_ASIGNAR[0]
+            sin_especialidad += 1
+        id_especialidad_bk = sql_key(especialidad_id) # Clave de negocio de especialidad como VARCHAR(250) (INT en el esquema compacto)
+        rows_to_merge.append((medico_id, id_especialidad_bk, codigo_empleado, nombre, apellido, genero))
+    if sin_especialidad:
+        print(f"Advertencia: {sin_especialidad} médicos sin especialidad en el origen; se asignan a "
+              f"'{ESPECIALIDAD_SIN_ASIGNAR[1]}' (id {ESPECIALIDAD_SIN_ASIGNAR[0]}).")
+        if not ensure_especialidad_sin_asignar(conn_almacen):
+            return None
+
+    cargadas = merge_dim_scd2(
+        conn_almacen, 'dim_medicos', 'id_medico_sk', 'id_medico',
+        ('id_especialidad', 'codigo_empleado', 'nombre', 'apellido', 'genero'),
+        rows_to_merge
+    )
+    if cargadas is not None:
+        print(f"Cargadas {cargadas} filas en dim_medicos.")
+    return cargadas
+
+COLUMNAS_DIM_TIEMPO = ('id_tiempo_sk', 'fecha', 'anio', 'mes', 'dia', 'hora', 'minuto', 'segundo', 'nombre_mes', 'dia_semana')
+
+def time_components(instantes):
+    """Descompone un array datetime64[s] en (dias, anio, mes, dia, hora, minuto, segundo) de forma vectorizada."""
+    dias = instantes.astype('datetime64[D]')
+    meses = instantes.astype('datetime64[M]')
+    anio = instantes.astype('datetime64[Y]').astype(np.int64) + 1970
+    mes = meses.astype(np.int64) % 12 + 1
+    dia = (dias - meses.astype('datetime64[D]')).astype(np.int64) + 1
+    segundos_dia = (instantes - dias).astype(np.int64)
+    return dias, anio, mes, dia, segundos_dia // 3600, segundos_dia % 3600 // 60, segundos_dia % 60
+
+def time_keys(instantes):
+    """Calcula id_tiempo_sk (YYYYMMDDHHMMSS como entero) de un array datetime64[s]."""
+    _, anio, mes, dia, hora, minuto, segundo = time_components(instantes)
+    return anio * 10**10 + mes * 10**8 + dia * 10**6 + hora * 10**4 + minuto * 100 + segundo
+
+def build_time_rows(instantes):
+    """Construye con NumPy las filas de dim_tiempo (en el orden de COLUMNAS_DIM_TIEMPO) de un array datetime64[s]."""
+    dias, anio, mes, dia, hora, minuto, segundo = time_components(instantes)
+    id_tiempo_sk = anio * 10**10 + mes * 10**8 + dia * 10**6 + hora * 10**4 + minuto * 100 + segundo
+    # Mismos nombres que strftime('%B') y strftime('%A'); 1970-01-01 fue jueves (lunes = 0)
+    nombre_mes = np.array(calendar.month_name)[mes]
+    dia_semana = np.array(calendar.day_name)[(dias.astype(np.int64) + 3) % 7]
+    return list(zip(
+        sql_keys(id_tiempo_sk), dias.astype(object).tolist(), anio.tolist(), mes.tolist(), dia.tolist(),
+        hora.tolist(), minuto.tolist(), segundo.tolist(), nombre_mes.tolist(), dia_semana.tolist()
+    ))
+
+def build_calendar_rows(desde, hasta, grano):
+    """Construye las filas de dim_tiempo de [desde, hasta] (fechas inclusive) al grano indicado."""
+    instantes = np.arange(np.datetime64(desde, 's'), np.datetime64(hasta + timedelta(days=1), 's'),
+                          np.timedelta64(SEGUNDOS_POR_GRANO[grano], 's'))
+    return build_time_rows(instantes)
+
+def _hora_a_segundos(cita_id, hora_cita_raw):
+    """Convierte HoraCita (timedelta, time o 'HH:MM:SS') a segundos del día. Retorna None si no es convertible."""
+    if isinstance(hora_cita_raw, timedelta):
+        return hora_cita_raw.seconds
+    if isinstance(hora_cita_raw, time):
+        return hora_cita_raw.hour * 3600 + hora_cita_raw.minute * 60 + hora_cita_raw.second
+    print(f"Advertencia: Tipo de HoraCita inesperado para cita {cita_id}: {type(hora_cita_raw)}. Se espera datetime.time o timedelta.")
+    if isinstance(hora_cita_raw, str):
+        try:
+            # Si viene como string 'HH:MM:SS', se puede parsear
+            hora = datetime.strptime(hora_cita_raw, '%H:%M:%S')
+            return hora.hour * 3600 + hora.minute * 60 + hora.second
+        except ValueError as ve:
+            print(f"Error al parsear HoraCita string para cita {cita_id}: {ve}. Saltando fila.")
+            return None
+    print(f"Error: HoraCita no convertible para cita {cita_id}. Saltando fila.")
+    return None
+
+# Lote de citas transformado a columnas (arrays NumPy), compartido por load_dim_tiempo y load_citas_hechos
+LoteCitas = namedtuple('LoteCitas', 'cita_id paciente_id medico_id fecha_hora id_tiempo_sk estado motivo')
+
+def transform_citas_batch(citas_origen):
+    """Transforma un lote de citas (tuplas de extract_data) a columnas, calculando fecha_hora e id_tiempo_sk una sola vez.
+
+    id_tiempo_sk se trunca al grano del calendario si ETL_GRANO_TIEMPO está activo. Las citas con HoraCita no
+    convertible se descartan.
+    """
+    if isinstance(citas_origen, LoteCitas): # Ya transformado (p. ej. leído de un snapshot con transform_citas_arrow)
+        return citas_origen
+    if not citas_origen:
+        vacio = np.array([], dtype=np.int64)
+        return LoteCitas(vacio, vacio, vacio, np.array([], dtype='datetime64[s]'), vacio, np.array([], dtype=object), np.array([], dtype=object))
+    cita_id, paciente_id, medico_id, fecha_cita, hora_cita, estado, motivo = zip(*citas_origen)
     try:
-        for med in medicos_origen:
-            # Transforma y asegura que los IDs sean VARCHAR(250)
-            id_medico_sk = str(med['MedicoID'])
-            id_medico_bk = str(med['MedicoID']) # id_medico como Business Key
-            id_especialidad_bk = str(med['EspecialidadID']) # Clave de negocio de especialidad
+        # Camino rápido: MySQL devuelve TIME como timedelta, que NumPy convierte sin recorrer en Python
+        horas = np.array(hora_cita, dtype='timedelta64[s]')
+        # None se convierte en NaT en lugar de fallar: esas citas se descartan, como en el camino lento
+        validas = ~np.isnat(horas)
+        for i in np.flatnonzero(~validas):
+            _hora_a_segundos(cita_id[i], hora_cita[i])
+        segundos = np.where(validas, horas.astype(np.int64), 0) % 86400
+    except (TypeError, ValueError):
+        convertidas = [_hora_a_segundos(cid, hora) for cid, hora in zip(cita_id, hora_cita)]
+        validas = np.array([seg is not None for seg in convertidas])
+        segundos = np.array([seg or 0 for seg in convertidas], dtype=np.int64)
+
+    return _build_lote_citas(
+        np.array(cita_id, dtype=np.int64), np.array(paciente_id, dtype=np.int64), np.array(medico_id, dtype=np.int64),
+        np.array(fecha_cita, dtype='datetime64[D]'), segundos, np.array(estado, dtype=object), np.array(motivo, dtype=object),
+        validas
+    )
+
+def transform_citas_arrow(lote):
+    """Versión de transform_citas_batch para un lote de un snapshot (RecordBatch de Arrow con las columnas de Citas).
+
+    Las columnas pasan a NumPy de forma vectorizada, sin convertirse en tuplas de Python; las claves, sin copiarse.
+    """
+    cita_id, paciente_id, medico_id, fecha_cita, hora_cita, estado, motivo = lote.columns
+    horas = hora_cita.to_numpy(zero_copy_only=False).astype('timedelta64[s]')
+    validas = ~np.isnat(horas)
+    segundos = np.where(validas, horas.astype(np.int64), 0) % 86400
+    return _build_lote_citas(
+        cita_id.to_numpy(), paciente_id.to_numpy(), medico_id.to_numpy(), fecha_cita.to_numpy(zero_copy_only=False), segundos,
+        estado.to_numpy(zero_copy_only=False), motivo.to_numpy(zero_copy_only=False), validas
+    )
+
+def _build_lote_citas(cita_id, paciente_id, medico_id, fechas, segundos, estado, motivo, validas=None):
+    """Arma un LoteCitas a partir de columnas NumPy (fechas datetime64[D], segundos desde medianoche) y las filas validas."""
+    # Combinar fecha y hora para una marca de tiempo completa
+    fecha_hora = fechas.astype('datetime64[s]') + segundos.astype('timedelta64[s]')
+    instantes_clave = fecha_hora
+    if ETL_GRANO_TIEMPO:
+        paso = SEGUNDOS_POR_GRANO[ETL_GRANO_TIEMPO]
+        instantes_clave = fecha_hora - (segundos % paso).astype('timedelta64[s]')
+    lote = LoteCitas(cita_id, paciente_id, medico_id, fecha_hora, time_keys(instantes_clave), estado, motivo)
+    if validas is not None and not validas.all():
+        lote = LoteCitas(*(columna[validas] for columna in lote))
+    return lote
+
+# Rango de fechas [desde, hasta] ya presente en dim_tiempo por grano (se lee de etl_control una vez por ejecución)
+_cobertura_calendario = {}
+
+def ensure_calendar(conn_almacen, fecha_min, fecha_max):
+    """Extiende el calendario precalculado de dim_tiempo para que cubra [fecha_min, fecha_max].
+
+    Solo genera los días que faltan (por meses, para acotar la memoria) y registra la nueva cobertura en
+    etl_control. Retorna el número de filas cargadas, o None si hubo error.
+    """
+    grano = ETL_GRANO_TIEMPO
+    clave_desde, clave_hasta = f"dim_tiempo_{grano}_desde", f"dim_tiempo_{grano}_hasta"
+    if grano not in _cobertura_calendario:
+        marcas = get_watermarks(conn_almacen) or {}
+        if clave_desde in marcas and clave_hasta in marcas:
+            _cobertura_calendario[grano] = tuple(datetime.strptime(str(marcas[c]), '%Y%m%d').date() for c in (clave_desde, clave_hasta))
+        else:
+            _cobertura_calendario[grano] = None
+    cobertura = _cobertura_calendario[grano]
+    if cobertura and cobertura[0] <= fecha_min and fecha_max <= cobertura[1]:
+        return 0
+
+    fecha_min = fecha_min.replace(day=1) # Extender por meses completos hacia atrás para evitar extensiones pequeñas
+    nuevo_hasta = fecha_max + timedelta(days=ETL_HORIZONTE_CALENDARIO_DIAS)
+    if cobertura:
+        tramos = []
+        nueva_cobertura = list(cobertura)
+        if fecha_min < cobertura[0]:
+            tramos.append((fecha_min, cobertura[0] - timedelta(days=1)))
+            nueva_cobertura[0] = fecha_min
+        if fecha_max > cobertura[1]:
+            tramos.append((cobertura[1] + timedelta(days=1), nuevo_hasta))
+            nueva_cobertura[1] = nuevo_hasta
+    else:
+        tramos = [(fecha_min, nuevo_hasta)]
+        nueva_cobertura = (fecha_min, nuevo_hasta)
+
+    print(f"Extendiendo calendario de dim_tiempo (grano {grano}): {tramos}")
+    cargadas = 0
+    for desde, hasta in tramos:
+        while desde <= hasta:
+            fin_mes = min(hasta, date(desde.year + desde.month // 12, desde.month % 12 + 1, 1) - timedelta(days=1))
+            filas = build_calendar_rows(desde, fin_mes, grano)
+            resultado = load_rows(conn_almacen, 'dim_tiempo', COLUMNAS_DIM_TIEMPO, filas, ignore=True)
+            if resultado is None:
+                return None
+            export_parquet('dim_tiempo', COLUMNAS_DIM_TIEMPO, filas)
+            cargadas += resultado
+            desde = fin_mes + timedelta(days=1)
+
+    save_watermarks(conn_almacen, {
+        clave_desde: int(nueva_cobertura[0].strftime('%Y%m%d')),
+        clave_hasta: int(nueva_cobertura[1].strftime('%Y%m%d'))
+    })
+    _cobertura_calendario[grano] = nueva_cobertura
+    return cargadas
+
+@instrumentado
+def load_dim_tiempo(conn_almacen, citas):
+    """Carga dim_tiempo a partir de un lote de citas (LoteCitas, o tuplas de extract_data que se transforman aquí).
+
+    Con ETL_GRANO_TIEMPO solo se asegura que el calendario precalculado cubra las fechas del lote.
+    """
+    if not isinstance(citas, LoteCitas):
+        citas = transform_citas_batch(citas)
+    if ETL_GRANO_TIEMPO:
+        if not len(citas.fecha_hora):
+            return 0
+        fechas = citas.fecha_hora.astype('datetime64[D]')
+        return ensure_calendar(conn_almacen, fechas.min().astype(object), fechas.max().astype(object))
+
+    print("Cargando dim_tiempo...")
+    # Una fila por id_tiempo_sk distinto del lote
+    _, indices = np.unique(citas.id_tiempo_sk, return_index=True)
+    rows_to_insert = build_time_rows(citas.fecha_hora[indices])
+
+    if rows_to_insert:
+        cargadas = load_rows(conn_almacen, 'dim_tiempo', COLUMNAS_DIM_TIEMPO, rows_to_insert, ignore=True)
+        if cargadas is not None:
+            # Cada lote exporta sus instantes distintos; entre lotes puede haber claves repetidas
+            export_parquet('dim_tiempo', COLUMNAS_DIM_TIEMPO, rows_to_insert)
+            print(f"Cargadas {cargadas} filas únicas en dim_tiempo.")
+        return cargadas
+    else:
+        print("No hay nuevas entradas de tiempo para cargar.")
+        return 0
+
+
+class SurrogateKeyCache:
+    """Caché en memoria de clave de negocio (entera) -> clave sustituta de una dimensión.
+
+    Se guarda como un array('q') indexado por la clave de negocio (0 = ausente), mucho más compacto que un
+    dict de cadenas. Los cargadores de dimensiones lo llenan con lo que insertan; si la caché no está
+    completa (cargas incrementales), las claves que falten se buscan en el almacén bajo demanda.
+    """
 
+    def __init__(self, table_name, sk_col, bk_col):
+        self.table_name = table_name
+        self.sk_col = sk_col
+        self.bk_col = bk_col
+        self.claves = array('q')
+        self.completa = False # True cuando la caché refleja toda la dimensión (p. ej. tras truncar el almacén)
+        self._lock = threading.Lock()
+
+    def reset(self, completa):
+        with self._lock:
+            self.claves = array('q')
+            self.completa = completa
+
+    def add_many(self, pares):
+        """Registra pares (clave_negocio, clave_sustituta) enteros."""
+        with self._lock:
+            for bk, sk in pares:
+                if bk >= len(self.claves):
+                    nuevo_tamano = max(bk + 1, 2 * len(self.claves))
+                    self.claves.frombytes(bytes(self.claves.itemsize * (nuevo_tamano - len(self.claves))))
+                self.claves[bk] = sk
+
+    def get(self, bk):
+        """Retorna la clave sustituta de bk, o None si no está en la caché."""
+        if 0 <= bk < len(self.claves):
+            return self.claves[bk] or None
+        return None
+
+    def get_array(self, bks):
+        """Versión vectorizada de get: retorna un array con la clave sustituta de cada bk (0 si no está)."""
+        resultado = np.zeros(len(bks), dtype=np.int64)
+        with self._lock:
+            claves = np.frombuffer(self.claves, dtype=np.int64) if len(self.claves) else np.zeros(0, dtype=np.int64)
+            dentro = (bks >= 0) & (bks < len(claves))
+            resultado[dentro] = claves[bks[dentro]]
+            del claves # Liberar la vista antes de que add_many pueda redimensionar el array
+        return resultado
+
+    def resolve(self, conn_almacen, bks):
+        """Asegura que las claves de negocio dadas estén en la caché, consultando al almacén solo las que falten."""
+        if self.completa:
+            return
+        faltantes = sorted({bk for bk in bks if self.get(bk) is None})
+        if not faltantes:
+            return
+        cursor = conn_almacen.cursor()
+        try:
+            for inicio in range(0, len(faltantes), ETL_TAMANO_LOTE_CARGA):
+                parte = faltantes[inicio:inicio + ETL_TAMANO_LOTE_CARGA]
+                cursor.execute(
+                    f"SELECT {self.bk_col}, {self.sk_col} FROM {nombre_fisico(self.table_name)} WHERE es_actual = 1 AND {self.bk_col} IN ({', '.join(['%s'] * len(parte))})",
+                    [sql_key(bk) for bk in parte]
+                )
+                self.add_many((int(bk), int(sk)) for bk, sk in cursor.fetchall())
+        finally:
+            cursor.close()
+
+    def load_from_warehouse(self, conn_almacen):
+        """Llena la caché con toda la dimensión leída del almacén y la marca como completa."""
+        cursor = conn_almacen.cursor()
+        try:
+            cursor.execute(f"SELECT {self.bk_col}, {self.sk_col} FROM {nombre_fisico(self.table_name)} WHERE es_actual = 1")
+            self.reset(completa=False)
+            self.add_many((int(bk), int(sk)) for bk, sk in cursor.fetchall())
+            self.completa = True
+        finally:
+            cursor.close()
+
+    def _ruta(self, directorio, marca_agua, extension='sk'):
+        return os.path.join(directorio, f"{self.table_name}_{marca_agua}.{extension}")
+
+    def count_rows(self, conn_almacen):
+        """Número de filas (todas las versiones) de la dimensión en el almacén: marca de validez de la caché en disco."""
+        cursor = conn_almacen.cursor()
+        try:
+            cursor.execute(f"SELECT COUNT(*) FROM {nombre_fisico(self.table_name)}")
+            return int(cursor.fetchone()[0])
+        finally:
+            cursor.close()
+
+    def discard(self, directorio):
+        """Elimina la caché persistida en disco (y su marca de filas), si existe."""
+        if not os.path.isdir(directorio):
+            return
+        for archivo in os.listdir(directorio):
+            if archivo.startswith(f"{self.table_name}_") and archivo.endswith((".sk", ".filas")):
+                os.remove(os.path.join(directorio, archivo))
+
+    def save(self, directorio, marca_agua, filas):
+        """Persiste la caché en disco, asociada a la marca de agua de la tabla de origen y al número de filas
+        de la dimensión en el almacén (que se guarda al lado, en un archivo .filas)."""
+        os.makedirs(directorio, exist_ok=True)
+        self.discard(directorio)
+        with self._lock, open(self._ruta(directorio, marca_agua), 'wb') as f:
+            self.claves.tofile(f)
+        with open(self._ruta(directorio, marca_agua, 'filas'), 'w') as f:
+            f.write(str(filas))
+
+    def load(self, directorio, marca_agua, filas):
+        """Carga la caché persistida si corresponde a la marca de agua actual y la dimensión sigue teniendo filas filas
+        en el almacén (si no, otro proceso, como CDC, la modificó). Retorna True si se cargó."""
+        ruta = self._ruta(directorio, marca_agua)
+        ruta_filas = self._ruta(directorio, marca_agua, 'filas')
+        if marca_agua is None or not os.path.exists(ruta) or not os.path.exists(ruta_filas):
+            return False
+        with open(ruta_filas) as f:
+            if f.read().strip() != str(filas):
+                return False
+        claves = array('q')
+        with open(ruta, 'rb') as f:
+            claves.frombytes(f.read())
+        with self._lock:
+            self.claves = claves
+            self.completa = True
+        return True
+
+# Cachés de claves sustitutas compartidas por los cargadores, con la tabla de origen de la que dependen
+SK_CACHE = {
+    'dim_pacientes': SurrogateKeyCache('dim_pacientes', 'id_paciente_sk', 'id_paciente'),
+    'dim_medicos': SurrogateKeyCache('dim_medicos', 'id_medico_sk', 'id_medico')
+}
+TABLA_ORIGEN_CACHE = {'dim_pacientes': 'Pacientes', 'dim_medicos': 'Medicos'}
+
+def prepare_sk_caches(conn_almacen, marcas_agua, completa):
+    """Inicializa las cachés de claves al comienzo de una ejecución.
+
+    Tras truncar el almacén quedan completas (vacías). En cargas incrementales se reutiliza la caché
+    persistida en ETL_DIRECTORIO_ESTADO si coincide con la marca de agua y con el número de filas de la dimensión
+    en el almacén, o se lee una vez del almacén para poder persistirla; sin directorio de estado, las claves se
+    consultan bajo demanda.
+    """
+    for tabla, cache in SK_CACHE.items():
+        cache.reset(completa)
+        if not completa and ETL_DIRECTORIO_ESTADO:
+            if cache.load(ETL_DIRECTORIO_ESTADO, marcas_agua.get(TABLA_ORIGEN_CACHE[tabla]), cache.count_rows(conn_almacen)):
+                print(f"Caché de claves de {tabla} cargada desde disco.")
+            else:
+                cache.load_from_warehouse(conn_almacen)
+
+def save_sk_caches(conn_almacen, marcas_agua):
+    """Persiste las cachés completas en ETL_DIRECTORIO_ESTADO (si está configurado)."""
+    if not ETL_DIRECTORIO_ESTADO:
+        return
+    for tabla, cache in SK_CACHE.items():
+        if cache.completa:
+            cache.save(ETL_DIRECTORIO_ESTADO, marcas_agua.get(TABLA_ORIGEN_CACHE[tabla]), cache.count_rows(conn_almacen))
+
+def discard_sk_caches():
+    """Elimina las cachés persistidas en ETL_DIRECTORIO_ESTADO (si está configurado)."""
+    if not ETL_DIRECTORIO_ESTADO:
+        return
+    for cache in SK_CACHE.values():
+        cache.discard(ETL_DIRECTORIO_ESTADO)
+
+COLUMNAS_HECHOS = ('id_cita', 'id_paciente_sk', 'id_medico_sk', 'id_tiempo_sk', 'fecha_hora_cita', 'estado_cita', 'motivo_cita')
+
+# Límite superior (exclusivo, primer día de un mes) de la última partición mensual de cada tabla física de hechos.
+# None si la tabla no está particionada. Se lee de INFORMATION_SCHEMA una vez por ejecución.
+_limite_particiones = {}
+
+def _primer_dia_mes(fecha, meses=0):
+    indice = fecha.year * 12 + fecha.month - 1 + meses
+    return date(indice // 12, indice % 12 + 1, 1)
+
+def ensure_fact_partitions(conn_almacen, fecha_max):
+    """Crea las particiones mensuales de citas_hechos que faltan hasta fecha_max (más ETL_MESES_PARTICIONES meses).
+
+    Las nuevas particiones se obtienen reorganizando p_futuro, que normalmente está vacía (y entonces es inmediato).
+    Retorna True si la tabla cubre fecha_max con particiones mensuales o no está particionada.
+    """
+    tabla = nombre_fisico('citas_hechos')
+    cursor = conn_almacen.cursor()
+    try:
+        if tabla not in _limite_particiones:
             cursor.execute(
-                "INSERT IGNORE INTO dim_medicos (id_medico_sk, id_medico, id_especialidad, codigo_empleado, nombre, apellido, genero, fecha_carga) VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)",
-                (id_medico_sk, id_medico_bk, id_especialidad_bk, med['CodigoEmpleado'], med['Nombre'], med['Apellido'], med['Genero'])
+                "SELECT PARTITION_DESCRIPTION FROM INFORMATION_SCHEMA.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() "
+                "AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL AND PARTITION_DESCRIPTION <> 'MAXVALUE'", (tabla,)
             )
+            dias = [int(descripcion) for (descripcion,) in cursor.fetchall()]
+            # PARTITION_DESCRIPTION es TO_DAYS del límite; TO_DAYS('0001-01-01') = 366 y date.toordinal('0001-01-01') = 1
+            _limite_particiones[tabla] = date.fromordinal(max(dias) - 365) if dias else None
+        limite = _limite_particiones[tabla]
+        if limite is None or fecha_max < limite:
+            return True
+
+        nuevo_limite = _primer_dia_mes(fecha_max, ETL_MESES_PARTICIONES + 1)
+        particiones = []
+        desde = limite
+        while desde < nuevo_limite:
+            hasta = _primer_dia_mes(desde, 1)
+            particiones.append(f"PARTITION p{desde.strftime('%Y%m')} VALUES LESS THAN (TO_DAYS('{hasta.isoformat()}'))")
+            desde = hasta
+        print(f"Creando particiones de {tabla} hasta {nuevo_limite}...")
+        cursor.execute(f"ALTER TABLE {tabla} REORGANIZE PARTITION p_futuro INTO ("
+                       + ", ".join(particiones) + ", PARTITION p_futuro VALUES LESS THAN MAXVALUE)")
+        _limite_particiones[tabla] = nuevo_limite
+        return True
+    except mysql.connector.Error as err:
+        print(f"Error al crear particiones de {tabla}: {err}")
+        return False
+    finally:
+        cursor.close()
+
+def _delete_stale_rows(cursor, filas):
+    # Sin la fecha anterior no hay predicado de partición: cada id_cita se busca en todas, por eso solo se llama con
+    # las citas que pueden tener ya una fila (_citas_preexistentes)
+    tabla = nombre_fisico('citas_hechos')
+    for inicio in range(0, len(filas), ETL_TAMANO_LOTE_CARGA):
+        parte = filas[inicio:inicio + ETL_TAMANO_LOTE_CARGA]
+        cursor.execute(
+            f"DELETE FROM {tabla} WHERE id_cita IN ({', '.join(['%s'] * len(parte))}) "
+            f"AND (id_cita, fecha_hora_cita) NOT IN ({', '.join(['(%s, %s)'] * len(parte))})",
+            [fila[0] for fila in parte] + [valor for fila in parte for valor in (fila[0], fila[4])]
+        )
+
+def delete_stale_citas_hechos(conn_almacen, filas):
+    """Elimina las versiones de las citas cargadas con otra fecha_hora_cita (la fecha es parte de la PK).
+
+    Una cita reprogramada se inserta como una fila nueva en su partición; la fila anterior se borra después,
+    así que la cita nunca falta en citas_hechos. Retorna True si no hubo error.
+    """
+    if not filas:
+        return True
+    cursor = conn_almacen.cursor()
+    try:
+        _delete_stale_rows(cursor, filas)
         conn_almacen.commit()
-        print(f"Cargadas {cursor.rowcount} filas en dim_medicos.")
+        return True
     except mysql.connector.Error as err:
         conn_almacen.rollback()
-        print(f"Error al cargar dim_medicos: {err}")
+        print(f"Error al eliminar versiones anteriores de citas_hechos: {err}")
+        return False
     finally:
         cursor.close()
 
-def load_dim_tiempo(conn_almacen, citas_origen):
-    """Carga y transforma datos para dim_tiempo a partir de las fechas de citas."""
-    cursor = conn_almacen.cursor()
-    print("Cargando dim_tiempo...")
-    unique_dates = set()
-    rows_to_insert = []
+# --- Agregados de citas_hechos ---
+# Especialidad de cada versión de médico (id_medico_sk -> id_especialidad): una versión SCD2 no cambia de especialidad
+_especialidad_medico = {}
 
-    for cita in citas_origen:
-        hora_cita_raw = cita['HoraCita']
-        
-        # Convertir timedelta a datetime.time si es necesario
-        if isinstance(hora_cita_raw, timedelta):
-            total_seconds = hora_cita_raw.seconds
-            hours = total_seconds // 3600
-            minutes = (total_seconds % 3600) // 60
-            seconds = total_seconds % 60
-            hora_cita_obj = time(hours, minutes, seconds)
-        elif isinstance(hora_cita_raw, time):
-            hora_cita_obj = hora_cita_raw
-        else:
-            # En caso de otro tipo inesperado, intentar parsear o loggear error
-            print(f"Advertencia: Tipo de HoraCita inesperado para cita {cita.get('CitaID')}: {type(hora_cita_raw)}. Se espera datetime.time o timedelta.")
-            try:
-                # Si viene como string 'HH:MM:SS', se puede parsear
-                if isinstance(hora_cita_raw, str):
-                    hora_cita_obj = datetime.strptime(hora_cita_raw, '%H:%M:%S').time()
-                else:
-                    # Si no es un tipo esperado, saltar o manejar el error
-                    print(f"Error: HoraCita no convertible para cita {cita.get('CitaID')}. Saltando fila.")
-                    continue
-            except ValueError as ve:
-                print(f"Error al parsear HoraCita string para cita {cita.get('CitaID')}: {ve}. Saltando fila.")
-                continue
+def _especialidades_medicos(cursor, medicos_sk):
+    """Retorna {id_medico_sk: id_especialidad}, consultando en dim_medicos solo las SK que no están en caché."""
+    faltantes = list({sk for sk in medicos_sk if sk not in _especialidad_medico})
+    for inicio in range(0, len(faltantes), ETL_TAMANO_LOTE_CARGA):
+        parte = faltantes[inicio:inicio + ETL_TAMANO_LOTE_CARGA]
+        cursor.execute(
+            f"SELECT id_medico_sk, id_especialidad FROM {nombre_fisico('dim_medicos')} "
+            f"WHERE id_medico_sk IN ({', '.join(['%s'] * len(parte))})", parte)
+        for medico_sk, especialidad in cursor.fetchall():
+            _especialidad_medico[sql_key(medico_sk)] = especialidad
+    return _especialidad_medico
 
-        # Combinar fecha y hora para una marca de tiempo completa
-        fecha_hora_cita = datetime.combine(cita['FechaCita'], hora_cita_obj)
-        
-        # Generar id_tiempo_sk basado en el formatoYYYYMMDDHHMMSS (VARCHAR)
-        id_tiempo_sk = fecha_hora_cita.strftime('%Y%m%d%H%M%S')
-
-        if id_tiempo_sk not in unique_dates:
-            unique_dates.add(id_tiempo_sk)
-            rows_to_insert.append((
-                id_tiempo_sk,
-                fecha_hora_cita.date(),
-                fecha_hora_cita.year,
-                fecha_hora_cita.month,
-                fecha_hora_cita.day,
-                fecha_hora_cita.hour,
-                fecha_hora_cita.minute,
-                fecha_hora_cita.second,
-                fecha_hora_cita.strftime('%B'), # Nombre del mes
-                fecha_hora_cita.strftime('%A')  # Nombre del día de la semana
-            ))
-    
-    if rows_to_insert:
+def _fact_aggregate_keys(cursor, ids_cita):
+    """Lee (id_medico_sk, fecha_hora_cita, estado_cita, motivo_cita) de las filas de citas_hechos de esas citas.
+
+    Son las contribuciones a los agregados que el lote va a reemplazar (o borrar).
+    """
+    tabla = nombre_fisico('citas_hechos')
+    filas = []
+    for inicio in range(0, len(ids_cita), ETL_TAMANO_LOTE_CARGA):
+        parte = ids_cita[inicio:inicio + ETL_TAMANO_LOTE_CARGA]
+        cursor.execute(
+            f"SELECT id_medico_sk, fecha_hora_cita, estado_cita, motivo_cita FROM {tabla} "
+            f"WHERE id_cita IN ({', '.join(['%s'] * len(parte))})", parte)
+        filas.extend((sql_key(medico_sk), fecha, estado, motivo) for medico_sk, fecha, estado, motivo in cursor.fetchall())
+    return filas
+
+def _apply_aggregate_deltas(cursor, nuevas, anteriores=()):
+    """Suma a los agregados las filas nuevas de citas_hechos y resta las anteriores que reemplazan o borran.
+
+    Las filas son (id_medico_sk, fecha_hora_cita, estado_cita, motivo_cita). Solo se escriben los grupos cuyo conteo
+    cambia, con un upsert num_citas = num_citas + delta; de los grupos que se restaron se eliminan los que quedan
+    en cero. No confirma: va en la misma transacción que la escritura de los hechos.
+    """
+    especialidades = _especialidades_medicos(cursor, [fila[0] for fila in nuevas] + [fila[0] for fila in anteriores])
+    por_dia = {}
+    por_mes = {}
+    for signo, filas in ((1, nuevas), (-1, anteriores)):
+        for medico_sk, fecha_hora, estado, motivo in filas:
+            # motivo_cita admite NULL en los hechos, pero es parte de la PK de los agregados
+            motivo = motivo or ''
+            clave = (fecha_hora.date(), medico_sk, estado, motivo)
+            por_dia[clave] = por_dia.get(clave, 0) + signo
+            clave = (fecha_hora.year, fecha_hora.month, especialidades.get(medico_sk), estado, motivo)
+            por_mes[clave] = por_mes.get(clave, 0) + signo
+
+    for tabla, columnas, deltas in (
+            ('agg_citas_dia_medico', ('fecha', 'id_medico_sk', 'estado_cita', 'motivo_cita'), por_dia),
+            ('agg_citas_mes_especialidad', ('anio', 'mes', 'id_especialidad', 'estado_cita', 'motivo_cita'), por_mes)):
+        filas = [clave + (delta,) for clave, delta in deltas.items() if delta]
+        fila_sql = "(" + ", ".join(["%s"] * (len(columnas) + 1)) + ")"
+        for inicio in range(0, len(filas), ETL_TAMANO_LOTE_CARGA):
+            parte = filas[inicio:inicio + ETL_TAMANO_LOTE_CARGA]
+            cursor.execute(
+                f"INSERT INTO {nombre_fisico(tabla)} ({', '.join(columnas)}, num_citas) VALUES "
+                f"{', '.join([fila_sql] * len(parte))} ON DUPLICATE KEY UPDATE num_citas = num_citas + VALUES(num_citas)",
+                [valor for fila in parte for valor in fila])
+        # Solo los grupos restados pueden quedar en cero; se buscan por su PK
+        restados = [clave for clave, delta in deltas.items() if delta < 0]
+        clave_sql = "(" + ", ".join(["%s"] * len(columnas)) + ")"
+        for inicio in range(0, len(restados), ETL_TAMANO_LOTE_CARGA):
+            parte = restados[inicio:inicio + ETL_TAMANO_LOTE_CARGA]
+            cursor.execute(
+                f"DELETE FROM {nombre_fisico(tabla)} WHERE ({', '.join(columnas)}) IN ({', '.join([clave_sql] * len(parte))}) "
+                "AND num_citas <= 0",
+                [valor for clave in parte for valor in clave])
+
+def load_facts_with_aggregates(conn_almacen, filas):
+    """Carga filas de citas_hechos y aplica su delta a los agregados en una sola transacción.
+
+    Lee las filas que el lote reemplaza (para restarlas), hace el upsert, borra las versiones con otra fecha y
+    actualiza los agregados; si algo falla no queda nada escrito, así que hechos y agregados nunca divergen.
+    Deadlocks y esperas de bloqueo reintentan la transacción completa. Retorna el número de filas, o None si hubo error.
+    """
+    for intento in range(ETL_REINTENTOS + 1):
+        cursor = conn_almacen.cursor()
         try:
-            # Usar executemany para inserciones más eficientes
-            insert_query = """
-            INSERT IGNORE INTO dim_tiempo (id_tiempo_sk, fecha, anio, mes, dia, hora, minuto, segundo, nombre_mes, dia_semana, fecha_carga)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-            """
-            cursor.executemany(insert_query, rows_to_insert)
+            # Las filas que el lote reemplaza se restan (solo las citas que pueden tener ya una fila)
+            preexistentes = _citas_preexistentes(filas)
+            anteriores = _fact_aggregate_keys(cursor, [fila[0] for fila in preexistentes])
+            for inicio in range(0, len(filas), ETL_TAMANO_LOTE_CARGA):
+                parte = filas[inicio:inicio + ETL_TAMANO_LOTE_CARGA]
+                cursor.execute(build_insert_sql('citas_hechos', COLUMNAS_HECHOS, len(parte), COLUMNAS_HECHOS[1:]),
+                               [valor for fila in parte for valor in fila])
+            _delete_stale_rows(cursor, preexistentes)
+            _apply_aggregate_deltas(cursor, [fila[2:3] + fila[4:] for fila in filas], anteriores)
             conn_almacen.commit()
-            print(f"Cargadas {cursor.rowcount} filas únicas en dim_tiempo.")
+            return len(filas)
         except mysql.connector.Error as err:
             conn_almacen.rollback()
-            print(f"Error al cargar dim_tiempo: {err}")
+            if intento < ETL_REINTENTOS and err.errno in (1205, 1213):
+                wait_before_retry(intento)
+                continue
+            print(f"Error al cargar citas_hechos y sus agregados: {err}")
+            return None
         finally:
             cursor.close()
-    else:
-        print("No hay nuevas entradas de tiempo para cargar.")
 
+def rebuild_aggregates(conn_almacen):
+    """Recalcula los agregados desde citas_hechos (p. ej. al activarlos sobre un almacén ya cargado). Retorna True si no hubo error."""
+    hechos = nombre_fisico('citas_hechos')
+    cursor = conn_almacen.cursor()
+    try:
+        print("Recalculando los agregados de citas desde citas_hechos...")
+        for tabla in TABLAS_AGREGADOS:
+            cursor.execute(f"DELETE FROM {nombre_fisico(tabla)}")
+        cursor.execute(
+            f"INSERT INTO {nombre_fisico('agg_citas_dia_medico')} (fecha, id_medico_sk, estado_cita, motivo_cita, num_citas) "
+            f"SELECT DATE(fecha_hora_cita), id_medico_sk, estado_cita, COALESCE(motivo_cita, ''), COUNT(*) FROM {hechos} "
+            "GROUP BY DATE(fecha_hora_cita), id_medico_sk, estado_cita, COALESCE(motivo_cita, '')")
+        cursor.execute(
+            f"INSERT INTO {nombre_fisico('agg_citas_mes_especialidad')} (anio, mes, id_especialidad, estado_cita, motivo_cita, num_citas) "
+            f"SELECT YEAR(fecha), MONTH(fecha), id_especialidad, estado_cita, motivo_cita, SUM(num_citas) "
+            f"FROM {nombre_fisico('agg_citas_dia_medico')} a JOIN {nombre_fisico('dim_medicos')} m USING (id_medico_sk) "
+            "GROUP BY YEAR(fecha), MONTH(fecha), id_especialidad, estado_cita, motivo_cita")
+        conn_almacen.commit()
+        return True
+    except mysql.connector.Error as err:
+        conn_almacen.rollback()
+        print(f"Error al recalcular los agregados de citas: {err}")
+        return False
+    finally:
+        cursor.close()
+
+def _load_fact_rows(conn_almacen, filas):
+    return load_rows(conn_almacen, 'citas_hechos', COLUMNAS_HECHOS, filas, update_columns=COLUMNAS_HECHOS[1:])
+
+def _load_fact_partition(mes, filas):
+    """Carga las filas de un mes de citas_hechos en su propia conexión, reintentando la partición completa si falla."""
+    for intento in range(ETL_REINTENTOS + 1):
+        conn = connect_db(DB_CONFIG_ALMACEN)
+        if conn:
+            try:
+                cargadas = _load_fact_rows(conn, filas)
+            finally:
+                conn.close()
+            if cargadas is not None:
+                return cargadas
+        if intento < ETL_REINTENTOS:
+            print(f"Reintentando la partición {mes} de citas_hechos (intento {intento + 2}/{ETL_REINTENTOS + 1})...")
+            wait_before_retry(intento)
+    print(f"No se pudo cargar la partición {mes} de citas_hechos.")
+    return None
+
+@instrumentado
+def load_citas_hechos(conn_almacen, citas, por_mes=False):
+    """Carga citas_hechos a partir de un lote de citas (LoteCitas, o tuplas de extract_data), buscando claves sustitutas en SK_CACHE.
 
-def load_citas_hechos(conn_almacen, citas_origen):
-    """Carga y transforma datos para citas_hechos, buscando claves sustitutas."""
-    cursor_almacen = conn_almacen.cursor()
+    Con por_mes y ETL_HILOS_HECHOS > 1 (para lotes grandes, como los unidos por merge_fact_batches) las filas se
+    reparten por mes de la cita (las particiones de la tabla) y cada mes se carga en paralelo en su propia conexión. Los meses confirmados no se deshacen si otro falla: la carga es un
+    upsert, así que reintentar el lote es seguro.
+    """
+    if not isinstance(citas, LoteCitas):
+        citas = transform_citas_batch(citas)
     print("Cargando citas_hechos...")
-    rows_to_insert = []
 
-    # Recuperar mapeos de claves de negocio a claves sustitutas de las dimensiones
-    def get_sk_mapping(table_name, pk_col_sk, bk_col_name):
-        cursor_map = conn_almacen.cursor()
-        cursor_map.execute(f"SELECT {pk_col_sk}, {bk_col_name} FROM {table_name}")
-        # Aseguramos que tanto SK como BK sean cadenas
-        mapping = {str(row[1]): str(row[0]) for row in cursor_map.fetchall()} 
-        cursor_map.close()
-        return mapping
-
-    paciente_sk_map = get_sk_mapping('dim_pacientes', 'id_paciente_sk', 'id_paciente')
-    medico_sk_map = get_sk_mapping('dim_medicos', 'id_medico_sk', 'id_medico')
-    
-    for cita in citas_origen:
+    # Asegurar que las claves sustitutas referenciadas estén en caché (solo consulta al almacén en cargas incrementales)
+    cache_pacientes = SK_CACHE['dim_pacientes']
+    cache_medicos = SK_CACHE['dim_medicos']
+    cache_pacientes.resolve(conn_almacen, np.unique(citas.paciente_id).tolist())
+    cache_medicos.resolve(conn_almacen, np.unique(citas.medico_id).tolist())
+    id_paciente_sk = cache_pacientes.get_array(citas.paciente_id)
+    id_medico_sk = cache_medicos.get_array(citas.medico_id)
+
+    encontradas = (id_paciente_sk > 0) & (id_medico_sk > 0)
+    for i in np.flatnonzero(~encontradas):
+        print(f"Advertencia: No se pudo encontrar SK para cita {citas.cita_id[i]} (PacienteID: {citas.paciente_id[i]}, MedicoID: {citas.medico_id[i]}). Saltando.")
+
+    # Las claves del almacén son VARCHAR(250) (o enteros en el esquema compacto); fecha_hora_cita se envía como datetime (DATETIME)
+    rows_to_insert = list(zip(
+        sql_keys(citas.cita_id[encontradas]),
+        sql_keys(id_paciente_sk[encontradas]),
+        sql_keys(id_medico_sk[encontradas]),
+        sql_keys(citas.id_tiempo_sk[encontradas]),
+        citas.fecha_hora[encontradas].astype(object).tolist(),
+        citas.estado[encontradas].tolist(),
+        citas.motivo[encontradas].tolist()
+    ))
+
+    if not rows_to_insert:
+        print("No hay citas para cargar en la tabla de hechos.")
+        return 0
+
+    meses = citas.fecha_hora[encontradas].astype('datetime64[M]')
+    if not ensure_fact_partitions(conn_almacen, meses.max().astype(object)):
+        return None
+    if TABLAS_AGREGADOS:
+        # Hechos y agregados en una sola transacción de conn_almacen (sin reparto por mes en otras conexiones)
+        cargadas = load_facts_with_aggregates(conn_almacen, rows_to_insert)
+    elif por_mes and ETL_HILOS_HECHOS > 1:
+        valores_mes, indice_mes = np.unique(meses, return_inverse=True)
+        particiones = {str(mes): [] for mes in valores_mes}
+        for fila, i in zip(rows_to_insert, indice_mes.tolist()):
+            particiones[str(valores_mes[i])].append(fila)
+        with ThreadPoolExecutor(max_workers=min(ETL_HILOS_HECHOS, len(particiones))) as pool:
+            resultados = list(pool.map(lambda particion: _load_fact_partition(*particion), particiones.items()))
+        cargadas = None if None in resultados else sum(resultados)
+    else:
+        cargadas = _load_fact_rows(conn_almacen, rows_to_insert)
+
+    if cargadas is not None and not TABLAS_AGREGADOS and not delete_stale_citas_hechos(conn_almacen, _citas_preexistentes(rows_to_insert)):
+        cargadas = None
+    if cargadas is not None:
+        export_fact_parquet(rows_to_insert, meses)
+        print(f"Cargadas {cargadas} filas en citas_hechos.")
+    return cargadas
+
+def merge_fact_batches(lotes_citas):
+    """Une lotes de citas transformados en un único LoteCitas (en el mismo orden)."""
+    return LoteCitas(*(np.concatenate(columna) for columna in zip(*lotes_citas)))
+
+
+# --- Función Principal de Orquestación ETL ---
+def run_task_graph(tareas, max_workers):
+    """Ejecuta un grafo de tareas {nombre: (funcion, [dependencias])} en un pool de hilos.
+
+    Cada función retorna (exito, valor). Una tarea se lanza en cuanto todas sus dependencias terminaron
+    con éxito; si alguna falló, se omite y se marca como fallida. Retorna {nombre: ((exito, valor), segundos)}.
+    """
+    resultados = {}
+    pendientes = dict(tareas)
+
+    def ejecutar(nombre, funcion):
+        inicio = perf_counter()
         try:
-            # Obtener claves sustitutas usando los mapeos
-            # Aseguramos que la clave de negocio de la cita también sea cadena para la búsqueda
-            id_paciente_sk = paciente_sk_map.get(str(cita['PacienteID']))
-            id_medico_sk = medico_sk_map.get(str(cita['MedicoID']))
-            
-            # Asegurar que HoraCita sea un objeto time para combinar correctamente
-            hora_cita_raw = cita['HoraCita']
-            if isinstance(hora_cita_raw, timedelta):
-                total_seconds = hora_cita_raw.seconds
-                hours = total_seconds // 3600
-                minutes = (total_seconds % 3600) // 60
-                seconds = total_seconds % 60
-                hora_cita_obj = time(hours, minutes, seconds)
-            elif isinstance(hora_cita_raw, time):
-                hora_cita_obj = hora_cita_raw
-            else:
-                print(f"Advertencia: Tipo de HoraCita inesperado para cita {cita.get('CitaID')} en hechos: {type(hora_cita_raw)}. Saltando fila.")
+            resultado = funcion()
+        except Exception as e:
+            print(f"Error en la tarea {nombre}: {e}")
+            resultado = (False, None)
+        return resultado, perf_counter() - inicio
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        en_curso = {}
+        while pendientes or en_curso:
+            for nombre, (funcion, dependencias) in list(pendientes.items()):
+                if any(dep in resultados and not resultados[dep][0][0] for dep in dependencias):
+                    print(f"Tarea {nombre} omitida: falló una de sus dependencias.")
+                    resultados[nombre] = ((False, None), 0.0)
+                    del pendientes[nombre]
+                elif all(dep in resultados for dep in dependencias):
+                    en_curso[pool.submit(ejecutar, nombre, funcion)] = nombre
+                    del pendientes[nombre]
+            if not en_curso:
                 continue
+            terminados, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                nombre = en_curso.pop(futuro)
+                resultados[nombre] = futuro.result()
+                print(f"Tarea {nombre} terminada en {resultados[nombre][1]:.2f} s.")
+    return resultados
 
+def run_parallel_load(lotes_de, max_workers, puntos_control=False):
+    """Carga dimensiones y hechos según sus dependencias reales, en paralelo y con una conexión al almacén por tarea.
 
-            # id_tiempo_sk se deriva de la fecha_hora_cita y ya es una cadena
-            fecha_hora_cita_obj = datetime.combine(cita['FechaCita'], hora_cita_obj)
-            id_tiempo_sk = fecha_hora_cita_obj.strftime('%Y%m%d%H%M%S')
-
-            if id_paciente_sk and id_medico_sk and id_tiempo_sk:
-                rows_to_insert.append((
-                    str(cita['CitaID']), # id_cita como VARCHAR(250)
-                    id_paciente_sk,
-                    id_medico_sk,
-                    id_tiempo_sk,
-                    fecha_hora_cita_obj, # Fecha y hora completas (DATETIME)
-                    cita['EstadoCita'],
-                    cita['MotivoCita']
-                ))
-            else:
-                print(f"Advertencia: No se pudo encontrar SK para cita {cita.get('CitaID')} (PacienteID: {cita['PacienteID']}, MedicoID: {cita['MedicoID']}). Saltando.")
+    dim_medicos depende de dim_especialidades (FK) y citas_hechos de todas las dimensiones que referencia.
+    Con puntos_control, cada tarea guarda el punto de control de su tabla de origen tras cada lote (el de Citas lo
+    guarda citas_hechos, que empieza cuando dim_tiempo ya terminó). Retorna {tabla_origen: (exito, marca_agua)}, como process_batches.
+    """
+    def al_confirmar(conn, tabla):
+        return (lambda marca: save_checkpoint(conn, tabla, marca)) if puntos_control else None
+
+    def con_conexion(cargar):
+        def tarea():
+            conn = connect_db(DB_CONFIG_ALMACEN)
+            if not conn:
+                return False, None
+            try:
+                return cargar(conn)
+            finally:
+                conn.close()
+        return tarea
 
-        except KeyError as ke:
-            print(f"Error de mapeo de clave para cita {cita.get('CitaID')}: {ke}. Asegúrate que las claves de negocio existen en las dimensiones.")
-            continue # Saltar esta fila si hay un problema de clave
+    # Las citas se transforman una sola vez y el resultado lo usan tanto dim_tiempo como citas_hechos
+    lotes_citas = lotes_de('Citas')
+    if lotes_citas is not None:
+        lotes_citas = [transform_citas_batch(lote) for lote in lotes_citas]
 
-    if rows_to_insert:
+    def cargar_hechos(conn):
+        lotes = lotes_citas
+        por_mes = ETL_HILOS_HECHOS > 1 and not TABLAS_AGREGADOS # Con agregados, cada lote es una transacción
+        if por_mes and lotes:
+            # Con todas las citas en memoria, se reparten por mes de una vez para que cada partición sea grande
+            lotes = [merge_fact_batches(lotes)]
+        return process_batches(lotes, lambda lote: load_citas_hechos(conn, lote, por_mes=por_mes), al_confirmar(conn, 'Citas'))
+
+    tareas = {
+        'dim_especialidades': (con_conexion(lambda conn: process_batches(
+            lotes_de('Especialidades'), lambda lote: load_dim_especialidades(conn, lote), al_confirmar(conn, 'Especialidades'))), []),
+        'dim_pacientes': (con_conexion(lambda conn: process_batches(
+            lotes_de('Pacientes'), lambda lote: load_dim_pacientes(conn, lote), al_confirmar(conn, 'Pacientes'))), []),
+        'dim_tiempo': (con_conexion(lambda conn: process_batches(
+            lotes_citas, lambda lote: load_dim_tiempo(conn, lote))), []),
+        'dim_medicos': (con_conexion(lambda conn: process_batches(
+            lotes_de('Medicos'), lambda lote: load_dim_medicos(conn, lote), al_confirmar(conn, 'Medicos'))), ['dim_especialidades']),
+        'citas_hechos': (con_conexion(cargar_hechos), ['dim_pacientes', 'dim_medicos', 'dim_tiempo'])
+    }
+    resultados = run_task_graph(tareas, max_workers)
+
+    print("Tiempos de carga por tarea: " + ", ".join(f"{nombre}={segundos:.2f}s" for nombre, (_, segundos) in resultados.items()))
+    exito_tiempo = resultados['dim_tiempo'][0][0]
+    exito_hechos, marca_citas = resultados['citas_hechos'][0]
+    return {
+        'Especialidades': resultados['dim_especialidades'][0],
+        'Pacientes': resultados['dim_pacientes'][0],
+        'Medicos': resultados['dim_medicos'][0],
+        'Citas': (exito_tiempo and exito_hechos, marca_citas)
+    }
+
+_FIN_COLA = object()
+
+def pipeline_batches(lotes, transformar=None, tamano_cola=ETL_TAMANO_COLA):
+    """Recorre lotes a través de un pipeline de hilos: uno consume lotes (la extracción) y otro aplica transformar.
+
+    Las etapas se comunican por colas acotadas de tamano_cola lotes mientras el llamador carga, así que lectura del
+    origen, transformación y escritura en el almacén se solapan, y las colas llenas frenan la extracción si la carga se
+    retrasa (memoria acotada). Los errores de un hilo se relanzan en el llamador. Retorna None si lotes es None.
+    """
+    if lotes is None:
+        return None
+    detener = threading.Event()
+
+    def poner(cola, elemento):
+        while not detener.is_set():
+            try:
+                cola.put(elemento, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def leer(cola):
+        while not detener.is_set():
+            try:
+                elemento = cola.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if elemento is _FIN_COLA:
+                return
+            if isinstance(elemento, BaseException):
+                raise elemento
+            yield elemento
+
+    def etapa(entrada, salida, funcion):
         try:
-            insert_query = """
-            INSERT INTO citas_hechos (id_cita, id_paciente_sk, id_medico_sk, id_tiempo_sk, fecha_hora_cita, estado_cita, motivo_cita, fecha_carga)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-            """
-            cursor_almacen.executemany(insert_query, rows_to_insert)
-            conn_almacen.commit()
-            print(f"Cargadas {cursor_almacen.rowcount} filas en citas_hechos.")
-        except mysql.connector.Error as err:
-            conn_almacen.rollback()
-            print(f"Error al cargar citas_hechos: {err}")
+            for lote in entrada:
+                if not poner(salida, funcion(lote) if funcion else lote):
+                    return
+            poner(salida, _FIN_COLA)
+        except BaseException as err:
+            poner(salida, err)
         finally:
-            cursor_almacen.close()
-    else:
-        print("No hay citas para cargar en la tabla de hechos.")
+            if hasattr(entrada, 'close'):
+                entrada.close() # Cierra el cursor de origen aunque el consumidor se detenga antes de tiempo
 
+    def generar():
+        extraidos = queue.Queue(maxsize=tamano_cola)
+        hilos = [threading.Thread(target=etapa, args=(iter(lotes), extraidos, None), daemon=True)]
+        salida = extraidos
+        if transformar:
+            salida = queue.Queue(maxsize=tamano_cola)
+            hilos.append(threading.Thread(target=etapa, args=(leer(extraidos), salida, transformar), daemon=True))
+        for hilo in hilos:
+            hilo.start()
+        try:
+            yield from leer(salida)
+        finally:
+            detener.set()
+            for hilo in hilos:
+                hilo.join()
 
-# --- Función Principal de Orquestación ETL ---
+    return generar()
+
+def process_batches(lotes, cargar_lote, al_confirmar=None):
+    """Aplica cargar_lote a cada lote extraído. Retorna (exito, marca_agua) con la última clave primaria procesada.
+
+    Se consumen todos los lotes aunque alguno falle, para no dejar resultados sin leer en el cursor de origen.
+    lotes es None cuando la extracción de la tabla falló, y si se interrumpe a mitad (ERRORES_EXTRACCION) la tabla
+    también cuenta como fallida. al_confirmar(marca_agua) se llama tras cada lote
+    cargado mientras no haya fallado ninguno (para guardar puntos de control).
+    """
+    if lotes is None:
+        return False, None
+    exito = True
+    marca_agua = None
+    iterador = iter(lotes)
+    while True:
+        try:
+            lote = next(iterador)
+        except StopIteration:
+            break
+        except ERRORES_EXTRACCION:
+            # La extracción se interrumpió (ya se informó el error): la tabla queda incompleta
+            return False, marca_agua
+        if cargar_lote(lote) is None:
+            exito = False
+        elif exito and _num_filas(lote):
+            # Los lotes vienen ordenados por la clave primaria (primera columna)
+            marca_agua = int(lote.cita_id[-1]) if isinstance(lote, LoteCitas) else lote[-1][0]
+            if al_confirmar:
+                al_confirmar(marca_agua)
+    return exito, marca_agua
+
+@instrumentado
 def run_etl_process():
     """Ejecuta el proceso ETL completo."""
+    global _citas_nuevas_desde
     conn_origen = None
     conn_almacen = None
     try:
-        # Verificar que las credenciales se cargaron correctamente
-        if not DB_CONFIG_ORIGEN or not DB_CONFIG_ALMACEN:
+        # Verificar que las credenciales se cargaron correctamente (al repetir desde snapshots el origen es opcional)
+        if not DB_CONFIG_ALMACEN or not (ETL_DESDE_SNAPSHOT or DB_CONFIG_ORIGEN):
             print("Las credenciales de la base de datos no están disponibles. Terminando ETL.")
             return
 
-        conn_origen = connect_db(DB_CONFIG_ORIGEN)
+        conn_origen = connect_db(DB_CONFIG_ORIGEN) if DB_CONFIG_ORIGEN else None
         conn_almacen = connect_db(DB_CONFIG_ALMACEN)
 
-        if not conn_origen or not conn_almacen:
+        if not conn_almacen or not (conn_origen or ETL_DESDE_SNAPSHOT):
             print("No se pudo establecer conexión con una o ambas bases de datos. Terminando ETL.")
             return
 
-        # 1. Truncar tablas del almacén antes de iniciar (para Full Load)
-        truncate_warehouse_tables(conn_almacen)
-
-        # 2. Extraer datos de origen
-        print("\nIniciando extracción de datos de origen...")
-        pacientes_origen = extract_data(conn_origen, 'Pacientes')
-        medicos_origen = extract_data(conn_origen, 'Medicos')
-        especialidades_origen = extract_data(conn_origen, 'Especialidades')
-        citas_origen = extract_data(conn_origen, 'Citas')
-        print("Extracción de datos de origen completada.")
-
-        # 3. Cargar Dimensiones (Orden importante: Especialidades -> Medicos -> Pacientes -> Tiempo)
-        print("\nIniciando carga de dimensiones...")
-        load_dim_especialidades(conn_almacen, especialidades_origen)
-        load_dim_pacientes(conn_almacen, pacientes_origen)
-        load_dim_medicos(conn_almacen, medicos_origen)
-        load_dim_tiempo(conn_almacen, citas_origen)
-        print("Carga de dimensiones completada.")
-
-        # 4. Cargar Tabla de Hechos
-        print("\nIniciando carga de tabla de hechos...")
-        load_citas_hechos(conn_almacen, citas_origen)
-        print("Carga de tabla de hechos completada.")
+        incremental = ETL_MODO_CARGA == 'incremental'
+        tipo_carga = 'incremental' if incremental else ('sombra' if ETL_CARGA_SOMBRA else 'completa')
+        marcas_control = get_watermarks(conn_almacen)
+        if marcas_control is None:
+            print("No se pudieron leer las marcas de agua. Terminando ETL.")
+            return
+        # 0. Si la ejecución anterior del mismo tipo quedó a medias, se reanuda desde sus puntos de control
+        puntos_control = get_checkpoints(marcas_control)
+        reanudar = ETL_REANUDAR and puntos_control.get('carga') == TIPOS_CARGA[tipo_carga]
+        if reanudar and tipo_carga == 'sombra' and not resume_shadow_tables(conn_almacen):
+            print("Las tablas sombra de la ejecución interrumpida ya no existen; se empieza de nuevo.")
+            reanudar = False
+        if not reanudar:
+            puntos_control = {}
+
+        marcas_agua = {}
+        if incremental:
+            marcas_agua = {tabla: marca for tabla, marca in marcas_control.items() if not tabla.startswith(PREFIJO_PUNTO_CONTROL)}
+        # Las dimensiones SCD2 se leen completas para detectar cambios; la fusión solo escribe lo que cambió.
+        # Al reanudar, cada tabla continúa después de su última clave confirmada.
+        marcas_extraccion = {tabla: marca for tabla, marca in marcas_agua.items() if tabla not in TABLAS_SCD2}
+        marcas_extraccion.update({tabla: marca for tabla, marca in puntos_control.items() if tabla in COLUMNAS_ORIGEN})
+        if not conn_origen:
+            # Se comprueba antes de tocar el almacén: sin origen, todas las tablas deben poder leerse de snapshots
+            sin_snapshot = [tabla for tabla in COLUMNAS_ORIGEN if not find_snapshots(tabla, marcas_extraccion.get(tabla))]
+            if sin_snapshot:
+                print(f"Sin conexión al origen y sin snapshots de {', '.join(sin_snapshot)}. Terminando ETL.")
+                return
+
+        if incremental:
+            # 1. Carga incremental: leer las marcas de agua en lugar de truncar el almacén
+            print(f"Modo incremental. Marcas de agua actuales: {marcas_agua}")
+        elif reanudar:
+            print("Se reanuda la carga completa interrumpida; el almacén no se trunca.")
+        elif ETL_CARGA_SOMBRA:
+            # 1. Carga completa en tablas sombra vacías; el almacén publicado no se toca hasta el intercambio final
+            if not create_shadow_tables(conn_almacen):
+                print("No se pudieron crear las tablas sombra. Terminando ETL.")
+                return
+        else:
+            # 1. Truncar tablas del almacén antes de iniciar (para Full Load)
+            if not truncate_warehouse_tables(conn_almacen):
+                incremental = True # Si falla, no se asume un almacén vacío
+                tipo_carga = 'incremental'
+        if reanudar:
+            print(f"Reanudando desde los puntos de control: {puntos_control}")
+        else:
+            clear_checkpoints(conn_almacen)
+        save_checkpoint(conn_almacen, 'carga', TIPOS_CARGA[tipo_carga])
+        # Al reanudar, las dimensiones ya están parcialmente cargadas: las cachés se leen del almacén, no de disco
+        prepare_sk_caches(conn_almacen, {} if reanudar else marcas_agua, completa=not incremental and not reanudar)
+        if reanudar:
+            _citas_nuevas_desde = None
+        else:
+            marca_citas = marcas_agua.get('Citas') if incremental else 0
+            _citas_nuevas_desde = int(marca_citas) if marca_citas is not None else None
+        prepare_parquet_export(completa=not incremental, reanudar=reanudar)
+        _cobertura_calendario.clear() # Se vuelve a leer de etl_control en esta ejecución
+        _limite_particiones.clear()
+        _especialidad_medico.clear()
+
+        # 2. Extraer datos de origen: en paralelo (todo en memoria) o en streaming a medida que se cargan
+        if ETL_EXTRACCION_PARALELA or ETL_CARGA_PARALELA:
+            print("\nIniciando extracción paralela de datos de origen...")
+            extraidos = extract_data_parallel(DB_CONFIG_ORIGEN, marcas_extraccion, ETL_PARTICIONES_CITAS)
+            print("Extracción de datos de origen completada.")
+            lotes_de = lambda tabla: extraidos[tabla]
+        else:
+            lotes_de = lambda tabla: extract_data(conn_origen, tabla, marcas_extraccion.get(tabla))
+            if ETL_PIPELINE:
+                # Extracción (y transformación de las citas) en hilos propios, solapadas con la carga. Las tablas se
+                # siguen recorriendo de una en una, así que conn_origen nunca se usa desde dos hilos a la vez.
+                extraer = lotes_de
+                lotes_de = lambda tabla: pipeline_batches(extraer(tabla), transform_citas_batch if tabla == 'Citas' else None)
+
+        if ETL_CARGA_PARALELA:
+            # 3 y 4. Cargar dimensiones y hechos según el grafo de dependencias
+            print("\nIniciando carga paralela de dimensiones y tabla de hechos...")
+            resultados = run_parallel_load(lotes_de, ETL_HILOS_CARGA, puntos_control=True)
+            print("Carga de dimensiones y tabla de hechos completada.")
+        else:
+            # 3. Cargar lote a lote (Orden importante: Especialidades -> Pacientes -> Medicos -> Citas)
+            print("\nIniciando carga de dimensiones...")
+            resultados = {}
+            def al_confirmar(tabla):
+                return lambda marca: save_checkpoint(conn_almacen, tabla, marca)
+            resultados['Especialidades'] = process_batches(
+                lotes_de('Especialidades'),
+                lambda lote: load_dim_especialidades(conn_almacen, lote), al_confirmar('Especialidades'))
+            resultados['Pacientes'] = process_batches(
+                lotes_de('Pacientes'),
+                lambda lote: load_dim_pacientes(conn_almacen, lote), al_confirmar('Pacientes'))
+            resultados['Medicos'] = process_batches(
+                lotes_de('Medicos'),
+                lambda lote: load_dim_medicos(conn_almacen, lote), al_confirmar('Medicos'))
+            print("Carga de dimensiones completada.")
+
+            # 4. Cargar dim_tiempo y la tabla de hechos por lotes de citas
+            print("\nIniciando carga de dim_tiempo y tabla de hechos...")
+            def cargar_lote_citas(lote):
+                # Una sola transformación para ambas tablas (con ETL_PIPELINE ya viene transformado)
+                lote_citas = lote if isinstance(lote, LoteCitas) else transform_citas_batch(lote)
+                if load_dim_tiempo(conn_almacen, lote_citas) is None:
+                    return None
+                return load_citas_hechos(conn_almacen, lote_citas)
+
+            resultados['Citas'] = process_batches(lotes_de('Citas'), cargar_lote_citas, al_confirmar('Citas'))
+            print("Carga de tabla de hechos completada.")
+
+        # 5. Avanzar las marcas de agua solo si todas las cargas terminaron sin error
+        #    (también tras una carga completa, para que la siguiente incremental parta de aquí)
+        if not all(exito for exito, _ in resultados.values()):
+            if _tablas_destino:
+                _tablas_destino.clear()
+                print("Hubo errores de carga; las tablas sombra no se publican y el almacén conserva la carga anterior. "
+                      "La próxima ejecución reanuda la carga desde los puntos de control.")
+                return
+            print("Hubo errores de carga; las marcas de agua no se actualizan y la próxima ejecución reanuda desde los puntos de control.")
+        else:
+            if TABLAS_AGREGADOS and ETL_RECONSTRUIR_AGREGADOS and not rebuild_aggregates(conn_almacen):
+                print("No se pudieron recalcular los agregados. Terminando ETL.")
+                return
+            if _tablas_destino and not swap_shadow_tables(conn_almacen):
+                print("No se pudieron publicar las tablas sombra. Terminando ETL.")
+                return
+            publish_parquet_export()
+            # Una tabla que ya estaba completa al reanudar no procesa lotes: su marca es el punto de control
+            nuevas_marcas = {tabla: marca if marca is not None else puntos_control.get(tabla)
+                             for tabla, (_, marca) in resultados.items()}
+            nuevas_marcas = {tabla: marca for tabla, marca in nuevas_marcas.items() if marca is not None}
+            if nuevas_marcas:
+                save_watermarks(conn_almacen, nuevas_marcas)
+            clear_checkpoints(conn_almacen)
+            save_sk_caches(conn_almacen, {**marcas_agua, **nuevas_marcas})
 
         print("\nProceso ETL finalizado exitosamente.")
 
     finally:
+        close_parquet_export() # Sin publicar, si la carga completa no terminó
         if conn_origen:
             conn_origen.close()
             print("Conexión a origen_citas cerrada.")
@@ -377,5 +2630,242 @@ def run_etl_process():
             conn_almacen.close()
             print("Conexión a almacen_citas cerrada.")
 
+# --- Captura de Cambios (CDC) desde el binlog de origen ---
+def delete_citas_hechos(conn_almacen, ids_cita):
+    """Elimina de citas_hechos las citas borradas en el origen. Retorna el número de filas eliminadas, o None si hubo error."""
+    ids_cita = [sql_key(cita_id) for cita_id in ids_cita]
+    cursor = conn_almacen.cursor()
+    eliminadas = 0
+    try:
+        # Las filas borradas se restan de los agregados en la misma transacción
+        anteriores = _fact_aggregate_keys(cursor, ids_cita) if TABLAS_AGREGADOS else []
+        for inicio in range(0, len(ids_cita), ETL_TAMANO_LOTE_CARGA):
+            parte = ids_cita[inicio:inicio + ETL_TAMANO_LOTE_CARGA]
+            cursor.execute(f"DELETE FROM citas_hechos WHERE id_cita IN ({', '.join(['%s'] * len(parte))})", parte)
+            eliminadas += cursor.rowcount
+        if anteriores:
+            _apply_aggregate_deltas(cursor, [], anteriores)
+        conn_almacen.commit()
+        print(f"Eliminadas {eliminadas} filas de citas_hechos.")
+        delete_parquet_rows('citas_hechos', ids_cita)
+        return eliminadas
+    except mysql.connector.Error as err:
+        conn_almacen.rollback()
+        print(f"Error al eliminar filas de citas_hechos: {err}")
+        return None
+    finally:
+        cursor.close()
+
+def apply_cdc_changes(conn_almacen, cambios):
+    """Aplica un micro-lote de cambios {tabla_origen: {clave: (operacion, fila)}} al almacén.
+
+    Las inserciones y actualizaciones se cargan con los mismos cargadores (upsert o fusión SCD2) que el ETL por lotes, en orden
+    de dependencias. Los borrados de citas se eliminan de citas_hechos; los de dimensiones se conservan en el
+    almacén porque los hechos históricos pueden referenciarlos. Retorna True si todo se aplicó.
+    """
+    cargadores = {
+        'Especialidades': load_dim_especialidades,
+        'Pacientes': load_dim_pacientes,
+        'Medicos': load_dim_medicos
+    }
+    exito = True
+    for tabla in ('Especialidades', 'Pacientes', 'Medicos', 'Citas'):
+        pendientes = cambios.get(tabla, {})
+        filas = [fila for operacion, fila in pendientes.values() if operacion != 'delete']
+        borrados = [clave for clave, (operacion, _) in pendientes.items() if operacion == 'delete']
+        if tabla == 'Citas':
+            if filas:
+                lote_citas = transform_citas_batch(filas)
+                exito = exito and load_dim_tiempo(conn_almacen, lote_citas) is not None
+                exito = exito and load_citas_hechos(conn_almacen, lote_citas) is not None
+            if borrados:
+                exito = exito and delete_citas_hechos(conn_almacen, borrados) is not None
+        else:
+            if filas:
+                exito = exito and cargadores[tabla](conn_almacen, filas) is not None
+            if borrados:
+                print(f"Advertencia: {len(borrados)} filas borradas en {tabla} se conservan en el almacén.")
+    return exito
+
+def get_binlog_position(conn_origen):
+    """Retorna (archivo, posicion) actuales del binlog del origen."""
+    cursor = conn_origen.cursor()
+    try:
+        try:
+            cursor.execute("SHOW BINARY LOG STATUS") # MySQL 8.4+
+        except mysql.connector.Error:
+            cursor.execute("SHOW MASTER STATUS")
+        fila = cursor.fetchone()
+        return fila[0], fila[1]
+    finally:
+        cursor.close()
+
+# Configuración del binlog del origen que requiere el modo CDC: filas completas y con nombres de columna
+AJUSTES_BINLOG = {'binlog_format': 'ROW', 'binlog_row_image': 'FULL', 'binlog_row_metadata': 'FULL'}
+
+def check_binlog_settings(conn_origen):
+    """Comprueba que el binlog del origen tenga AJUSTES_BINLOG. Retorna True si es así; si no, informa qué falta."""
+    cursor = conn_origen.cursor()
+    try:
+        cursor.execute("SELECT " + ", ".join(f"@@{variable}" for variable in AJUSTES_BINLOG))
+        valores = dict(zip(AJUSTES_BINLOG, cursor.fetchone()))
+    except mysql.connector.Error as err:
+        # binlog_row_metadata no existe antes de MySQL 8.0.1
+        print(f"No se pudo leer la configuración del binlog del origen: {err}")
+        return False
+    finally:
+        cursor.close()
+    incorrectos = [f"{variable}={valores[variable]} (se requiere {requerido})"
+                   for variable, requerido in AJUSTES_BINLOG.items() if str(valores[variable]).upper() != requerido]
+    if incorrectos:
+        print("El binlog del origen no tiene la configuración que requiere CDC: " + ", ".join(incorrectos) + ".")
+        return False
+    return True
+
+def run_cdc_process():
+    """Replica en casi tiempo real los cambios del origen leyendo su binlog (eventos de filas).
+
+    Requiere en el origen binlog_format=ROW, binlog_row_image=FULL y binlog_row_metadata=FULL (sin esta última,
+    mysql-replication 1.x nombra las columnas UNKNOWN_COL0..n; MySQL 8 usa MINIMAL por omisión), y un usuario con
+    permisos REPLICATION SLAVE y REPLICATION CLIENT. Se comprueba al iniciar (check_binlog_settings).
+    Los cambios se acumulan por tabla y clave (solo cuenta el último) y se aplican en micro-lotes de
+    ETL_CDC_TAMANO_LOTE cambios o cada ETL_CDC_INTERVALO segundos, siempre al terminar una transacción del origen.
+    La posición del binlog se guarda en etl_control tras cada micro-lote, así que un reinicio continúa desde ahí
+    (los cambios se reaplican como upserts). Nunca se guarda a mitad de una transacción: al reanudar desde ahí,
+    mysql-replication descartaría sin error sus eventos de filas restantes (su TABLE_MAP ya quedó atrás).
+    La exportación Parquet se cierra y compacta cada ETL_CDC_INTERVALO_PARQUET segundos, no en cada micro-lote.
+    La primera vez arranca desde la posición actual: debe hacerse antes una carga completa.
+    """
+    global _citas_nuevas_desde
+    try:
+        from pymysqlreplication import BinLogStreamReader
+        from pymysqlreplication.event import HeartbeatLogEvent, QueryEvent, XidEvent
+        from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+    except ImportError:
+        print("El modo CDC requiere el paquete mysql-replication (pip install mysql-replication). Terminando.")
+        return
+
+    if not DB_CONFIG_ORIGEN or not DB_CONFIG_ALMACEN:
+        print("Las credenciales de la base de datos no están disponibles. Terminando CDC.")
+        return
+    conn_almacen = connect_db(DB_CONFIG_ALMACEN)
+    conn_origen = connect_db(DB_CONFIG_ORIGEN)
+    if not conn_origen or not conn_almacen:
+        print("No se pudo establecer conexión con una o ambas bases de datos. Terminando CDC.")
+        return
+
+    stream = None
+    try:
+        if not check_binlog_settings(conn_origen):
+            print("Terminando CDC.")
+            return
+        marcas_agua = get_watermarks(conn_almacen) or {}
+        archivo_actual, posicion_actual = get_binlog_position(conn_origen)
+        prefijo = archivo_actual.rsplit('.', 1)[0]
+        if 'cdc_binlog_archivo' in marcas_agua:
+            log_file = f"{prefijo}.{int(marcas_agua['cdc_binlog_archivo']):06d}"
+            log_pos = int(marcas_agua['cdc_binlog_posicion'])
+        else:
+            log_file, log_pos = archivo_actual, posicion_actual
+        conn_origen.close()
+        conn_origen = None
+        print(f"Iniciando CDC desde {log_file}:{log_pos}...")
+
+        _citas_nuevas_desde = None # Los cambios de CDC pueden reprogramar cualquier cita
+        prepare_sk_caches(conn_almacen, marcas_agua, completa=False)
+        # CDC inserta filas de dimensiones sin avanzar las marcas de agua: la caché persistida deja de valer
+        discard_sk_caches()
+        prepare_parquet_export(completa=False)
+        tablas = {tabla.lower(): tabla for tabla in COLUMNAS_ORIGEN}
+        conexion = {
+            'host': DB_CONFIG_ORIGEN['host'],
+            'port': DB_CONFIG_ORIGEN.get('port', 3306),
+            'user': DB_CONFIG_ORIGEN['user'],
+            'passwd': DB_CONFIG_ORIGEN['password']
+        }
+        if DB_CONFIG_ORIGEN.get('ssl_ca'):
+            conexion['ssl'] = {'ca': DB_CONFIG_ORIGEN['ssl_ca']}
+        stream = BinLogStreamReader(
+            connection_settings=conexion,
+            server_id=ETL_CDC_SERVER_ID,
+            only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent, XidEvent, QueryEvent, HeartbeatLogEvent],
+            only_schemas=[DB_CONFIG_ORIGEN['database']],
+            log_file=log_file,
+            log_pos=log_pos,
+            resume_stream=True,
+            blocking=True,
+            slave_heartbeat=ETL_CDC_INTERVALO # Eventos periódicos para poder vaciar el buffer aunque no haya cambios
+        )
+
+        cambios = {}
+        pendientes = 0
+        en_transaccion = False
+        ultimo_vaciado = ultima_exportacion = perf_counter()
+        inicio = perf_counter()
+        for evento in stream:
+            if isinstance(evento, XidEvent):
+                en_transaccion = False # COMMIT de una transacción InnoDB
+            elif isinstance(evento, QueryEvent):
+                # BEGIN abre una transacción; COMMIT (tablas no transaccionales) o una sentencia DDL la cierran
+                en_transaccion = evento.query.strip().upper() == 'BEGIN'
+            elif isinstance(evento, (WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent)):
+                en_transaccion = True # Por si el BEGIN quedó fuera del filtro de esquemas
+            tabla = tablas.get(getattr(evento, 'table', '').lower())
+            if tabla:
+                columnas = COLUMNAS_ORIGEN[tabla]
+                for fila in evento.rows:
+                    if isinstance(evento, DeleteRowsEvent):
+                        operacion, valores = 'delete', fila['values']
+                    else:
+                        operacion, valores = 'upsert', fila.get('after_values', fila.get('values'))
+                    tupla = tuple(valores[columna] for columna in columnas)
+                    cambios.setdefault(tabla, {})[tupla[0]] = (operacion, tupla)
+                    pendientes += 1
+
+            if pendientes and not en_transaccion and (
+                    pendientes >= ETL_CDC_TAMANO_LOTE or perf_counter() - ultimo_vaciado >= ETL_CDC_INTERVALO):
+                print(f"\nAplicando micro-lote CDC de {pendientes} cambios...")
+                if not apply_cdc_changes(conn_almacen, cambios):
+                    print("Error al aplicar el micro-lote CDC; se detiene para reintentar desde la última posición guardada.")
+                    return
+                save_watermarks(conn_almacen, {
+                    'cdc_binlog_archivo': int(stream.log_file.rsplit('.', 1)[1]),
+                    'cdc_binlog_posicion': stream.log_pos
+                })
+                # Los archivos Parquet siguen abiertos entre micro-lotes: se cierran y compactan cada cierto tiempo
+                if (perf_counter() - ultima_exportacion >= ETL_CDC_INTERVALO_PARQUET
+                        or len(_exportacion['archivos']) >= ETL_PARQUET_ARCHIVOS_COMPACTAR):
+                    close_parquet_export()
+                    ultima_exportacion = perf_counter()
+                cambios = {}
+                pendientes = 0
+                ultimo_vaciado = perf_counter()
+
+            if ETL_CDC_DURACION and perf_counter() - inicio >= ETL_CDC_DURACION and not pendientes and not en_transaccion:
+                print("Duración máxima de CDC alcanzada.")
+                break
+    finally:
+        close_parquet_export()
+        if stream:
+            stream.close()
+        if conn_origen:
+            conn_origen.close()
+        conn_almacen.close()
+        print("Conexiones de CDC cerradas.")
+
 if __name__ == "__main__":
-    run_etl_process()
+    if ETL_GRANO_TIEMPO and ETL_GRANO_TIEMPO not in SEGUNDOS_POR_GRANO:
+        print(f"ETL_GRANO_TIEMPO='{ETL_GRANO_TIEMPO}' no es válido: debe ser uno de {', '.join(SEGUNDOS_POR_GRANO)} "
+              "o estar vacío. Terminando ETL.")
+        exit(1)
+    report_bulk_load_fallbacks()
+    if not DB_CONFIG_ALMACEN or not (ETL_DESDE_SNAPSHOT and ETL_MODO_CARGA != 'cdc' or DB_CONFIG_ORIGEN):
+        print("No se pudieron cargar las credenciales de la base de datos desde Key Vault. Terminando ETL.")
+        exit(1)
+    try:
+        if ETL_MODO_CARGA == 'cdc':
+            run_cdc_process()
+        else:
+            run_etl_process()
+    finally:
+        write_metrics()
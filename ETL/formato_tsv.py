@@ -0,0 +1,11 @@
+"""Serialización de filas para archivos TSV de LOAD DATA, compartida por etl.py y generar_data_de_prueba_origen.py."""
+
+def valor_tsv(valor):
+    """Serializa un valor para un archivo TSV de LOAD DATA (NULL como \\N, escapando separadores)."""
+    if valor is None:
+        return "\\N"
+    return str(valor).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def fila_tsv(fila):
+    """Serializa una fila como una línea TSV (terminada en salto de línea)."""
+    return "\t".join(valor_tsv(valor) for valor in fila) + "\n"
@@ -0,0 +1,169 @@
+USE db_destino;
+
+-- Esquema compacto del almacén (alternativa a almacen_citas_v2.sql, usar con ETL_ESQUEMA_COMPACTO=true):
+-- claves sustitutas y de negocio enteras (BIGINT donde caben versiones SCD2 o YYYYMMDDHHMMSS) y columnas de texto
+-- con el tamaño de las columnas de origen, para que la tabla de hechos, sus índices y los joins sean más pequeños.
+
+
+SET FOREIGN_KEY_CHECKS = 0;
+
+
+CREATE TABLE `dim_especialidades` (
+  `id_especialidad_sk` int unsigned NOT NULL,
+  `id_especialidad` int unsigned UNIQUE NOT NULL,
+  `nombre_especialidad` varchar(255) DEFAULT NULL,
+  `fecha_carga` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id_especialidad_sk`)
+);
+
+-- Especialidad reservada para los médicos sin EspecialidadID en el origen (ESPECIALIDAD_SIN_ASIGNAR en etl.py)
+INSERT INTO `dim_especialidades` (`id_especialidad_sk`, `id_especialidad`, `nombre_especialidad`) VALUES (0, 0, 'Sin especialidad');
+
+-- dim_pacientes y dim_medicos son dimensiones SCD tipo 2: cada cambio crea una nueva versión (es_actual = 1)
+-- y cierra la anterior (valido_hasta). La SK de la versión n es (n - 1) * 10^10 + clave de negocio.
+CREATE TABLE `dim_pacientes` (
+  `id_paciente_sk` bigint unsigned NOT NULL,
+  `id_paciente` int unsigned NOT NULL,
+  `apellido` varchar(255) DEFAULT NULL,
+  `direccion` varchar(255) DEFAULT NULL,
+  `fecha_nacimiento` date DEFAULT NULL,
+  `genero` varchar(10) DEFAULT NULL,
+  `nombre` varchar(255) DEFAULT NULL,
+  `telefono` varchar(20) DEFAULT NULL,
+  `hash_contenido` char(32) CHARACTER SET ascii DEFAULT NULL,
+  `valido_desde` datetime DEFAULT NULL,
+  `valido_hasta` datetime DEFAULT NULL,
+  `version` smallint unsigned NOT NULL DEFAULT 1,
+  `es_actual` tinyint(1) NOT NULL DEFAULT 1,
+  `fecha_carga` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id_paciente_sk`),
+  KEY `id_paciente_actual` (`id_paciente`, `es_actual`)
+);
+
+CREATE TABLE `dim_medicos` (
+  `id_medico_sk` bigint unsigned NOT NULL,
+  `id_medico` int unsigned NOT NULL,
+  `id_especialidad` int unsigned NOT NULL,
+  `codigo_empleado` varchar(50) DEFAULT NULL,
+  `nombre` varchar(255) DEFAULT NULL,
+  `apellido` varchar(255) DEFAULT NULL,
+  `genero` varchar(10) DEFAULT NULL,
+  `hash_contenido` char(32) CHARACTER SET ascii DEFAULT NULL,
+  `valido_desde` datetime DEFAULT NULL,
+  `valido_hasta` datetime DEFAULT NULL,
+  `version` smallint unsigned NOT NULL DEFAULT 1,
+  `es_actual` tinyint(1) NOT NULL DEFAULT 1,
+  `fecha_carga` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id_medico_sk`),
+  KEY `id_medico_actual` (`id_medico`, `es_actual`),
+  KEY `FK_dim_medicos_dim_especialidades` (`id_especialidad`),
+  CONSTRAINT `FK_dim_medicos_dim_especialidades` FOREIGN KEY (`id_especialidad`) REFERENCES `dim_especialidades` (`id_especialidad`)
+);
+
+CREATE TABLE `dim_tiempo` (
+  `id_tiempo_sk` bigint unsigned NOT NULL, -- YYYYMMDDHHMMSS numérico
+  `fecha` date DEFAULT NULL,
+  `anio` smallint unsigned DEFAULT NULL,
+  `mes` tinyint unsigned DEFAULT NULL,
+  `dia` tinyint unsigned DEFAULT NULL,
+  `hora` tinyint unsigned DEFAULT NULL,
+  `minuto` tinyint unsigned DEFAULT NULL,
+  `segundo` tinyint unsigned DEFAULT NULL,
+  `nombre_mes` varchar(10) DEFAULT NULL,
+  `dia_semana` varchar(10) DEFAULT NULL,
+  `fecha_carga` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id_tiempo_sk`)
+);
+
+-- citas_hechos está particionada por mes de fecha_hora_cita (RANGE): la carga escribe cada mes en paralelo y las
+-- consultas por rango de fechas solo leen sus particiones. El ETL crea las particiones de meses futuros
+-- reorganizando p_futuro. MySQL no admite FKs en tablas particionadas, así que las referencias a las dimensiones
+-- las garantiza el ETL (solo carga hechos con claves sustitutas resueltas), y la fecha forma parte de la PK.
+CREATE TABLE `citas_hechos` (
+  `id_cita` int unsigned NOT NULL,
+  `id_paciente_sk` bigint unsigned NOT NULL,
+  `id_medico_sk` bigint unsigned NOT NULL,
+  `id_tiempo_sk` bigint unsigned NOT NULL,
+  `fecha_hora_cita` datetime NOT NULL,
+  `estado_cita` varchar(50) DEFAULT NULL,
+  `motivo_cita` varchar(255) DEFAULT NULL,
+  `fecha_carga` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id_cita`, `fecha_hora_cita`),
+  KEY `id_paciente_sk` (`id_paciente_sk`),
+  KEY `id_medico_sk` (`id_medico_sk`),
+  KEY `id_tiempo_sk` (`id_tiempo_sk`)
+)
+PARTITION BY RANGE (TO_DAYS(`fecha_hora_cita`)) (
+  PARTITION p_anterior VALUES LESS THAN (TO_DAYS('2024-01-01')),
+  PARTITION p202401 VALUES LESS THAN (TO_DAYS('2024-02-01')),
+  PARTITION p202402 VALUES LESS THAN (TO_DAYS('2024-03-01')),
+  PARTITION p202403 VALUES LESS THAN (TO_DAYS('2024-04-01')),
+  PARTITION p202404 VALUES LESS THAN (TO_DAYS('2024-05-01')),
+  PARTITION p202405 VALUES LESS THAN (TO_DAYS('2024-06-01')),
+  PARTITION p202406 VALUES LESS THAN (TO_DAYS('2024-07-01')),
+  PARTITION p202407 VALUES LESS THAN (TO_DAYS('2024-08-01')),
+  PARTITION p202408 VALUES LESS THAN (TO_DAYS('2024-09-01')),
+  PARTITION p202409 VALUES LESS THAN (TO_DAYS('2024-10-01')),
+  PARTITION p202410 VALUES LESS THAN (TO_DAYS('2024-11-01')),
+  PARTITION p202411 VALUES LESS THAN (TO_DAYS('2024-12-01')),
+  PARTITION p202412 VALUES LESS THAN (TO_DAYS('2025-01-01')),
+  PARTITION p202501 VALUES LESS THAN (TO_DAYS('2025-02-01')),
+  PARTITION p202502 VALUES LESS THAN (TO_DAYS('2025-03-01')),
+  PARTITION p202503 VALUES LESS THAN (TO_DAYS('2025-04-01')),
+  PARTITION p202504 VALUES LESS THAN (TO_DAYS('2025-05-01')),
+  PARTITION p202505 VALUES LESS THAN (TO_DAYS('2025-06-01')),
+  PARTITION p202506 VALUES LESS THAN (TO_DAYS('2025-07-01')),
+  PARTITION p202507 VALUES LESS THAN (TO_DAYS('2025-08-01')),
+  PARTITION p202508 VALUES LESS THAN (TO_DAYS('2025-09-01')),
+  PARTITION p202509 VALUES LESS THAN (TO_DAYS('2025-10-01')),
+  PARTITION p202510 VALUES LESS THAN (TO_DAYS('2025-11-01')),
+  PARTITION p202511 VALUES LESS THAN (TO_DAYS('2025-12-01')),
+  PARTITION p202512 VALUES LESS THAN (TO_DAYS('2026-01-01')),
+  PARTITION p202601 VALUES LESS THAN (TO_DAYS('2026-02-01')),
+  PARTITION p202602 VALUES LESS THAN (TO_DAYS('2026-03-01')),
+  PARTITION p202603 VALUES LESS THAN (TO_DAYS('2026-04-01')),
+  PARTITION p202604 VALUES LESS THAN (TO_DAYS('2026-05-01')),
+  PARTITION p202605 VALUES LESS THAN (TO_DAYS('2026-06-01')),
+  PARTITION p202606 VALUES LESS THAN (TO_DAYS('2026-07-01')),
+  PARTITION p202607 VALUES LESS THAN (TO_DAYS('2026-08-01')),
+  PARTITION p202608 VALUES LESS THAN (TO_DAYS('2026-09-01')),
+  PARTITION p202609 VALUES LESS THAN (TO_DAYS('2026-10-01')),
+  PARTITION p202610 VALUES LESS THAN (TO_DAYS('2026-11-01')),
+  PARTITION p202611 VALUES LESS THAN (TO_DAYS('2026-12-01')),
+  PARTITION p202612 VALUES LESS THAN (TO_DAYS('2027-01-01')),
+  PARTITION p_futuro VALUES LESS THAN MAXVALUE
+);
+
+-- Agregados de citas_hechos que el ETL mantiene incrementalmente con cada lote (ETL_AGREGADOS=true), para que los
+-- tableros cuenten citas sin recorrer la tabla de hechos. motivo_cita vacío ('') agrupa las citas sin motivo.
+CREATE TABLE `agg_citas_dia_medico` (
+  `fecha` date NOT NULL,
+  `id_medico_sk` bigint unsigned NOT NULL,
+  `estado_cita` varchar(50) NOT NULL,
+  `motivo_cita` varchar(255) NOT NULL DEFAULT '',
+  `num_citas` int NOT NULL,
+  `fecha_actualizacion` timestamp NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`fecha`, `id_medico_sk`, `estado_cita`, `motivo_cita`),
+  KEY `id_medico_sk` (`id_medico_sk`)
+);
+
+CREATE TABLE `agg_citas_mes_especialidad` (
+  `anio` smallint unsigned NOT NULL,
+  `mes` tinyint unsigned NOT NULL,
+  `id_especialidad` int unsigned NOT NULL,
+  `estado_cita` varchar(50) NOT NULL,
+  `motivo_cita` varchar(255) NOT NULL DEFAULT '',
+  `num_citas` int NOT NULL,
+  `fecha_actualizacion` timestamp NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`anio`, `mes`, `id_especialidad`, `estado_cita`, `motivo_cita`)
+);
+
+-- Tabla de control del ETL: marca de agua (último ID cargado) por tabla de origen para la carga incremental
+CREATE TABLE `etl_control` (
+  `tabla_origen` varchar(100) NOT NULL,
+  `marca_agua` bigint DEFAULT NULL,
+  `fecha_actualizacion` timestamp NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`tabla_origen`)
+);
+
+SET FOREIGN_KEY_CHECKS = 1;
\ No newline at end of file
@@ -0,0 +1,274 @@
+"""Benchmark reproducible del ETL contra un MySQL local (Docker o servidor local).
+
+Para cada escala (número de citas) genera un dataset con semilla fija en db_origen (por defecto con el generador
+rápido generate_data_fast; con --generador faker, con generate_data e insert_data), recrea db_destino y ejecuta ETL/etl.py como subproceso con las métricas por etapa activadas
+(ETL_METRICAS_ARCHIVO). Los resultados (tiempo, filas, filas/s y pico de memoria por etapa) se añaden como JSON
+lines al archivo de resultados, etiquetados con el commit, para compararlos entre commits:
+
+    python benchmark_etl.py --docker --escalas 10000,1000000 --resultados benchmark.jsonl
+    python benchmark_etl.py --comparar base.jsonl benchmark.jsonl --umbral 0.10
+
+Con --generador faker, las escalas grandes necesitan un servidor con max_allowed_packet alto (insert_data inserta
+cada tabla en una sola sentencia); el contenedor de --docker ya se inicia con 1 GB.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, date
+from statistics import median
+from time import perf_counter, sleep
+try:
+    import resource # Solo en sistemas Unix; sin él no se reporta el pico de memoria de la generación
+except ImportError:
+    resource = None
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+# Nombres de las bases de datos usados por origen_citas_v2.sql y almacen_citas_v2.sql
+DB_ORIGEN = "db_origen"
+DB_ALMACEN = "db_destino"
+CONTENEDOR_DOCKER = "etl-benchmark-mysql"
+ESCALAS_POR_DEFECTO = "10000,1000000,10000000"
+# Fecha de referencia fija del generador rápido, para que el dataset no cambie de un día a otro
+FECHA_REFERENCIA = date(2025, 1, 1)
+
+def proporciones(num_citas):
+    """Pacientes y médicos para una escala, con las mismas proporciones que generar_data_de_prueba_origen.py."""
+    return max(1, num_citas // 5), max(1, num_citas // 50)
+
+def git_commit():
+    """Commit actual del repositorio (con sufijo -dirty si hay cambios sin confirmar), o None fuera de git."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True, text=True, check=True).stdout.strip()
+        cambios = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=RAIZ, capture_output=True, text=True, check=True).stdout
+        return commit + ("-dirty" if cambios.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def rss_maximo():
+    """Pico de memoria residente de este proceso en bytes (ru_maxrss está en KB en Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None
+
+def start_docker_mysql(args):
+    """Inicia (o reutiliza) un contenedor MySQL 8 para el benchmark, con la configuración que el ETL necesita."""
+    existe = subprocess.run(["docker", "ps", "-a", "-q", "-f", f"name=^{CONTENEDOR_DOCKER}$"], capture_output=True, text=True, check=True).stdout.strip()
+    if existe:
+        subprocess.run(["docker", "start", CONTENEDOR_DOCKER], check=True, capture_output=True)
+    else:
+        print(f"Iniciando contenedor {CONTENEDOR_DOCKER} en el puerto {args.puerto}...")
+        subprocess.run([
+            "docker", "run", "-d", "--name", CONTENEDOR_DOCKER,
+            "-e", f"MYSQL_ROOT_PASSWORD={args.password}", "-p", f"{args.puerto}:3306", args.imagen_docker,
+            # Nombres de tabla sin distinción de mayúsculas, como en Azure MySQL (el ETL usa Citas, los scripts citas)
+            "--lower-case-table-names=1", "--local-infile=1", "--max-allowed-packet=1G", "--log-bin=mysql-bin",
+            # Binlog con filas y nombres de columna completos, como requiere el modo CDC del ETL
+            "--binlog-format=ROW", "--binlog-row-image=FULL", "--binlog-row-metadata=FULL"
+        ], check=True, capture_output=True)
+
+def connect_server(args, database=None, espera=0):
+    """Conecta al servidor del benchmark, esperando hasta espera segundos a que acepte conexiones."""
+    import mysql.connector
+    limite = perf_counter() + espera
+    while True:
+        try:
+            return mysql.connector.connect(host=args.host, port=args.puerto, user=args.usuario, password=args.password,
+                                           database=database, allow_local_infile=True)
+        except mysql.connector.Error:
+            if perf_counter() >= limite:
+                raise
+            sleep(2)
+
+def run_sql_file(conn, ruta):
+    """Ejecuta un script SQL del repositorio sentencia a sentencia (sin comentarios de línea)."""
+    with open(ruta, encoding='utf-8') as f:
+        sql = "\n".join(linea for linea in f if not linea.lstrip().startswith("--"))
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 0") # origen_citas_v2.sql crea citas antes que las tablas referidas
+        for sentencia in sql.split(";"):
+            if sentencia.strip():
+                cursor.execute(sentencia)
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+        conn.commit()
+    finally:
+        cursor.close()
+
+def recreate_database(conn, nombre, script):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"DROP DATABASE IF EXISTS {nombre}")
+        cursor.execute(f"CREATE DATABASE {nombre} CHARACTER SET utf8mb4")
+    finally:
+        cursor.close()
+    run_sql_file(conn, os.path.join(RAIZ, script))
+
+def count_rows(conn, tabla):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT COUNT(*) FROM {DB_ORIGEN}.{tabla}")
+        return cursor.fetchone()[0]
+    except Exception:
+        return None
+    finally:
+        cursor.close()
+
+def prepare_source(conn, num_citas, args):
+    """Genera e inserta el dataset de una escala en db_origen. Retorna las mediciones de generación e inserción.
+
+    Con --reusar-origen, si db_origen ya tiene exactamente num_citas citas se conserva (la semilla fija hace que el
+    dataset sea el mismo) y no se mide nada.
+    """
+    from generar_data_de_prueba_origen import generate_data, insert_data, generate_data_fast
+    from faker import Faker
+
+    if args.reusar_origen and count_rows(conn, "Citas") == num_citas:
+        print(f"Reutilizando db_origen con {num_citas} citas.")
+        return []
+    recreate_database(conn, DB_ORIGEN, "origen_citas_v2.sql")
+    conn.database = DB_ORIGEN
+
+    num_pacientes, num_medicos = proporciones(num_citas)
+    print(f"Generando {num_pacientes} pacientes, {num_medicos} médicos y {num_citas} citas...")
+    inicio = perf_counter()
+    if args.generador == 'rapido':
+        # Generación e inserción se solapan, así que se miden juntas
+        generate_data_fast(conn, num_pacientes, num_medicos, num_citas, args.semilla, args.procesos_generador,
+                           fecha_referencia=FECHA_REFERENCIA)
+        mediciones = [{'etapa': 'generate_data_fast', 'segundos': perf_counter() - inicio, 'filas_salida': num_citas, 'rss_pico_proceso_bytes': rss_maximo()}]
+    else:
+        Faker.seed(args.semilla)
+        random.seed(args.semilla)
+        data = generate_data(num_pacientes, num_medicos, num_citas)
+        mediciones = [{'etapa': 'generate_data', 'segundos': perf_counter() - inicio, 'filas_salida': num_citas, 'rss_pico_proceso_bytes': rss_maximo()}]
+        inicio = perf_counter()
+        insert_data(conn, data)
+        mediciones.append({'etapa': 'insert_data', 'segundos': perf_counter() - inicio, 'filas_entrada': num_citas, 'rss_pico_proceso_bytes': rss_maximo()})
+        del data
+
+    # insert_data solo imprime sus errores, así que se verifica el resultado
+    insertadas = count_rows(conn, "Citas")
+    if insertadas != num_citas:
+        raise RuntimeError(f"db_origen tiene {insertadas} citas en lugar de {num_citas}; revisa max_allowed_packet y la salida de insert_data.")
+    return mediciones
+
+def run_etl(args, modo, extra_env):
+    """Ejecuta ETL/etl.py contra el servidor del benchmark y retorna sus métricas por etapa y el tiempo total."""
+    archivo_metricas = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False).name
+    log = tempfile.NamedTemporaryFile('w', suffix='.log', prefix='etl_benchmark_', delete=False)
+    env = dict(os.environ)
+    env.pop("KEY_VAULT_URL", None)
+    for prefijo, database in (("DB_ORIGEN", DB_ORIGEN), ("DB_ALMACEN", DB_ALMACEN)):
+        env.update({f"{prefijo}_HOST": args.host, f"{prefijo}_PORT": str(args.puerto), f"{prefijo}_USER": args.usuario,
+                    f"{prefijo}_PASSWORD": args.password, f"{prefijo}_DATABASE": database})
+    env.update({"ETL_MODO_CARGA": modo, "ETL_METRICAS_ARCHIVO": archivo_metricas, "ETL_METRICAS_PROMETHEUS": ""})
+    env.update(extra_env)
+    try:
+        inicio = perf_counter()
+        with log:
+            proceso = subprocess.run([sys.executable, os.path.join(RAIZ, "ETL", "etl.py")], env=env, stdout=log, stderr=subprocess.STDOUT)
+        segundos = perf_counter() - inicio
+        with open(archivo_metricas, encoding='utf-8') as f:
+            metricas = [json.loads(linea) for linea in f if linea.strip()]
+        if proceso.returncode != 0 or not any(m['etapa'] == 'run_etl_process' for m in metricas):
+            raise RuntimeError(f"El ETL terminó con código {proceso.returncode}; ver {log.name}")
+        os.remove(log.name)
+        return metricas + [{'etapa': 'etl_total', 'segundos': segundos}]
+    finally:
+        os.remove(archivo_metricas)
+
+def run_benchmark(args):
+    extra_env = dict(par.split("=", 1) for par in args.env)
+    if args.esquema_compacto:
+        extra_env["ETL_ESQUEMA_COMPACTO"] = "true"
+    if args.docker:
+        start_docker_mysql(args)
+    conn = connect_server(args, espera=120 if args.docker else 0)
+    commit = git_commit()
+    try:
+        for num_citas in sorted(int(escala) for escala in args.escalas.split(",")):
+            print(f"\n=== Escala: {num_citas} citas ===")
+            mediciones = [dict(m, modo=None, repeticion=0) for m in prepare_source(conn, num_citas, args)]
+            for repeticion in range(args.repeticiones):
+                recreate_database(conn, DB_ALMACEN, "almacen_citas_v2_compacto.sql" if args.esquema_compacto else "almacen_citas_v2.sql")
+                # Los modos se ejecutan en orden sobre el mismo almacén (p. ej. completa y luego incremental sin cambios)
+                for modo in args.modos.split(","):
+                    print(f"Ejecutando ETL (modo {modo}, repetición {repeticion + 1}/{args.repeticiones})...")
+                    for m in run_etl(args, modo, extra_env):
+                        m.pop('fecha', None)
+                        mediciones.append(dict(m, modo=modo, repeticion=repeticion))
+                    print(f"  {mediciones[-1]['segundos']:.2f} s")
+
+            fecha = datetime.now().isoformat(timespec='seconds')
+            with open(args.resultados, 'a', encoding='utf-8') as f:
+                for m in mediciones:
+                    m['segundos'] = round(m['segundos'], 3)
+                    f.write(json.dumps({'fecha': fecha, 'commit': commit, 'escala': num_citas, 'configuracion': extra_env,
+                                        'python': sys.version.split()[0], **m}) + "\n")
+            print(f"Resultados de la escala {num_citas} añadidos a {args.resultados}.")
+    finally:
+        conn.close()
+
+def summarize(ruta):
+    """Mediana de segundos y máximo del pico de memoria del proceso por (escala, configuración, modo, etapa) de un
+    archivo de resultados (rss_max_bytes en los resultados anteriores)."""
+    grupos = {}
+    with open(ruta, encoding='utf-8') as f:
+        for linea in f:
+            if linea.strip():
+                m = json.loads(linea)
+                grupos.setdefault((m['escala'], json.dumps(m.get('configuracion') or {}, sort_keys=True), m.get('modo'), m['etapa']), []).append(m)
+    return {
+        clave: (median(m['segundos'] for m in filas), max(m.get('rss_pico_proceso_bytes', m.get('rss_max_bytes')) or 0 for m in filas))
+        for clave, filas in grupos.items()
+    }
+
+def compare_results(base, nuevo, umbral):
+    """Compara dos archivos de resultados. Retorna True si ninguna etapa empeoró más que umbral (fracción)."""
+    resumen_base = summarize(base)
+    resumen_nuevo = summarize(nuevo)
+    sin_regresiones = True
+    print(f"{'escala':>10} {'modo':<12} {'etapa':<26} {'base (s)':>10} {'nuevo (s)':>10} {'cambio':>8} {'memoria':>8}")
+    for clave in sorted(set(resumen_base) & set(resumen_nuevo), key=lambda c: (c[0], c[1], c[2] or "", c[3])):
+        (seg_base, rss_base), (seg_nuevo, rss_nuevo) = resumen_base[clave], resumen_nuevo[clave]
+        cambio = (seg_nuevo - seg_base) / seg_base if seg_base else 0.0
+        cambio_rss = (rss_nuevo - rss_base) / rss_base if rss_base else 0.0
+        regresion = cambio > umbral or cambio_rss > umbral
+        sin_regresiones = sin_regresiones and not regresion
+        escala, _, modo, etapa = clave
+        print(f"{escala:>10} {modo or '-':<12} {etapa:<26} {seg_base:>10.3f} {seg_nuevo:>10.3f} {cambio:>+8.1%} {cambio_rss:>+8.1%}"
+              + ("  REGRESIÓN" if regresion else ""))
+    return sin_regresiones
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reproducible del ETL con datasets sintéticos.")
+    parser.add_argument("--escalas", default=ESCALAS_POR_DEFECTO, help="Números de citas separados por coma")
+    parser.add_argument("--modos", default="completa", help="Modos de ETL_MODO_CARGA a ejecutar en orden, separados por coma")
+    parser.add_argument("--repeticiones", type=int, default=1)
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--resultados", default="benchmark_resultados.jsonl")
+    parser.add_argument("--env", action="append", default=[], metavar="VARIABLE=VALOR",
+                        help="Variable de entorno extra para el ETL (p. ej. ETL_CARGA_PARALELA=true); se puede repetir")
+    parser.add_argument("--generador", choices=("rapido", "faker"), default="rapido",
+                        help="rapido: generate_data_fast (pools de Faker, NumPy y procesos); faker: generate_data e insert_data")
+    parser.add_argument("--procesos-generador", type=int, default=None)
+    parser.add_argument("--esquema-compacto", action="store_true", help="Usar almacen_citas_v2_compacto.sql (claves enteras)")
+    parser.add_argument("--reusar-origen", action="store_true", help="No regenerar db_origen si ya tiene la escala pedida")
+    parser.add_argument("--host", default=os.environ.get("BENCHMARK_MYSQL_HOST", "127.0.0.1"))
+    parser.add_argument("--puerto", type=int, default=int(os.environ.get("BENCHMARK_MYSQL_PORT", "3307")))
+    parser.add_argument("--usuario", default=os.environ.get("BENCHMARK_MYSQL_USER", "root"))
+    parser.add_argument("--password", default=os.environ.get("BENCHMARK_MYSQL_PASSWORD", "benchmark"))
+    parser.add_argument("--docker", action="store_true", help=f"Iniciar (o reutilizar) el contenedor {CONTENEDOR_DOCKER}")
+    parser.add_argument("--imagen-docker", default="mysql:8.0")
+    parser.add_argument("--comparar", nargs=2, metavar=("BASE", "NUEVO"), help="Comparar dos archivos de resultados y salir")
+    parser.add_argument("--umbral", type=float, default=0.10, help="Empeoramiento relativo tolerado al comparar")
+    args = parser.parse_args()
+
+    if args.comparar:
+        sys.exit(0 if compare_results(*args.comparar, args.umbral) else 1)
+    run_benchmark(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
 from faker import Faker
 import mysql.connector
-from datetime import datetime, timedelta, time # Importar time
+from datetime import datetime, timedelta, time, date # Importar time
 import random # ¡Importar el módulo random!
+import argparse
+import os
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ETL")) # Módulos compartidos con el ETL
+from formato_tsv import fila_tsv
 
 # Configuración de la conexión a la base de datos de origen
 # Asegúrate de que estas credenciales sean correctas para tu DB de origen
@@ -20,13 +27,17 @@ def connect_to_db():
         print(f"Error al conectar a la base de datos: {e}")
         return None
 
+ESPECIALIDADES = ['Cardiología', 'Dermatología', 'Gastroenterología', 'Neurología', 'Pediatría',
+                  'Oftalmología', 'Traumatología', 'Urología', 'Ginecología', 'Psiquiatría']
+ESTADOS_CITA = ['Programada', 'Atendida', 'Cancelada', 'Reprogramada']
+MOTIVOS_CITA = ['Consulta general', 'Control', 'Urgencia', 'Examen']
+
 def generate_data(num_pacientes, num_medicos, num_citas):
     """Genera datos de prueba para las tablas de origen."""
     fake = Faker('es_CO')
-    especialidades_lista = ['Cardiología', 'Dermatología', 'Gastroenterología', 'Neurología', 'Pediatría', 
-                            'Oftalmología', 'Traumatología', 'Urología', 'Ginecología', 'Psiquiatría']
-    estado_cita_lista = ['Programada', 'Atendida', 'Cancelada', 'Reprogramada']
-    motivo_cita_lista = ['Consulta general', 'Control', 'Urgencia', 'Examen']
+    especialidades_lista = ESPECIALIDADES
+    estado_cita_lista = ESTADOS_CITA
+    motivo_cita_lista = MOTIVOS_CITA
     
     data = {
         'especialidades': [],
@@ -214,12 +225,182 @@ def insert_data(connection, data):
     finally:
         cursor.close()
 
+# --- Generador de alto volumen (modo rápido) ---
+# Valores de Faker precalculados una sola vez por campo; las filas se muestrean de ellos con NumPy
+TAMANO_POOL_FAKER = 5000
+# Filas por chunk generado en un proceso (y por commit) y filas por sentencia INSERT multi-fila
+TAMANO_CHUNK = 50000
+TAMANO_INSERT = 5000
+
+COLUMNAS_TABLAS = {
+    'Especialidades': ('EspecialidadID', 'NombreEspecialidad', 'Descripcion'),
+    'Pacientes': ('PacienteID', 'Nombre', 'Apellido', 'FechaNacimiento', 'Genero', 'Direccion', 'Telefono', 'Email'),
+    'Medicos': ('MedicoID', 'Nombre', 'Apellido', 'CodigoEmpleado', 'Genero', 'EspecialidadID', 'TelefonoContacto', 'Email'),
+    'Citas': ('CitaID', 'PacienteID', 'MedicoID', 'FechaCita', 'HoraCita', 'EstadoCita', 'MotivoCita', 'FechaCreacion')
+}
+
+_pools = None # Pools de Faker de cada proceso generador (se reciben una vez, en el inicializador)
+
+def build_faker_pools(semilla, tamano=TAMANO_POOL_FAKER):
+    """Genera con Faker (una sola vez) pools de nombres, apellidos, direcciones, teléfonos, emails y descripciones."""
+    Faker.seed(semilla)
+    fake = Faker('es_CO')
+    return {
+        'nombres': np.array([fake.first_name() for _ in range(tamano)], dtype=object),
+        'apellidos': np.array([fake.last_name() for _ in range(tamano)], dtype=object),
+        'direcciones': np.array([fake.address() for _ in range(tamano)], dtype=object),
+        'telefonos': np.array([fake.phone_number() for _ in range(tamano)], dtype=object),
+        'emails': np.array([fake.email() for _ in range(tamano)], dtype=object),
+        'descripciones': [fake.sentence(nb_words=6) for _ in ESPECIALIDADES]
+    }
+
+def _init_worker(pools):
+    global _pools
+    _pools = pools
+
+def _elegir(rng, valores, n):
+    return np.asarray(valores, dtype=object)[rng.integers(0, len(valores), n)].tolist()
+
+def _codigo_empleado(medico_id):
+    """Código con el patrón EMP####??? derivado del ID, único sin tener que comprobar duplicados."""
+    letras = medico_id // 10000
+    return "EMP%04d%s" % (medico_id % 10000, "".join(chr(65 + letras // 26 ** i % 26) for i in (2, 1, 0)))
+
+def generate_chunk(tabla, inicio, cantidad, semilla, num_pacientes, num_medicos, fecha_referencia):
+    """Genera las filas (tuplas en el orden de COLUMNAS_TABLAS, con IDs explícitos) inicio+1..inicio+cantidad de una tabla.
+
+    Cada chunk usa su propio generador sembrado con (semilla, tabla, inicio), así que el resultado no depende
+    del número de procesos ni del orden en que se ejecutan los chunks.
+    """
+    rng = np.random.default_rng([semilla, list(COLUMNAS_TABLAS).index(tabla), inicio])
+    ids = list(range(inicio + 1, inicio + cantidad + 1))
+    referencia = np.datetime64(fecha_referencia, 'D')
+    generos = _elegir(rng, ['Masculino', 'Femenino'], cantidad)
+    if tabla == 'Pacientes':
+        nacimiento = (referencia - rng.integers(18 * 365, 80 * 365, cantidad)).astype(str).tolist()
+        return list(zip(ids, _elegir(rng, _pools['nombres'], cantidad), _elegir(rng, _pools['apellidos'], cantidad),
+                        nacimiento, generos, _elegir(rng, _pools['direcciones'], cantidad),
+                        _elegir(rng, _pools['telefonos'], cantidad), _elegir(rng, _pools['emails'], cantidad)))
+    if tabla == 'Medicos':
+        especialidades = rng.integers(1, len(ESPECIALIDADES) + 1, cantidad).tolist()
+        return list(zip(ids, _elegir(rng, _pools['nombres'], cantidad), _elegir(rng, _pools['apellidos'], cantidad),
+                        [_codigo_empleado(i) for i in ids], generos, especialidades,
+                        _elegir(rng, _pools['telefonos'], cantidad), _elegir(rng, _pools['emails'], cantidad)))
+    # Citas: fecha en [-1 año, +1 año] respecto a fecha_referencia, como en generate_data
+    fechas = (referencia + rng.integers(-365, 366, cantidad)).astype(str).tolist()
+    segundos = rng.integers(0, 86400, cantidad).tolist()
+    horas = ["%02d:%02d:%02d" % (s // 3600, s // 60 % 60, s % 60) for s in segundos]
+    creacion = str(np.datetime64(fecha_referencia, 's')).replace("T", " ")
+    return list(zip(ids, rng.integers(1, num_pacientes + 1, cantidad).tolist(), rng.integers(1, num_medicos + 1, cantidad).tolist(),
+                    fechas, horas, _elegir(rng, ESTADOS_CITA, cantidad), _elegir(rng, MOTIVOS_CITA, cantidad), [creacion] * cantidad))
+
+def _generate_chunk_tsv(*args):
+    return "".join(fila_tsv(fila) for fila in generate_chunk(*args))
+
+def generate_chunks(tabla, total, semilla, num_pacientes, num_medicos, fecha_referencia, pool, procesos, tsv=False, tamano_chunk=TAMANO_CHUNK):
+    """Genera una tabla por chunks en el pool de procesos y los produce en orden de ID.
+
+    Como mucho hay dos chunks en vuelo por proceso, para que la generación no se adelante demasiado a la escritura.
+    """
+    funcion = _generate_chunk_tsv if tsv else generate_chunk
+    en_vuelo = []
+    for inicio in range(0, total, tamano_chunk):
+        en_vuelo.append(pool.submit(funcion, tabla, inicio, min(tamano_chunk, total - inicio), semilla,
+                                    num_pacientes, num_medicos, fecha_referencia))
+        if len(en_vuelo) >= 2 * procesos:
+            yield en_vuelo.pop(0).result()
+    for futuro in en_vuelo:
+        yield futuro.result()
+
+def insert_rows(connection, tabla, filas):
+    """Inserta filas con INSERT multi-fila de TAMANO_INSERT filas y confirma al final."""
+    columnas = COLUMNAS_TABLAS[tabla]
+    cursor = connection.cursor()
+    try:
+        for inicio in range(0, len(filas), TAMANO_INSERT):
+            lote = filas[inicio:inicio + TAMANO_INSERT]
+            fila_sql = "(" + ", ".join(["%s"] * len(columnas)) + ")"
+            cursor.execute(f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES " + ", ".join([fila_sql] * len(lote)),
+                           [valor for fila in lote for valor in fila])
+        connection.commit()
+    finally:
+        cursor.close()
+
+def generate_data_fast(connection, num_pacientes, num_medicos, num_citas, semilla=42, procesos=None,
+                       directorio_csv=None, fecha_referencia=None):
+    """Genera datos de prueba de alto volumen en paralelo y los escribe por chunks, sin tenerlos todos en memoria.
+
+    Con directorio_csv se escribe un TSV por tabla (para LOAD DATA) en lugar de insertar; si no, las tablas de
+    origen se truncan y los chunks se insertan en connection a medida que se generan. Los IDs se generan
+    explícitamente (1..N), así que las FKs de citas no requieren leer los AUTO_INCREMENT insertados.
+    Con la misma semilla y fecha_referencia el resultado es idéntico.
+    """
+    fecha_referencia = fecha_referencia or date.today()
+    procesos = procesos or os.cpu_count() or 1
+    pools = build_faker_pools(semilla)
+    especialidades = [(i + 1, nombre, descripcion) for i, (nombre, descripcion) in enumerate(zip(ESPECIALIDADES, pools['descripciones']))]
+    totales = {'Pacientes': num_pacientes, 'Medicos': num_medicos, 'Citas': num_citas}
+
+    cursor = None
+    if not directorio_csv:
+        cursor = connection.cursor()
+        print("Truncando tablas de origen (Pacientes, Medicos, Especialidades, Citas)...")
+        # Sin verificación de FKs durante la carga: los IDs referenciados se generan consistentes
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 0;")
+        for tabla in ('Citas', 'Medicos', 'Pacientes', 'Especialidades'):
+            cursor.execute(f"TRUNCATE TABLE {tabla};")
+        insert_rows(connection, 'Especialidades', especialidades)
+    else:
+        os.makedirs(directorio_csv, exist_ok=True)
+        with open(os.path.join(directorio_csv, "Especialidades.tsv"), 'w', encoding='utf-8', newline='\n') as archivo:
+            archivo.writelines(fila_tsv(fila) for fila in especialidades)
+
+    try:
+        with ProcessPoolExecutor(max_workers=procesos, initializer=_init_worker, initargs=(pools,)) as pool:
+            for tabla, total in totales.items():
+                print(f"Generando {total} filas en {tabla}...")
+                if directorio_csv:
+                    with open(os.path.join(directorio_csv, f"{tabla}.tsv"), 'w', encoding='utf-8', newline='\n') as archivo:
+                        for texto in generate_chunks(tabla, total, semilla, num_pacientes, num_medicos, fecha_referencia, pool, procesos, tsv=True):
+                            archivo.write(texto)
+                else:
+                    for filas in generate_chunks(tabla, total, semilla, num_pacientes, num_medicos, fecha_referencia, pool, procesos):
+                        insert_rows(connection, tabla, filas)
+                print(f"Cargadas {total} filas en {tabla}.")
+    except Exception:
+        if connection and not directorio_csv:
+            connection.rollback()
+        raise
+    finally:
+        if cursor:
+            cursor.execute("SET FOREIGN_KEY_CHECKS = 1;")
+            cursor.close()
+
+    if directorio_csv:
+        print(f"Archivos TSV escritos en {directorio_csv}. Para cargarlos (tras truncar las tablas y con FOREIGN_KEY_CHECKS = 0):")
+        for tabla, columnas in COLUMNAS_TABLAS.items():
+            print(f"  LOAD DATA LOCAL INFILE '{os.path.join(directorio_csv, tabla + '.tsv')}' INTO TABLE {tabla} CHARACTER SET utf8mb4 "
+                  f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({', '.join(columnas)});")
+
 if __name__ == "__main__":
-    connection = connect_to_db()
-    if connection:
-        num_pacientes = 2000
-        num_medicos = 200
-        num_citas = 10000
-        data = generate_data(num_pacientes, num_medicos, num_citas)
-        insert_data(connection, data)
-        connection.close()
+    parser = argparse.ArgumentParser(description="Genera datos de prueba para la base de datos de origen.")
+    parser.add_argument("--pacientes", type=int, default=2000)
+    parser.add_argument("--medicos", type=int, default=200)
+    parser.add_argument("--citas", type=int, default=10000)
+    parser.add_argument("--rapido", action="store_true", help="Generador de alto volumen: pools de Faker, NumPy y procesos en paralelo")
+    parser.add_argument("--procesos", type=int, default=None, help="Procesos generadores en modo rápido (por defecto, uno por CPU)")
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--csv", metavar="DIRECTORIO", help="En modo rápido, escribir TSV para LOAD DATA en lugar de insertar")
+    args = parser.parse_args()
+
+    if args.rapido and args.csv:
+        generate_data_fast(None, args.pacientes, args.medicos, args.citas, args.semilla, args.procesos, args.csv)
+    else:
+        connection = connect_to_db()
+        if connection:
+            if args.rapido:
+                generate_data_fast(connection, args.pacientes, args.medicos, args.citas, args.semilla, args.procesos)
+            else:
+                data = generate_data(args.pacientes, args.medicos, args.citas)
+                insert_data(connection, data)
+            connection.close()